@@ -84,6 +84,18 @@ private:
      */
     void registerDeviceApi();
 
+    /**
+     * 注册小时统计API
+     * 返回指定日期按小时汇总的统计数据，可按国家或设备分组
+     */
+    void registerHourlyApi();
+
+    /**
+     * 注册维度统计API
+     * 返回stats_dimensions中登记的维度（如media_source）按日期和维度值汇总的统计数据
+     */
+    void registerDimensionApi();
+
     /**
      * 注册详情API
      * 返回指定日期的详细数据
@@ -5,10 +5,13 @@
 #include <vector>
 #include <map>
 #include <memory>
+#include <shared_mutex>
+#include <sys/stat.h>
 
 /**
  * 数据库管理器类
  * 处理与SQLite数据库的连接和查询
+ * 数据处理脚本通过重命名整体替换数据库文件，每次查询前检查文件是否已被替换，替换后重新打开连接
  */
 class DatabaseManager {
 public:
@@ -49,8 +52,19 @@ public:
     bool isConnected() const;
 
 private:
+    std::string dbPath;
     sqlite3* db;
     bool connected;
+    // 当前连接打开的数据库文件标识，用于判断文件是否已被替换
+    dev_t dbDevice;
+    ino_t dbInode;
+    // 查询持有共享锁，重新打开连接时持有独占锁
+    std::shared_mutex dbMutex;
+
+    /**
+     * 数据库文件被替换时重新打开连接，打开失败时继续使用当前连接
+     */
+    void reopenIfReplaced();
 
     /**
      * 绑定参数到SQL语句
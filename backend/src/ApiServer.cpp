@@ -2,6 +2,7 @@
 #include <iostream>
 #include <string>
 #include <vector>
+#include <sstream>
 #include "json.hpp"
 
 // 简化JSON使用
@@ -19,6 +20,15 @@ json createSuccessResponse(const json& data, const std::string& message = "数
     return response;
 }
 
+// 用已经序列化好的data字符串创建成功响应体，data原样拼入，不解析再序列化
+std::string createSuccessResponseBody(const std::string& dataJson, const std::string& message = "数据获取成功") {
+    // 先以null占位生成外层对象，再把占位替换成data字符串
+    std::string body = createSuccessResponse(nullptr, message).dump();
+    const std::string placeholder = "\"data\":null";
+    body.replace(body.find(placeholder), placeholder.size(), "\"data\":" + dataJson);
+    return body;
+}
+
 // 创建API错误响应，同时添加CORS头
 json createErrorResponse(int code, const std::string& message) {
     json response;
@@ -82,6 +92,8 @@ void ApiServer::setupRoutes() {
     registerTimelineApi();
     registerCountryApi();
     registerDeviceApi();
+    registerHourlyApi();
+    registerDimensionApi();
     registerDetailsApi();
     registerLtvApi();  // 添加LTV API路由
 
@@ -392,6 +404,209 @@ void ApiServer::registerDeviceApi() {
     });
 }
 
+void ApiServer::registerHourlyApi() {
+    app.route_dynamic("/api/hourly")
+    ([this](const crow::request& req) {
+        try {
+            std::string whereClause = "";
+            std::vector<std::string> params;
+            
+            // 检查是否有日期参数
+            if (req.url_params.get("date") != nullptr) {
+                std::string dateParam = req.url_params.get("date");
+                
+                // 检查是否是日期范围查询（格式：startDate|endDate）
+                size_t separatorPos = dateParam.find('|');
+                if (separatorPos != std::string::npos) {
+                    whereClause = " WHERE stat_date BETWEEN ? AND ? ";
+                    params.push_back(dateParam.substr(0, separatorPos));
+                    params.push_back(dateParam.substr(separatorPos + 1));
+                } else {
+                    whereClause = " WHERE stat_date = ? ";
+                    params.push_back(dateParam);
+                }
+            }
+            
+            // 分组维度：country、device，未指定时返回每小时的汇总数据
+            std::string dimension = req.url_params.get("dimension") ? req.url_params.get("dimension") : "";
+            std::string table;
+            std::string dimensionColumn;
+            std::string dimensionKey;
+            if (dimension.empty()) {
+                table = "hourly_stats";
+            } else if (dimension == "country") {
+                table = "country_hourly_stats";
+                dimensionColumn = "country_code";
+                dimensionKey = "country";
+            } else if (dimension == "device") {
+                table = "device_hourly_stats";
+                dimensionColumn = "device_category";
+                dimensionKey = "device";
+            } else {
+                crow::response res;
+                res.code = 400;
+                res.body = createErrorResponse(400, "无效的分组维度: " + dimension).dump();
+                res.set_header("Content-Type", "application/json");
+                addCorsHeaders(res);
+                return res;
+            }
+            
+            std::string columns = dimensionColumn.empty()
+                ? "stat_date, stat_hour, user_count, new_user_count, event_count, purchase_count, revenue_usd"
+                : "stat_date, stat_hour, " + dimensionColumn + ", user_count, event_count, revenue_usd";
+            auto result = dbManager->executeQuery(
+                "SELECT " + columns + " FROM " + table +
+                whereClause +
+                "ORDER BY stat_date, stat_hour" + (dimensionColumn.empty() ? "" : ", revenue_usd DESC"),
+                params
+            );
+            
+            // 创建数据数组
+            json dataArray = json::array();
+            for (const auto& row : result) {
+                json item;
+                item["date"] = row.at("stat_date");
+                item["hour"] = std::stoi(row.at("stat_hour"));
+                if (dimensionColumn.empty()) {
+                    item["new_user_count"] = std::stoi(row.at("new_user_count"));
+                    item["purchase_count"] = std::stoi(row.at("purchase_count"));
+                } else {
+                    item[dimensionKey] = row.at(dimensionColumn);
+                }
+                item["user_count"] = std::stoi(row.at("user_count"));
+                item["event_count"] = std::stoi(row.at("event_count"));
+                item["revenue"] = std::stod(row.at("revenue_usd"));
+                dataArray.push_back(item);
+            }
+            
+            // 创建包含元数据的响应
+            json responseData;
+            responseData["items"] = dataArray;
+            responseData["total"] = dataArray.size();
+            
+            // 使用统一的响应格式
+            crow::response res;
+            res.body = createSuccessResponse(responseData, "小时统计数据获取成功").dump();
+            res.set_header("Content-Type", "application/json");
+            // 添加CORS头
+            addCorsHeaders(res);
+            return res;
+        } catch (const std::exception& e) {
+            crow::response res;
+            res.code = 500;
+            res.body = createErrorResponse(500, e.what()).dump();
+            res.set_header("Content-Type", "application/json");
+            // 添加CORS头
+            addCorsHeaders(res);
+            return res;
+        }
+    });
+}
+
+void ApiServer::registerDimensionApi() {
+    app.route_dynamic("/api/dimension")
+    ([this](const crow::request& req) {
+        try {
+            // 从维度登记表查找统计表，表名和列名只使用登记表中的值
+            std::string name = req.url_params.get("name") ? req.url_params.get("name") : "";
+            auto dimensionResult = dbManager->executeQuery(
+                "SELECT table_name, dimension_columns FROM stats_dimensions WHERE dimension_name = ?",
+                {name}
+            );
+            if (dimensionResult.empty()) {
+                crow::response res;
+                res.code = 400;
+                res.body = createErrorResponse(400, "未登记的统计维度: " + name).dump();
+                res.set_header("Content-Type", "application/json");
+                addCorsHeaders(res);
+                return res;
+            }
+            std::string table = dimensionResult[0].at("table_name");
+            std::vector<std::string> dimensionColumns;
+            std::stringstream columnStream(dimensionResult[0].at("dimension_columns"));
+            std::string column;
+            while (std::getline(columnStream, column, ',')) {
+                dimensionColumns.push_back(column);
+            }
+            
+            std::string whereClause = " WHERE 1 = 1 ";
+            std::vector<std::string> params;
+            
+            // 按第一个维度列的值过滤，如只查询某个媒体来源，使用维度列在前的组合索引
+            if (req.url_params.get("value") != nullptr) {
+                whereClause += " AND " + dimensionColumns[0] + " = ? ";
+                params.push_back(req.url_params.get("value"));
+            }
+            
+            // 检查是否有日期参数
+            if (req.url_params.get("date") != nullptr) {
+                std::string dateParam = req.url_params.get("date");
+                
+                // 检查是否是日期范围查询（格式：startDate|endDate）
+                size_t separatorPos = dateParam.find('|');
+                if (separatorPos != std::string::npos) {
+                    whereClause += " AND stat_date BETWEEN ? AND ? ";
+                    params.push_back(dateParam.substr(0, separatorPos));
+                    params.push_back(dateParam.substr(separatorPos + 1));
+                } else {
+                    whereClause += " AND stat_date = ? ";
+                    params.push_back(dateParam);
+                }
+            }
+            
+            std::string columns = "stat_date";
+            for (const auto& dimensionColumn : dimensionColumns) {
+                columns += ", " + dimensionColumn;
+            }
+            auto result = dbManager->executeQuery(
+                "SELECT " + columns + ", user_count, new_user_count, event_count, purchase_count, revenue_usd "
+                "FROM " + table +
+                whereClause +
+                "ORDER BY stat_date, revenue_usd DESC",
+                params
+            );
+            
+            // 创建数据数组
+            json dataArray = json::array();
+            for (const auto& row : result) {
+                json item;
+                item["date"] = row.at("stat_date");
+                for (const auto& dimensionColumn : dimensionColumns) {
+                    item[dimensionColumn] = row.at(dimensionColumn);
+                }
+                item["user_count"] = std::stoi(row.at("user_count"));
+                item["new_user_count"] = std::stoi(row.at("new_user_count"));
+                item["event_count"] = std::stoi(row.at("event_count"));
+                item["purchase_count"] = std::stoi(row.at("purchase_count"));
+                item["revenue"] = std::stod(row.at("revenue_usd"));
+                dataArray.push_back(item);
+            }
+            
+            // 创建包含元数据的响应
+            json responseData;
+            responseData["dimension"] = dimensionColumns;
+            responseData["items"] = dataArray;
+            responseData["total"] = dataArray.size();
+            
+            // 使用统一的响应格式
+            crow::response res;
+            res.body = createSuccessResponse(responseData, "维度统计数据获取成功").dump();
+            res.set_header("Content-Type", "application/json");
+            // 添加CORS头
+            addCorsHeaders(res);
+            return res;
+        } catch (const std::exception& e) {
+            crow::response res;
+            res.code = 500;
+            res.body = createErrorResponse(500, e.what()).dump();
+            res.set_header("Content-Type", "application/json");
+            // 添加CORS头
+            addCorsHeaders(res);
+            return res;
+        }
+    });
+}
+
 void ApiServer::registerDetailsApi() {
     app.route_dynamic("/api/details")
     ([this](const crow::request& req) {
@@ -403,7 +618,21 @@ void ApiServer::registerDetailsApi() {
             
             std::string date = req.url_params.get("date");
             
-            // 查询指定日期的详细数据
+            // 优先读取ETL预先生成的日期详情，按主键查找一行后原样返回
+            auto detailsResult = dbManager->executeQuery(
+                "SELECT details_json FROM daily_details WHERE stat_date = ?",
+                {date}
+            );
+            if (!detailsResult.empty()) {
+                crow::response res;
+                res.body = createSuccessResponseBody(detailsResult[0]["details_json"], "日期详情数据获取成功");
+                res.set_header("Content-Type", "application/json");
+                // 添加CORS头
+                addCorsHeaders(res);
+                return res;
+            }
+            
+            // 没有预先生成的详情（该日期没有事件，或统计数据尚未生成）时实时查询
             auto userCountryResult = dbManager->executeQuery(
                 "SELECT country_code, COUNT(DISTINCT appsflyer_id) as user_count "
                 "FROM events "
@@ -507,47 +736,58 @@ void ApiServer::registerLtvApi() {
             std::string window = req.url_params.get("window") != nullptr ? 
                 req.url_params.get("window") : "total";
             
-            // 根据分组参数修改查询
+            // 窗口名称须在ltv_windows中登记，total对应同期群汇总中window_days为0的行
+            std::string windowDays = "0";
+            if (window != "total") {
+                auto windowResult = dbManager->executeQuery(
+                    "SELECT window_days FROM ltv_windows WHERE window_name = ?", {window}
+                );
+                if (windowResult.empty()) {
+                    crow::response res;
+                    res.code = 400;
+                    res.body = createErrorResponse(400, "未登记的LTV窗口: " + window).dump();
+                    res.set_header("Content-Type", "application/json");
+                    addCorsHeaders(res);
+                    return res;
+                }
+                windowDays = windowResult[0].at("window_days");
+            }
+            
+            // 分组查询读取预先汇总的LTV同期群(首次购买日期×国家×设备)
             std::string groupByClause = "";
             if (groupBy == "country") {
                 // 按国家分组
                 baseQuery = 
-                    "SELECT e.country_code as country, "
-                    "COUNT(DISTINCT u.appsflyer_id) as user_count, "
-                    "SUM(u." + (window == "total" ? "ltv_total" : "ltv_" + window) + ") as ltv_value ";
-                fromClause = 
-                    "FROM user_ltv u "
-                    "JOIN users e ON u.appsflyer_id = e.appsflyer_id ";
-                
-                // 添加分组子句
-                whereClause += (whereClause.empty() ? " WHERE " : " AND ");
-                whereClause += "e.country_code IS NOT NULL ";
-                groupByClause = " GROUP BY e.country_code ORDER BY ltv_value DESC";
+                    "SELECT country_code as country, "
+                    "SUM(user_count) as user_count, "
+                    "SUM(total_ltv) as ltv_value ";
+                fromClause = "FROM ltv_cohort_stats ";
+                whereClause = " WHERE window_days = ? AND country_code IS NOT NULL ";
+                params.push_back(windowDays);
+                groupByClause = " GROUP BY country_code ORDER BY ltv_value DESC";
             } 
             else if (groupBy == "device") {
                 // 按设备分组
                 baseQuery = 
-                    "SELECT e.device_category as device, "
-                    "COUNT(DISTINCT u.appsflyer_id) as user_count, "
-                    "SUM(u." + (window == "total" ? "ltv_total" : "ltv_" + window) + ") as ltv_value ";
-                fromClause = 
-                    "FROM user_ltv u "
-                    "JOIN users e ON u.appsflyer_id = e.appsflyer_id ";
-                
-                // 添加分组子句
-                whereClause += (whereClause.empty() ? " WHERE " : " AND ");
-                whereClause += "e.device_category IS NOT NULL ";
-                groupByClause = " GROUP BY e.device_category ORDER BY ltv_value DESC";
+                    "SELECT device_category as device, "
+                    "SUM(user_count) as user_count, "
+                    "SUM(total_ltv) as ltv_value ";
+                fromClause = "FROM ltv_cohort_stats ";
+                whereClause = " WHERE window_days = ? AND device_category IS NOT NULL ";
+                params.push_back(windowDays);
+                groupByClause = " GROUP BY device_category ORDER BY ltv_value DESC";
             }
             else if (groupBy == "date") {
                 // 按首次购买日期分组
                 baseQuery = 
-                    "SELECT u.first_purchase_date as date, "
-                    "COUNT(DISTINCT u.appsflyer_id) as user_count, "
-                    "AVG(u." + (window == "total" ? "ltv_total" : "ltv_" + window) + ") as avg_ltv, "
-                    "SUM(u." + (window == "total" ? "ltv_total" : "ltv_" + window) + ") as total_ltv ";
-                fromClause = "FROM user_ltv u ";
-                groupByClause = " GROUP BY u.first_purchase_date ORDER BY u.first_purchase_date DESC";
+                    "SELECT first_purchase_date as date, "
+                    "SUM(user_count) as user_count, "
+                    "SUM(total_ltv) / SUM(user_count) as avg_ltv, "
+                    "SUM(total_ltv) as total_ltv ";
+                fromClause = "FROM ltv_cohort_stats ";
+                whereClause = " WHERE window_days = ? ";
+                params.push_back(windowDays);
+                groupByClause = " GROUP BY first_purchase_date ORDER BY first_purchase_date DESC";
             }
             
             // 构建完整的SQL查询
@@ -684,24 +924,18 @@ void ApiServer::registerLtvApi() {
     app.route_dynamic("/api/ltv/overview")
     ([this](const crow::request& req) {
         try {
-            // 获取LTV统计信息
+            // 总LTV取自同期群汇总中window_days为0的行
             auto result = dbManager->executeQuery(
                 "SELECT "
-                "AVG(ltv_1d) as avg_ltv_1d, "
-                "AVG(ltv_7d) as avg_ltv_7d, "
-                "AVG(ltv_14d) as avg_ltv_14d, "
-                "AVG(ltv_30d) as avg_ltv_30d, "
-                "AVG(ltv_60d) as avg_ltv_60d, "
-                "AVG(ltv_90d) as avg_ltv_90d, "
-                "AVG(ltv_total) as avg_ltv_total, "
-                "SUM(ltv_total) as total_ltv, "
-                "COUNT(*) as user_count, "
-                "AVG(purchase_count) as avg_purchases "
-                "FROM user_ltv",
+                "SUM(total_ltv) as total_ltv, "
+                "SUM(user_count) as user_count, "
+                "SUM(purchase_count) as purchase_count "
+                "FROM ltv_cohort_stats "
+                "WHERE window_days = 0",
                 {}
             );
             
-            if (result.empty()) {
+            if (result.empty() || result[0].at("user_count").empty()) {
                 throw std::runtime_error("No LTV data available");
             }
             
@@ -709,16 +943,33 @@ void ApiServer::registerLtvApi() {
             json overview;
             const auto& row = result[0];
             
-            overview["avg_ltv_1d"] = std::stod(row.at("avg_ltv_1d"));
-            overview["avg_ltv_7d"] = std::stod(row.at("avg_ltv_7d"));
-            overview["avg_ltv_14d"] = std::stod(row.at("avg_ltv_14d"));
-            overview["avg_ltv_30d"] = std::stod(row.at("avg_ltv_30d"));
-            overview["avg_ltv_60d"] = std::stod(row.at("avg_ltv_60d"));
-            overview["avg_ltv_90d"] = std::stod(row.at("avg_ltv_90d"));
-            overview["avg_ltv_total"] = std::stod(row.at("avg_ltv_total"));
-            overview["total_ltv"] = std::stod(row.at("total_ltv"));
-            overview["user_count"] = std::stoi(row.at("user_count"));
-            overview["avg_purchases"] = std::stod(row.at("avg_purchases"));
+            double totalLtv = std::stod(row.at("total_ltv"));
+            int userCount = std::stoi(row.at("user_count"));
+            overview["avg_ltv_total"] = totalLtv / userCount;
+            overview["total_ltv"] = totalLtv;
+            overview["user_count"] = userCount;
+            overview["avg_purchases"] = std::stod(row.at("purchase_count")) / userCount;
+            
+            // 登记窗口的预汇总结果，每个窗口同时以avg_ltv_<窗口名称>返回
+            auto windowResult = dbManager->executeQuery(
+                "SELECT w.window_name, w.window_days, s.user_count, s.total_ltv, s.avg_ltv "
+                "FROM ltv_windows w "
+                "JOIN ltv_window_stats s ON w.window_days = s.window_days "
+                "ORDER BY w.window_days",
+                {}
+            );
+            json windows = json::array();
+            for (const auto& windowRow : windowResult) {
+                json item;
+                item["window"] = windowRow.at("window_name");
+                item["days"] = std::stoi(windowRow.at("window_days"));
+                item["user_count"] = std::stoi(windowRow.at("user_count"));
+                item["total_ltv"] = std::stod(windowRow.at("total_ltv"));
+                item["avg_ltv"] = std::stod(windowRow.at("avg_ltv"));
+                overview["avg_ltv_" + windowRow.at("window_name")] = item["avg_ltv"];
+                windows.push_back(item);
+            }
+            overview["windows"] = windows;
             
             // 使用统一的响应格式
             crow::response res;
@@ -1,9 +1,17 @@
 #include "DatabaseManager.h"
 #include <iostream>
 #include <stdexcept>
+#include <mutex>
 
 DatabaseManager::DatabaseManager(const std::string& dbPath) 
-    : db(nullptr), connected(false) {
+    : dbPath(dbPath), db(nullptr), connected(false), dbDevice(0), dbInode(0) {
+    
+    // 先记录文件标识再打开，打开期间文件被替换时下次查询会重新打开
+    struct stat fileStat;
+    if (stat(dbPath.c_str(), &fileStat) == 0) {
+        dbDevice = fileStat.st_dev;
+        dbInode = fileStat.st_ino;
+    }
     
     int rc = sqlite3_open(dbPath.c_str(), &db);
     if (rc != SQLITE_OK) {
@@ -28,6 +36,8 @@ DatabaseManager::ResultSet DatabaseManager::executeQuery(
     const std::vector<std::string>& params) {
     
     ResultSet resultSet;
+    reopenIfReplaced();
+    std::shared_lock<std::shared_mutex> lock(dbMutex);
     if (!connected) {
         throw std::runtime_error("Database is not connected");
     }
@@ -74,6 +84,8 @@ int DatabaseManager::executeUpdate(
     const std::string& sql, 
     const std::vector<std::string>& params) {
     
+    reopenIfReplaced();
+    std::shared_lock<std::shared_mutex> lock(dbMutex);
     if (!connected) {
         throw std::runtime_error("Database is not connected");
     }
@@ -106,6 +118,45 @@ bool DatabaseManager::isConnected() const {
     return connected;
 }
 
+void DatabaseManager::reopenIfReplaced() {
+    struct stat fileStat;
+    if (stat(dbPath.c_str(), &fileStat) != 0) {
+        // 文件暂时不存在时继续使用当前连接
+        return;
+    }
+    
+    {
+        std::shared_lock<std::shared_mutex> lock(dbMutex);
+        if (connected && fileStat.st_dev == dbDevice && fileStat.st_ino == dbInode) {
+            return;
+        }
+    }
+    
+    std::unique_lock<std::shared_mutex> lock(dbMutex);
+    // 其他线程可能已经重新打开
+    if (connected && fileStat.st_dev == dbDevice && fileStat.st_ino == dbInode) {
+        return;
+    }
+    
+    sqlite3* newDb = nullptr;
+    int rc = sqlite3_open(dbPath.c_str(), &newDb);
+    if (rc != SQLITE_OK) {
+        std::cerr << "Cannot reopen database: " << sqlite3_errmsg(newDb) << std::endl;
+        sqlite3_close(newDb);
+        return;
+    }
+    
+    // 旧连接上的查询都已结束（持有共享锁），可以安全关闭
+    if (db) {
+        sqlite3_close(db);
+    }
+    db = newDb;
+    dbDevice = fileStat.st_dev;
+    dbInode = fileStat.st_ino;
+    connected = true;
+    std::cout << "Database file replaced, reopened: " << dbPath << std::endl;
+}
+
 void DatabaseManager::bindParameters(
     sqlite3_stmt* stmt, 
     const std::vector<std::string>& params) {
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+性能基准测试脚本
+生成合成数据，对比数据处理各环节优化前后的吞吐量
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import logging
+import argparse
+import tempfile
+from collections import defaultdict
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+# 确保当前目录在导入路径中
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_processing.create_database import (
+    CREATE_TABLES_SQL, CURRENCY_RATES, INITIAL_RATES_EFFECTIVE_DATE, create_database, finish_bulk_load
+)
+from data_processing.process_data import (
+    CHUNK_SIZE, CSV_DTYPES, DATE_FORMAT, INSERT_EVENTS_SQL, PENDING_CHUNKS_PER_WORKER,
+    ensure_str_or_none, iter_event_rows, iter_transformed_chunks, preprocess_chunk, process_csv_data,
+    read_csv_chunks
+)
+from data_processing.calculate_ltv import (
+    LTV_WINDOWS, REGISTERED_DIMENSION_COLUMNS, STATS_TABLES, SUMMARY_DIMENSION_COLUMNS, UNKNOWN_DIMENSION_VALUE,
+    build_user_ltv, calculate_ltv, generate_daily_stats
+)
+
+# 配置日志
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# 默认合成数据行数
+DEFAULT_ROWS = 1000000
+
+# LTV测试默认的合成购买记录数
+DEFAULT_LTV_PURCHASES = 10000000
+
+# LTV测试中平均每个用户的购买次数和购买日期范围
+LTV_PURCHASES_PER_USER = 4
+LTV_DATE_RANGE_DAYS = 180
+
+# 合成数据使用的取值
+DEVICE_MODELS = [
+    'samsung::SM-A217F', 'Apple::iPhone12', 'Apple::iPad7,5', 'xiaomi::Redmi Note 9',
+    'huawei::MatePad', 'google::Pixel 6', 'oppo::CPH2127', 'Mobile-9'
+]
+COUNTRY_CODES = ['US', 'JP', 'KR', 'DE', 'GB', 'BR', 'IN', 'TW']
+CURRENCIES = ['USD', 'EUR', 'JPY', 'KRW', 'GBP']
+EVENT_NAMES = ['af_purchase', 'af_login', 'af_level_achieved', 'af_ad_view']
+PRODUCT_IDS = ['coins100', 'valuebundle', 'gems500', '1100coins']
+
+def generate_synthetic_csv(path, rows, seed=42):
+    """生成与AppsFlyer导出格式一致的合成CSV文件"""
+    rng = np.random.default_rng(seed)
+    user_count = max(rows // 20, 1)
+
+    base = np.datetime64('2025-01-01T00:00:00')
+    install_offsets = rng.integers(0, 60 * 86400, user_count)
+    user_ids = rng.integers(0, user_count, rows)
+    event_offsets = install_offsets[user_ids] + rng.integers(0, 30 * 86400, rows)
+    millis = rng.integers(0, 1000, rows).astype(str)
+
+    event_names = rng.choice(EVENT_NAMES, rows, p=[0.2, 0.4, 0.3, 0.1])
+    is_purchase = event_names == 'af_purchase'
+    revenue = np.where(is_purchase, np.round(rng.uniform(0.99, 99.99, rows), 2), np.nan)
+    currency = rng.choice(CURRENCIES, rows)
+    revenue_usd = np.where(currency == 'USD', revenue, np.nan)
+    products = rng.choice(PRODUCT_IDS, rows)
+    event_value = np.where(
+        is_purchase,
+        pd.Series(products).map(lambda p: f'{{"af_content_id":"{p}","af_revenue":1}}').to_numpy(),
+        ''
+    )
+
+    df = pd.DataFrame({
+        'appsflyer_id': pd.Series(user_ids).map(lambda u: f'{1737000000000 + u}-{u * 7919}'),
+        'app_id': '2732',
+        'event_time': pd.Series(base + event_offsets.astype('timedelta64[s]')).dt.strftime('%Y-%m-%d %H:%M:%S') + '.' + millis,
+        'install_time': pd.Series(base + install_offsets[user_ids].astype('timedelta64[s]')).dt.strftime('%Y-%m-%d %H:%M:%S.000'),
+        'country_code': np.array(COUNTRY_CODES)[user_ids % len(COUNTRY_CODES)],
+        'device_model': np.array(DEVICE_MODELS)[user_ids % len(DEVICE_MODELS)],
+        'platform': np.where(user_ids % 3 == 0, 'ios', 'android'),
+        'media_source': np.where(user_ids % 4 == 0, 'Facebook Ads', 'organic'),
+        'event_revenue': revenue,
+        'event_revenue_currency': currency,
+        'event_revenue_usd': revenue_usd,
+        'event_name': event_names,
+        'event_value': event_value,
+        'params': '{}',
+    })
+    df.to_csv(path, index=False)
+    return path
+
+def legacy_build_event_rows(df):
+    """原逐行(iterrows)生成事件记录的实现，作为对比基准"""
+    events_data = []
+
+    for _, row in df.iterrows():
+        appsflyer_id = row['appsflyer_id']
+        if pd.isna(appsflyer_id) or not appsflyer_id:
+            continue
+
+        events_data.append((
+            str(appsflyer_id),
+            str(row['event_name']) if not pd.isna(row['event_name']) else 'unknown_event',
+            str(row.get('event_value', '')) if row.get('event_value') and not pd.isna(row.get('event_value')) else None,
+            ensure_str_or_none(row['created_date'], DATE_FORMAT),
+            ensure_str_or_none(row['event_time']),
+            str(row['country_code']) if not pd.isna(row['country_code']) else None,
+            str(row['device_model']) if not pd.isna(row['device_model']) else None,
+            str(row['device_category']) if not pd.isna(row['device_category']) else None,
+            str(row.get('app_id', '')) if row.get('app_id') and not pd.isna(row.get('app_id')) else None,
+            str(row.get('platform', '')) if row.get('platform') and not pd.isna(row.get('platform')) else None,
+            str(row.get('media_source', '')) if row.get('media_source') and not pd.isna(row.get('media_source')) else None,
+            float(row.get('event_revenue', 0.0)) if row.get('event_revenue') and not pd.isna(row.get('event_revenue')) else 0.0,
+            str(row['event_revenue_currency']) if not pd.isna(row['event_revenue_currency']) else 'USD',
+            float(row['event_revenue_usd']) if not pd.isna(row['event_revenue_usd']) else 0.0,
+            str(row['event_params']) if not pd.isna(row['event_params']) else None,
+            ensure_str_or_none(row['install_time'])
+        ))
+
+    return events_data
+
+def legacy_build_user_ltv(purchase_rows):
+    """优化前的逐条购买计算LTV，用于对比"""
+    user_first_purchase = {}
+    user_purchases = defaultdict(list)
+    
+    for appsflyer_id, created_date, revenue in purchase_rows:
+        user_first_purchase.setdefault(appsflyer_id, created_date)
+        user_purchases[appsflyer_id].append((datetime.strptime(created_date, '%Y-%m-%d').date(), revenue))
+    
+    ltv_data = []
+    for appsflyer_id, purchases in user_purchases.items():
+        first_purchase_date = purchases[0][0]
+        window_sums = [0.0] * len(LTV_WINDOWS)
+        ltv_total = 0.0
+        for purchase_date, revenue in purchases:
+            days_diff = (purchase_date - first_purchase_date).days
+            ltv_total += revenue
+            for i, (_, days) in enumerate(LTV_WINDOWS):
+                if days_diff <= days - 1:
+                    window_sums[i] += revenue
+        ltv_data.append((
+            appsflyer_id, user_first_purchase[appsflyer_id], *window_sums,
+            ltv_total, len(purchases), str(purchases[-1][0])
+        ))
+    return ltv_data
+
+def generate_synthetic_purchases(rows, seed=42):
+    """生成按(用户, 日期)排序的合成购买记录，返回(用户ID, 购买日期, USD金额)三个数组"""
+    rng = np.random.default_rng(seed)
+    user_count = max(rows // LTV_PURCHASES_PER_USER, 1)
+    user_codes = rng.integers(0, user_count, rows)
+    day_numbers = rng.integers(0, LTV_DATE_RANGE_DAYS, rows)
+    order = np.lexsort((day_numbers, user_codes))
+    
+    # 用户ID和日期字符串只生成不重复的值，按编号引用
+    user_ids = np.array([f"user{code:09d}" for code in range(user_count)], dtype=object)
+    dates = pd.date_range('2025-01-01', periods=LTV_DATE_RANGE_DAYS).strftime('%Y-%m-%d').to_numpy(dtype=object)
+    revenues = np.round(rng.gamma(1.5, 6.0, rows), 2)
+    return user_ids[user_codes[order]], dates[day_numbers[order]], revenues[order]
+
+def benchmark_ltv(rows):
+    """对比逐条购买与按用户分段求和计算LTV的吞吐量，并检查结果精确到分"""
+    (appsflyer_ids, created_dates, revenues), _ = timed(
+        "生成合成购买记录", lambda: generate_synthetic_purchases(rows), rows
+    )
+    
+    vectorized, vectorized_elapsed = timed(
+        "分段求和计算LTV", lambda: build_user_ltv(appsflyer_ids, created_dates, revenues)[0], rows
+    )
+    legacy, legacy_elapsed = timed(
+        "逐条购买计算LTV", lambda: legacy_build_user_ltv(zip(appsflyer_ids, created_dates, revenues.tolist())), rows
+    )
+    
+    if len(legacy) != len(vectorized):
+        raise AssertionError("分段求和计算的用户数与逐条计算不一致")
+    legacy.sort()
+    vectorized.sort()
+    amount_columns = slice(2, 3 + len(LTV_WINDOWS))
+    max_diff = 0.0
+    for legacy_row, vectorized_row in zip(legacy, vectorized):
+        if legacy_row[:2] != vectorized_row[:2] or legacy_row[-2:] != vectorized_row[-2:]:
+            raise AssertionError(f"分段求和计算的LTV与逐条计算不一致: {legacy_row} / {vectorized_row}")
+        diffs = np.abs(np.subtract(legacy_row[amount_columns], vectorized_row[amount_columns]))
+        max_diff = max(max_diff, diffs.max())
+    if max_diff >= 0.005:
+        raise AssertionError(f"分段求和计算的LTV与逐条计算相差 {max_diff}")
+    
+    logger.info(f"LTV计算加速比: {legacy_elapsed / vectorized_elapsed:.1f}x（{len(vectorized)} 个用户，最大误差 {max_diff:.2e}）")
+
+def timed(label, func, rows):
+    """执行函数并记录耗时和每秒处理行数"""
+    start_time = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start_time
+    logger.info(f"{label}: {elapsed:.2f} 秒, {rows / elapsed:,.0f} 行/秒")
+    return result, elapsed
+
+def synthetic_rates():
+    """合成数据使用的汇率表"""
+    rates = pd.DataFrame(CURRENCY_RATES, columns=['currency_code', 'rate_to_usd'])
+    rates['effective_date'] = pd.Timestamp(INITIAL_RATES_EFFECTIVE_DATE)
+    return rates
+
+def load_synthetic_frame(workdir, rows):
+    """生成合成CSV并完成预处理，返回可直接写入的数据块"""
+    csv_file = os.path.join(workdir, 'synthetic.csv')
+    timed("生成合成CSV", lambda: generate_synthetic_csv(csv_file, rows), rows)
+    df, _ = timed("读取CSV", lambda: pd.read_csv(csv_file, dtype=CSV_DTYPES), rows)
+    df, _ = timed("预处理", lambda: preprocess_chunk(df, synthetic_rates()), rows)
+    return df
+
+def benchmark_event_rows(rows):
+    """对比逐行与按列生成事件记录并写入SQLite的吞吐量"""
+    with tempfile.TemporaryDirectory() as workdir:
+        df = load_synthetic_frame(workdir, rows)
+
+    legacy_rows, legacy_build = timed("逐行生成记录(iterrows)", lambda: legacy_build_event_rows(df), rows)
+    columnar_rows, columnar_build = timed("按列生成记录", lambda: list(iter_event_rows(df)), rows)
+    if legacy_rows != columnar_rows:
+        raise AssertionError("按列生成的事件记录与逐行实现不一致")
+    del legacy_rows, columnar_rows
+
+    def insert(rows_source):
+        conn = sqlite3.connect(':memory:')
+        conn.executescript(CREATE_TABLES_SQL)
+        conn.executemany(INSERT_EVENTS_SQL, rows_source())
+        conn.commit()
+        conn.close()
+
+    _, legacy_total = timed("逐行生成并写入", lambda: insert(lambda: legacy_build_event_rows(df)), rows)
+    _, columnar_total = timed("按列生成并写入(生成器)", lambda: insert(lambda: iter_event_rows(df)), rows)
+
+    logger.info(f"生成记录加速比: {legacy_build / columnar_build:.1f}x")
+    logger.info(f"生成并写入加速比: {legacy_total / columnar_total:.1f}x")
+
+def benchmark_transform(rows, workers=None):
+    """对比串行与多进程并行清洗数据块的吞吐量，并检查两者输出一致"""
+    workers = workers or os.cpu_count()
+    rates = synthetic_rates()
+    
+    def transform(executor):
+        results = []
+        with open(csv_file, 'rb') as f:
+            chunks = read_csv_chunks(f, CHUNK_SIZE)
+            transformed = iter_transformed_chunks(chunks, rates, {}, executor, workers * PENDING_CHUNKS_PER_WORKER)
+            for row_count, event_rows, user_state, purchases_data, _, _ in transformed:
+                results.append((row_count, list(event_rows), user_state, purchases_data))
+        return results
+    
+    with tempfile.TemporaryDirectory() as workdir:
+        csv_file = os.path.join(workdir, 'synthetic.csv')
+        timed("生成合成CSV", lambda: generate_synthetic_csv(csv_file, rows), rows)
+        
+        serial_results, serial_elapsed = timed("串行清洗", lambda: transform(None), rows)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parallel_results, parallel_elapsed = timed(f"{workers} 个进程并行清洗", lambda: transform(executor), rows)
+    
+    for serial, parallel in zip(serial_results, parallel_results):
+        if serial[0] != parallel[0] or serial[1] != parallel[1] or serial[3] != parallel[3] or not serial[2].equals(parallel[2]):
+            raise AssertionError("并行清洗的结果与串行处理不一致")
+    if len(serial_results) != len(parallel_results):
+        raise AssertionError("并行清洗的数据块数与串行处理不一致")
+    
+    logger.info(f"清洗加速比: {serial_elapsed / parallel_elapsed:.1f}x（{workers} 个进程）")
+
+def database_snapshot(db_file):
+    """读取数据库中所有表的内容和索引名称，用于比较两次导入的结果"""
+    conn = sqlite3.connect(db_file)
+    try:
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        )]
+        snapshot = {
+            table: conn.execute(f"SELECT * FROM {table} ORDER BY 1, 2").fetchall()
+            for table in tables if table != 'currency_rates'
+        }
+        snapshot['indexes'] = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        ).fetchall()
+        # etl_state和ingest_log中记录了导入时间
+        snapshot['etl_state'] = [row[:2] for row in snapshot['etl_state']]
+        snapshot['ingest_log'] = [row[:4] for row in snapshot['ingest_log']]
+    finally:
+        conn.close()
+    return snapshot
+
+def benchmark_bulk_load(rows):
+    """对比默认设置与批量导入模式下完整导入流程的耗时"""
+    def load(db_file, bulk_load):
+        label = "批量导入" if bulk_load else "默认设置"
+        timed(f"{label} - 创建表", lambda: create_database(db_file, with_indexes=not bulk_load), rows)
+        timed(f"{label} - 导入CSV", lambda: process_csv_data(
+            csv_files=[csv_file], chunksize=CHUNK_SIZE, db_file=db_file, bulk_load=bulk_load
+        ), rows)
+        timed(f"{label} - 计算LTV", lambda: calculate_ltv(db_file=db_file, bulk_load=bulk_load), rows)
+        timed(f"{label} - 生成统计", lambda: generate_daily_stats(db_file=db_file, bulk_load=bulk_load), rows)
+        if bulk_load:
+            timed(f"{label} - 创建索引和ANALYZE", lambda: finish_bulk_load(db_file), rows)
+    
+    with tempfile.TemporaryDirectory() as workdir:
+        csv_file = os.path.join(workdir, 'synthetic.csv')
+        timed("生成合成CSV", lambda: generate_synthetic_csv(csv_file, rows), rows)
+        
+        default_db = os.path.join(workdir, 'default.db')
+        bulk_db = os.path.join(workdir, 'bulk.db')
+        _, default_elapsed = timed("默认设置导入", lambda: load(default_db, False), rows)
+        _, bulk_elapsed = timed("批量导入模式", lambda: load(bulk_db, True), rows)
+        
+        if database_snapshot(default_db) != database_snapshot(bulk_db):
+            raise AssertionError("批量导入模式的结果与默认设置不一致")
+        journal_mode = sqlite3.connect(bulk_db).execute("PRAGMA journal_mode").fetchone()[0]
+    
+    logger.info(f"批量导入加速比: {default_elapsed / bulk_elapsed:.1f}x（导入后journal_mode={journal_mode}）")
+
+# 原按统计表分别扫描事件表时各分组列和指标列对应的表达式
+LEGACY_STATS_KEY_EXPRESSIONS = {
+    'stat_date': 'e.created_date',
+    'stat_hour': 'CAST(substr(e.event_time, 12, 2) AS INTEGER)',
+}
+LEGACY_STATS_MEASURE_EXPRESSIONS = {
+    'user_count': "COUNT(DISTINCT e.appsflyer_id)",
+    'new_user_count': "COUNT(DISTINCT CASE WHEN u.first_seen_date = e.created_date THEN u.appsflyer_id END)",
+    'event_count': "COUNT(*)",
+    'purchase_count': "COUNT(CASE WHEN e.event_name = 'af_purchase' THEN 1 END)",
+    'revenue_usd': "SUM(CASE WHEN e.event_name = 'af_purchase' THEN e.event_revenue_usd ELSE 0 END)",
+    'device_count': "COUNT(DISTINCT e.device_category)",
+    'country_count': "COUNT(DISTINCT e.country_code)",
+}
+
+def legacy_stats_sql(keys, columns):
+    """原每张统计表各扫描一次事件表的统计语句，作为对比基准"""
+    def key_expression(key):
+        if key in LEGACY_STATS_KEY_EXPRESSIONS:
+            return LEGACY_STATS_KEY_EXPRESSIONS[key]
+        if key in REGISTERED_DIMENSION_COLUMNS and key not in SUMMARY_DIMENSION_COLUMNS:
+            return f"COALESCE(e.{key}, '{UNKNOWN_DIMENSION_VALUE}')"
+        return f"e.{key}"
+    key_expressions = ', '.join(key_expression(key) for key in keys)
+    aggregates = ', '.join(LEGACY_STATS_MEASURE_EXPRESSIONS[column] for column in columns)
+    join = "LEFT JOIN users u ON e.appsflyer_id = u.appsflyer_id" if 'new_user_count' in columns else ""
+    return f"""
+    SELECT {key_expressions}, {aggregates}
+    FROM events e {join}
+    GROUP BY {key_expressions}
+    ORDER BY {key_expressions}
+    """
+
+def rounded_rows(rows):
+    """将浮点数保留6位小数，忽略求和顺序造成的误差"""
+    return [tuple(round(value, 6) if isinstance(value, float) else value for value in row) for row in rows]
+
+def benchmark_stats(rows):
+    """对比每张统计表各扫描一次事件表与单次扫描生成所有统计表的耗时，并检查结果一致"""
+    with tempfile.TemporaryDirectory() as workdir:
+        csv_file = os.path.join(workdir, 'synthetic.csv')
+        db_file = os.path.join(workdir, 'stats.db')
+        timed("生成合成CSV", lambda: generate_synthetic_csv(csv_file, rows), rows)
+        create_database(db_file)
+        timed("导入CSV", lambda: process_csv_data(csv_files=[csv_file], chunksize=CHUNK_SIZE, db_file=db_file), rows)
+        
+        conn = sqlite3.connect(db_file)
+        try:
+            def legacy_stats():
+                return {
+                    table: conn.execute(legacy_stats_sql(keys, columns)).fetchall()
+                    for table, keys, columns in STATS_TABLES
+                }
+            legacy, legacy_elapsed = timed(f"逐表扫描（{len(STATS_TABLES)}次）", legacy_stats, rows)
+            _, single_elapsed = timed("单次扫描", lambda: generate_daily_stats(db_file=db_file), rows)
+            for table, keys, _ in STATS_TABLES:
+                current = conn.execute(f"SELECT * FROM {table} ORDER BY {', '.join(keys)}").fetchall()
+                if rounded_rows(current) != rounded_rows(legacy[table]):
+                    raise AssertionError(f"单次扫描生成的{table}与逐表扫描不一致")
+        finally:
+            conn.close()
+    
+    logger.info(f"单次扫描加速比: {legacy_elapsed / single_elapsed:.1f}x（单次扫描另生成用户位图）")
+
+BENCHMARKS = {
+    'event-rows': benchmark_event_rows,
+    'transform': benchmark_transform,
+    'bulk-load': benchmark_bulk_load,
+    'ltv': benchmark_ltv,
+    'stats': benchmark_stats,
+}
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="数据处理性能基准测试")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS), help="要运行的基准测试")
+    parser.add_argument(
+        "--rows", type=int, default=None,
+        help=f"合成数据行数（默认{DEFAULT_ROWS}，ltv测试默认{DEFAULT_LTV_PURCHASES}条购买记录）"
+    )
+    parser.add_argument("--workers", type=int, default=None, help="transform测试的工作进程数（默认为CPU核数）")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.rows is None:
+        args.rows = DEFAULT_LTV_PURCHASES if args.benchmark == 'ltv' else DEFAULT_ROWS
+    if args.benchmark == 'transform':
+        benchmark_transform(args.rows, args.workers)
+    else:
+        BENCHMARKS[args.benchmark](args.rows)
@@ -7,10 +7,24 @@ LTV计算脚本
 """
 
 import os
+import sys
+import json
 import sqlite3
+import argparse
 import logging
-from datetime import datetime, timedelta
-from collections import defaultdict
+import numpy as np
+import pandas as pd
+
+# 确保当前目录在导入路径中
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_processing.create_database import (
+    DIMENSION_STATS, DIMENSION_STATS_MEASURES, UNKNOWN_DIMENSION_VALUE, begin_stage, commit_stage, connect_database,
+    NORMALIZED_COLUMNS, create_index, dictionary_table, dimension_stats_table, get_etl_state, is_normalized,
+    rollback_stage, set_etl_state, storage_table
+)
+from data_processing.staging import read_staging, read_staging_batches
+from data_processing.user_bitmaps import INSERT_USER_BITMAP_SQL, build_user_bitmap_rows
 
 # 配置日志
 logging.basicConfig(
@@ -26,137 +40,317 @@ ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DB_DIR = os.path.join(ROOT_DIR, 'database')
 DB_FILE = os.path.join(DB_DIR, 'app.db')
 
-def calculate_ltv():
-    """计算用户LTV并更新数据库"""
+# etl_state中记录LTV已处理到的最大购买ID的键
+LTV_WATERMARK_KEY = 'ltv_purchase_id'
+
+# user_ltv表中固定的LTV窗口列(列名, 天数)，天数为N时累加首次购买日起N天内（含首次购买当天）的购买；
+# 其他窗口在ltv_windows表中登记，结果写入user_ltv_window
+LTV_WINDOWS = [
+    ('ltv_1d', 1),
+    ('ltv_7d', 7),
+    ('ltv_14d', 14),
+    ('ltv_30d', 30),
+    ('ltv_60d', 60),
+    ('ltv_90d', 90),
+]
+
+# user_ltv表的列，顺序与compute_user_ltv返回的记录一致
+USER_LTV_COLUMNS = (
+    ['appsflyer_id', 'first_purchase_date'] + [name for name, _ in LTV_WINDOWS]
+    + ['ltv_total', 'purchase_count', 'last_purchase_date']
+)
+
+# 写入用户LTV的语句，已存在的用户整行替换
+UPSERT_USER_LTV_SQL = f"""
+INSERT OR REPLACE INTO user_ltv ({', '.join(USER_LTV_COLUMNS)})
+VALUES ({', '.join('?' * len(USER_LTV_COLUMNS))})
+"""
+
+# 写入用户各窗口LTV的语句
+UPSERT_USER_LTV_WINDOW_SQL = """
+INSERT OR REPLACE INTO user_ltv_window (window_days, appsflyer_id, ltv) VALUES (?, ?, ?)
+"""
+
+# 按窗口汇总用户LTV
+REFRESH_LTV_WINDOW_STATS_SQL = """
+INSERT INTO ltv_window_stats (window_days, user_count, total_ltv, avg_ltv)
+SELECT window_days, COUNT(*), SUM(ltv), AVG(ltv)
+FROM user_ltv_window
+GROUP BY window_days
+"""
+
+# LTV同期群汇总中表示总LTV的窗口天数
+TOTAL_LTV_WINDOW_DAYS = 0
+
+# 按首次购买日期、国家和设备类别汇总总LTV和各登记窗口的LTV，{cohort_filter}为空时汇总所有日期
+LTV_COHORT_STATS_SELECT_SQL = f"""
+SELECT l.first_purchase_date, u.country_code, u.device_category, {TOTAL_LTV_WINDOW_DAYS},
+       COUNT(*), SUM(l.purchase_count), SUM(l.ltv_total), AVG(l.ltv_total)
+FROM user_ltv l
+LEFT JOIN users u ON u.appsflyer_id = l.appsflyer_id
+{{cohort_filter}}
+GROUP BY l.first_purchase_date, u.country_code, u.device_category
+UNION ALL
+SELECT l.first_purchase_date, u.country_code, u.device_category, r.window_days,
+       COUNT(*), SUM(l.purchase_count), SUM(w.ltv), AVG(w.ltv)
+FROM user_ltv l
+CROSS JOIN ltv_windows r
+JOIN user_ltv_window w ON w.window_days = r.window_days AND w.appsflyer_id = l.appsflyer_id
+LEFT JOIN users u ON u.appsflyer_id = l.appsflyer_id
+{{cohort_filter}}
+GROUP BY r.window_days, l.first_purchase_date, u.country_code, u.device_category
+"""
+
+# 增量计算时只汇总cohort_dates临时表中的首次购买日期
+LTV_COHORT_DATE_FILTER = "WHERE l.first_purchase_date IN (SELECT first_purchase_date FROM temp.cohort_dates)"
+
+LTV_COHORT_STATS_COLUMNS = [
+    'first_purchase_date', 'country_code', 'device_category', 'window_days',
+    'user_count', 'purchase_count', 'total_ltv', 'avg_ltv'
+]
+
+def collect_cohort_dates(cursor, ltv_data):
+    """将重新计算的用户更新前后的首次购买日期写入cohort_dates临时表，须在写入user_ltv之前调用"""
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS cohort_dates (first_purchase_date DATE PRIMARY KEY)")
+    cursor.execute("DELETE FROM temp.cohort_dates")
+    cursor.executemany(
+        "INSERT OR IGNORE INTO temp.cohort_dates (first_purchase_date) VALUES (?)",
+        {(row[1],) for row in ltv_data}
+    )
+    cursor.executemany(
+        """
+        INSERT OR IGNORE INTO temp.cohort_dates (first_purchase_date)
+        SELECT first_purchase_date FROM user_ltv WHERE appsflyer_id = ?
+        """,
+        ((row[0],) for row in ltv_data)
+    )
+
+def refresh_ltv_cohort_stats(cursor, incremental=False):
+    """重新汇总LTV同期群，incremental为True时只替换cohort_dates中的首次购买日期"""
+    if incremental:
+        cursor.execute(
+            "DELETE FROM ltv_cohort_stats WHERE first_purchase_date IN (SELECT first_purchase_date FROM temp.cohort_dates)"
+        )
+        cohort_filter = LTV_COHORT_DATE_FILTER
+    else:
+        cursor.execute("DELETE FROM ltv_cohort_stats")
+        cohort_filter = ""
+    cursor.execute(
+        f"INSERT INTO ltv_cohort_stats ({', '.join(LTV_COHORT_STATS_COLUMNS)}) "
+        + LTV_COHORT_STATS_SELECT_SQL.format(cohort_filter=cohort_filter)
+    )
+
+def load_ltv_windows(cursor):
+    """读取登记的LTV窗口天数，按天数排序"""
+    cursor.execute("SELECT window_days FROM ltv_windows ORDER BY window_days")
+    return [row[0] for row in cursor.fetchall()]
+
+def register_ltv_window(cursor, window_days):
+    """登记新的LTV窗口，下次计算LTV时会为所有用户计算该窗口"""
+    cursor.execute(
+        "INSERT OR IGNORE INTO ltv_windows (window_days, window_name) VALUES (?, ?)",
+        (window_days, f"{window_days}d")
+    )
+    return cursor.rowcount > 0
+
+def compute_user_ltv(cursor, after_purchase_id=0, window_days=()):
+    """计算用户LTV，after_purchase_id大于0时只计算该ID之后有新购买的用户
+    
+    每个用户都基于其全部购买记录计算，购买按(created_date, id)顺序累加，
+    因此只计算部分用户时，结果与全量计算完全一致。
+    返回(user_ltv记录, window_days中各窗口的user_ltv_window记录)。
+    """
+    # 获取用户所有购买记录，按时间排序
+    if after_purchase_id:
+        cursor.execute("""
+        SELECT appsflyer_id, created_date, event_revenue_usd
+        FROM purchases
+        WHERE appsflyer_id IN (SELECT appsflyer_id FROM purchases WHERE id > ?)
+        ORDER BY appsflyer_id, created_date, id
+        """, (after_purchase_id,))
+    else:
+        cursor.execute("""
+        SELECT appsflyer_id, created_date, event_revenue_usd
+        FROM purchases
+        ORDER BY appsflyer_id, created_date, id
+        """)
+    purchases = pd.DataFrame(cursor.fetchall(), columns=['appsflyer_id', 'created_date', 'event_revenue_usd'])
+    return build_user_ltv(
+        purchases['appsflyer_id'], purchases['created_date'], purchases['event_revenue_usd'], window_days
+    )
+
+def compute_user_ltv_from_staging(conn, window_days=()):
+    """从暂存区读取购买记录计算全部用户的LTV，暂存区不可用时返回None"""
+    purchases = read_staging(conn, 'purchases', ['id', 'appsflyer_id', 'created_date', 'event_revenue_usd'])
+    if purchases is None:
+        return None
+    purchases = purchases.sort_values(['appsflyer_id', 'created_date', 'id'])
+    return build_user_ltv(
+        purchases['appsflyer_id'], purchases['created_date'], purchases['event_revenue_usd'], window_days
+    )
+
+def compute_ltv_windows(user_codes, purchase_days, revenue, window_days):
+    """按用户分段累加各时间窗口内的购买金额
+    
+    三个数组按(用户, 购买日期)排序，user_codes为用户编号，purchase_days为购买日期的天数序号。
+    每个用户的首次购买日期为其第一条记录的日期，各窗口的金额为一次分段求和（np.add.reduceat）。
+    返回(每个用户首条记录的下标, 每个用户的购买次数, {窗口天数: 金额数组}, 总金额数组)。
+    """
+    user_codes = np.asarray(user_codes)
+    purchase_days = np.asarray(purchase_days)
+    revenue = np.asarray(revenue, dtype=float)
+    if len(user_codes) == 0:
+        empty = np.zeros(0)
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), {days: empty for days in window_days}, empty
+    
+    starts = np.flatnonzero(np.concatenate(([True], user_codes[1:] != user_codes[:-1])))
+    counts = np.diff(np.append(starts, len(user_codes)))
+    day_offsets = purchase_days - np.repeat(purchase_days[starts], counts)
+    
+    window_sums = {
+        days: np.add.reduceat(np.where(day_offsets < days, revenue, 0.0), starts)
+        for days in window_days
+    }
+    return starts, counts, window_sums, np.add.reduceat(revenue, starts)
+
+def build_user_ltv(appsflyer_ids, created_dates, revenues, window_days=()):
+    """由按(appsflyer_id, created_date, id)排序的购买记录计算LTV
+    
+    user_ltv的固定窗口和window_days中的登记窗口一起计算，
+    返回(user_ltv记录, user_ltv_window记录)。
+    """
+    user_codes, _ = pd.factorize(np.asarray(appsflyer_ids, dtype=object))
+    # 日期字符串只解析不重复的值
+    date_codes, unique_dates = pd.factorize(np.asarray(created_dates, dtype=object))
+    unique_days = pd.to_datetime(unique_dates, format='%Y-%m-%d').to_numpy().astype('datetime64[D]').astype(np.int64)
+    purchase_days = unique_days[date_codes]
+    
+    all_window_days = sorted({days for _, days in LTV_WINDOWS} | set(window_days))
+    starts, counts, window_sums, ltv_total = compute_ltv_windows(user_codes, purchase_days, revenues, all_window_days)
+    if len(starts) == 0:
+        return [], []
+    
+    appsflyer_ids = np.asarray(appsflyer_ids, dtype=object)
+    created_dates = np.asarray(created_dates, dtype=object)
+    user_ids = appsflyer_ids[starts].tolist()
+    ltv_data = list(zip(
+        user_ids,
+        created_dates[starts].tolist(),
+        *(window_sums[days].tolist() for _, days in LTV_WINDOWS),
+        ltv_total.tolist(),
+        counts.tolist(),
+        created_dates[starts + counts - 1].tolist()
+    ))
+    window_data = [
+        row
+        for days in window_days
+        for row in zip([days] * len(user_ids), user_ids, window_sums[days].tolist())
+    ]
+    return ltv_data, window_data
+
+def calculate_ltv(incremental=False, db_file=None, bulk_load=False, conn=None, from_staging=False):
+    """计算用户LTV并更新数据库
+    
+    incremental为True时只重新计算上次计算后有新购买的用户，并更新这些用户的LTV。
+    LTV窗口从首次购买日起算且只累加已记录的购买，没有新购买的用户即使窗口尚未结束，
+    其LTV也不会变化，因此无需重新计算。新登记了窗口时执行全量计算，为所有用户补算该窗口。
+    
+    除user_ltv的固定窗口外，ltv_windows中登记的每个窗口写入user_ltv_window，
+    并重新汇总ltv_window_stats；ltv_cohort_stats中受影响的首次购买日期随之重新汇总。
+    
+    from_staging为True时全量计算从Parquet暂存区读取购买记录，暂存区与数据库不一致时从数据库读取。
+    传入conn时使用该共享连接，不关闭连接，修改作为保存点随调用方的事务提交。
+    """
+    own_conn = conn is None
+    db_file = db_file or DB_FILE
     try:
         # 检查数据库是否存在
-        if not os.path.exists(DB_FILE):
-            logger.error(f"数据库文件不存在: {DB_FILE}")
+        if own_conn and not os.path.exists(db_file):
+            logger.error(f"数据库文件不存在: {db_file}")
             logger.info("请先运行 create_database.py 创建数据库")
             return
         
-        logger.info("开始计算用户LTV")
+        logger.info(f"开始{'增量' if incremental else ''}计算用户LTV")
         
         # 连接数据库
-        conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row  # 使用命名行
+        if own_conn:
+            conn = connect_database(db_file, bulk_load)
         cursor = conn.cursor()
         
         # 检查是否有purchase数据
-        cursor.execute("SELECT COUNT(*) FROM purchases")
-        purchase_count = cursor.fetchone()[0]
+        cursor.execute(f"SELECT COUNT(*), COALESCE(MAX(id), 0) FROM {storage_table('purchases', is_normalized(cursor))}")
+        purchase_count, max_purchase_id = cursor.fetchone()
         
         if purchase_count == 0:
             logger.warning("没有找到购买数据，请先处理CSV数据")
-            return
+            # 全量计算时仍需清空原有的LTV数据
+            if incremental:
+                return
         
         logger.info(f"找到 {purchase_count} 条购买记录")
         
-        # 获取所有用户的首次购买日期
-        cursor.execute("""
-        SELECT appsflyer_id, MIN(created_date) as first_purchase_date
-        FROM purchases
-        GROUP BY appsflyer_id
-        """)
-        
-        user_first_purchase = {row['appsflyer_id']: row['first_purchase_date'] for row in cursor.fetchall()}
-        
-        # 获取用户所有购买记录，按时间排序
-        cursor.execute("""
-        SELECT appsflyer_id, created_date, event_revenue_usd
-        FROM purchases
-        ORDER BY appsflyer_id, created_date
-        """)
+        # 增量模式从上次处理到的购买ID之后开始
+        watermark = get_etl_state(cursor, LTV_WATERMARK_KEY) if incremental else None
+        if incremental and watermark is None:
+            logger.info("没有LTV增量计算记录，执行全量计算")
+            incremental = False
         
-        # 用户购买记录
-        user_purchases = defaultdict(list)
+        # 登记的窗口，其中尚未计算过的窗口需要为所有用户补算
+        window_days = load_ltv_windows(cursor)
+        if incremental:
+            cursor.execute("""
+            SELECT window_days FROM ltv_windows
+            WHERE window_days NOT IN (SELECT window_days FROM ltv_window_stats)
+            """)
+            new_window_days = [row[0] for row in cursor.fetchall()]
+            if new_window_days:
+                logger.info(f"新登记了LTV窗口 {new_window_days}，执行全量计算")
+                incremental = False
         
-        for row in cursor.fetchall():
-            appsflyer_id = row['appsflyer_id']
-            created_date = datetime.strptime(row['created_date'], '%Y-%m-%d').date()
-            revenue = row['event_revenue_usd']
-            
-            user_purchases[appsflyer_id].append((created_date, revenue))
+        if incremental:
+            if watermark >= max_purchase_id:
+                logger.info("没有新的购买数据，LTV无需更新")
+                return
+            ltv_data, window_data = compute_user_ltv(cursor, watermark, window_days)
+        else:
+            staged = compute_user_ltv_from_staging(conn, window_days) if from_staging else None
+            ltv_data, window_data = staged or compute_user_ltv(cursor, window_days=window_days)
         
-        # 计算LTV
-        ltv_data = []
+        # 开始事务
+        begin_stage(conn, 'calculate_ltv')
         
-        for appsflyer_id, purchases in user_purchases.items():
-            first_purchase_date = datetime.strptime(user_first_purchase[appsflyer_id], '%Y-%m-%d').date()
-            last_purchase_date = purchases[-1][0]
+        try:
+            # 全量计算时删除现有LTV数据，增量计算时删除已取消登记的窗口
+            if not incremental:
+                cursor.execute("DELETE FROM user_ltv")
+                cursor.execute("DELETE FROM user_ltv_window")
+            else:
+                cursor.execute("DELETE FROM user_ltv_window WHERE window_days NOT IN (SELECT window_days FROM ltv_windows)")
             
-            # 初始化各时间窗口的LTV
-            ltv_1d = 0.0
-            ltv_7d = 0.0
-            ltv_14d = 0.0
-            ltv_30d = 0.0
-            ltv_60d = 0.0
-            ltv_90d = 0.0
-            ltv_total = 0.0
+            # 记录受影响的同期群日期（包括用户更新前的首次购买日期）
+            if incremental:
+                collect_cohort_dates(cursor, ltv_data)
             
-            # 计算每个时间窗口的LTV
-            for purchase_date, revenue in purchases:
-                days_diff = (purchase_date - first_purchase_date).days
-                
-                ltv_total += revenue
-                
-                if days_diff <= 0:  # 包括首次购买当天
-                    ltv_1d += revenue
-                
-                if days_diff <= 6:  # 7天内（含首次购买当天）
-                    ltv_7d += revenue
-                
-                if days_diff <= 13:  # 14天内
-                    ltv_14d += revenue
-                
-                if days_diff <= 29:  # 30天内
-                    ltv_30d += revenue
-                
-                if days_diff <= 59:  # 60天内
-                    ltv_60d += revenue
-                
-                if days_diff <= 89:  # 90天内
-                    ltv_90d += revenue
+            # 写入新计算的LTV数据
+            cursor.executemany(UPSERT_USER_LTV_SQL, ltv_data)
+            cursor.executemany(UPSERT_USER_LTV_WINDOW_SQL, window_data)
+            set_etl_state(cursor, LTV_WATERMARK_KEY, max_purchase_id)
             
-            # 添加到批量更新数据
-            ltv_data.append((
-                appsflyer_id,
-                user_first_purchase[appsflyer_id],
-                ltv_1d,
-                ltv_7d,
-                ltv_14d,
-                ltv_30d,
-                ltv_60d,
-                ltv_90d,
-                ltv_total,
-                len(purchases),
-                str(last_purchase_date)
-            ))
-        
-        # 开始事务
-        conn.execute("BEGIN TRANSACTION")
-        
-        try:
-            # 删除现有LTV数据
-            cursor.execute("DELETE FROM user_ltv")
+            # 重新汇总各窗口的LTV
+            cursor.execute("DELETE FROM ltv_window_stats")
+            cursor.execute(REFRESH_LTV_WINDOW_STATS_SQL)
             
-            # 插入新计算的LTV数据
-            cursor.executemany("""
-            INSERT INTO user_ltv (
-                appsflyer_id, first_purchase_date, ltv_1d, 
-                ltv_7d, ltv_14d, ltv_30d, ltv_60d, ltv_90d, 
-                ltv_total, purchase_count, last_purchase_date
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, ltv_data)
+            # 重新汇总受影响的LTV同期群
+            refresh_ltv_cohort_stats(cursor, incremental)
             
             # 提交事务
-            conn.commit()
+            commit_stage(conn, 'calculate_ltv')
             
-            logger.info(f"已成功计算并更新 {len(ltv_data)} 个用户的LTV数据")
+            logger.info(f"已成功计算并更新 {len(ltv_data)} 个用户的LTV数据（{len(window_days)} 个登记窗口）")
             
         except Exception as e:
             # 回滚事务
-            conn.rollback()
+            rollback_stage(conn, 'calculate_ltv')
             logger.error(f"LTV计算失败: {e}")
             raise
         
@@ -164,115 +358,461 @@ def calculate_ltv():
         logger.error(f"LTV计算过程出错: {e}")
         raise
     finally:
-        if conn:
+        if own_conn and conn:
             conn.close()
 
-def generate_daily_stats():
-    """生成每日统计数据"""
+def round_cohort_row(row):
+    """同期群汇总记录中的金额保留6位小数"""
+    return tuple(round(value, 6) if isinstance(value, float) else value for value in row)
+
+def check_ltv_consistency(db_file=None, conn=None, after_purchase_id=0):
+    """将user_ltv和user_ltv_window表与全量重新计算的结果逐行比较，并检查ltv_cohort_stats与user_ltv一致，一致时返回True
+    
+    after_purchase_id大于0时只检查该ID之后有新购买的用户及其首次购买日期的同期群，
+    供增量更新后验证本次修改的数据，开销与新增数据量相关。
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect(db_file or DB_FILE)
+    try:
+        cursor = conn.cursor()
+        ltv_data, window_data = compute_user_ltv(cursor, after_purchase_id, window_days=load_ltv_windows(cursor))
+        expected = {row[0]: row for row in ltv_data}
+        user_filter = "WHERE appsflyer_id IN (SELECT appsflyer_id FROM purchases WHERE id > ?)" if after_purchase_id else ""
+        params = (after_purchase_id,) if after_purchase_id else ()
+        cursor.execute(f"SELECT {', '.join(USER_LTV_COLUMNS)} FROM user_ltv {user_filter}", params)
+        actual = {row[0]: row for row in cursor.fetchall()}
+        cursor.execute(f"SELECT window_days, appsflyer_id, ltv FROM user_ltv_window {user_filter}", params)
+        actual_windows = set(cursor.fetchall())
+        # 同期群汇总与由user_ltv重新汇总的结果比较，金额的求和顺序可能不同，按6位小数比较
+        cohort_filter = ""
+        if after_purchase_id:
+            collect_cohort_dates(cursor, ltv_data)
+            cohort_filter = LTV_COHORT_DATE_FILTER
+        cursor.execute(LTV_COHORT_STATS_SELECT_SQL.format(cohort_filter=cohort_filter))
+        expected_cohorts = {round_cohort_row(row) for row in cursor.fetchall()}
+        cursor.execute(
+            f"SELECT {', '.join(LTV_COHORT_STATS_COLUMNS)} FROM ltv_cohort_stats"
+            + (" WHERE first_purchase_date IN (SELECT first_purchase_date FROM temp.cohort_dates)" if after_purchase_id else "")
+        )
+        actual_cohorts = {round_cohort_row(row) for row in cursor.fetchall()}
+    finally:
+        if own_conn:
+            conn.close()
+    
+    window_mismatches = len(actual_windows ^ set(window_data))
+    if window_mismatches:
+        logger.error(f"LTV一致性检查失败: user_ltv_window中 {window_mismatches} 条记录与重新计算的结果不一致")
+        return False
+    cohort_mismatches = len(actual_cohorts ^ expected_cohorts)
+    if cohort_mismatches:
+        logger.error(f"LTV一致性检查失败: ltv_cohort_stats中 {cohort_mismatches} 条记录与user_ltv不一致")
+        return False
+    
+    mismatched = sorted(
+        appsflyer_id for appsflyer_id in expected.keys() | actual.keys()
+        if expected.get(appsflyer_id) != actual.get(appsflyer_id)
+    )
+    for appsflyer_id in mismatched[:10]:
+        logger.error(f"LTV不一致: {appsflyer_id} 表中为 {actual.get(appsflyer_id)}, 重新计算为 {expected.get(appsflyer_id)}")
+    
+    if mismatched:
+        logger.error(f"LTV一致性检查失败: {len(mismatched)} 个用户不一致")
+        return False
+    logger.info(f"LTV一致性检查通过: {len(expected)} 个{'有新购买的' if after_purchase_id else ''}用户与全量计算结果一致")
+    return True
+
+# etl_state中记录统计数据已处理到的最大事件ID的键
+STATS_WATERMARK_KEY = 'stats_event_id'
+
+# 增量统计时只统计stat_dates临时表中的日期
+STATS_DATE_FILTER = "AND e.created_date IN (SELECT stat_date FROM temp.stat_dates)"
+
+# 每批读取的事件数，按日期划分批次，同一日期的事件总在同一批中
+STATS_BATCH_ROWS = 1000000
+
+# 时间分组列，由事件时间得出；统计表的其余分组列均为事件表中的维度列
+STATS_TIME_KEYS = ['stat_date', 'stat_hour']
+
+# 每日和每小时统计的设备数、国家数需要的维度列
+SUMMARY_DIMENSION_COLUMNS = ['country_code', 'device_category']
+
+# 每日/每小时基本统计和国家/设备等维度统计的指标列
+SUMMARY_STATS_COLUMNS = [
+    'user_count', 'new_user_count', 'event_count', 'purchase_count', 'revenue_usd', 'device_count', 'country_count'
+]
+DIMENSION_STATS_COLUMNS = ['user_count', 'event_count', 'revenue_usd']
+
+# 统计表及其分组列和指标列，按天的表在前，按小时的表在后
+STATS_TABLES = [
+    ('daily_stats', ['stat_date'], SUMMARY_STATS_COLUMNS),
+    ('country_stats', ['stat_date', 'country_code'], DIMENSION_STATS_COLUMNS),
+    ('device_stats', ['stat_date', 'device_category'], DIMENSION_STATS_COLUMNS),
+    ('hourly_stats', ['stat_date', 'stat_hour'], SUMMARY_STATS_COLUMNS),
+    ('country_hourly_stats', ['stat_date', 'stat_hour', 'country_code'], DIMENSION_STATS_COLUMNS),
+    ('device_hourly_stats', ['stat_date', 'stat_hour', 'device_category'], DIMENSION_STATS_COLUMNS),
+]
+
+# 登记的维度统计表，维度列为空的事件计入UNKNOWN_DIMENSION_VALUE
+REGISTERED_DIMENSION_COLUMNS = [column for columns, _ in DIMENSION_STATS for column in columns]
+STATS_TABLES += [
+    (dimension_stats_table(columns), ['stat_date'] + columns, [measure for measure, _, _ in DIMENSION_STATS_MEASURES])
+    for columns, _ in DIMENSION_STATS
+]
+
+# 统计生成步骤维护的所有表及其中文名称，用于清空、按日期替换和日志
+STATS_TABLE_NAMES = {
+    'daily_stats': '每日统计',
+    'country_stats': '国家统计',
+    'device_stats': '设备统计',
+    'hourly_stats': '小时统计',
+    'country_hourly_stats': '国家小时统计',
+    'device_hourly_stats': '设备小时统计',
+    **{dimension_stats_table(columns): f"{label}统计" for columns, label in DIMENSION_STATS},
+    'user_bitmaps': '用户位图',
+    'daily_details': '日期详情',
+}
+
+# 统计所需的事件列，{dimension_columns}为各统计表用到的维度列。
+# 每个事件只读取一次，所有统计表和用户位图均由同一批数据计算，
+# 增加统计维度只增加读取的列，不增加对事件表的扫描；用户的rowid和首次出现日期由attach_users补充。
+# 规范化存储时直接读取编码表，{purchase_event_name}为购买事件名称的编码，维度列由decode_stats_columns转换
+STAT_EVENTS_SQL = """
+SELECT 
+    e.created_date AS stat_date,
+    CAST(substr(e.event_time, 12, 2) AS INTEGER) AS stat_hour,
+    e.appsflyer_id,
+    e.event_name = {purchase_event_name} AS is_purchase,
+    e.event_revenue_usd,
+    {dimension_columns}
+FROM 
+    {events_table} e
+WHERE 1 {date_filter}
+"""
+
+PURCHASE_EVENT_NAME_SQL = "'af_purchase'"
+PURCHASE_EVENT_CODE_SQL = f"(SELECT code FROM {dictionary_table('event_name')} WHERE value = 'af_purchase')"
+
+# 事件较多时按日期范围分批读取，每批使用created_date索引
+STATS_BATCH_FILTER = "AND e.created_date BETWEEN ? AND ?"
+
+def stats_dimension_columns(stats_tables):
+    """需读取的维度列：汇总统计用到的列，加上各统计表的非时间分组列"""
+    columns = list(SUMMARY_DIMENSION_COLUMNS)
+    for _, keys, _ in stats_tables:
+        columns += [key for key in keys if key not in STATS_TIME_KEYS and key not in columns]
+    return columns
+
+def insert_stats_sql(table, keys, columns):
+    """统计表的插入语句"""
+    columns = keys + columns
+    return f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+def read_stats_users(conn, coded=False):
+    """读取用户的rowid和首次出现日期，以appsflyer_id为索引；coded为True时以用户ID编码为索引"""
+    sql = (
+        f"SELECT appsflyer_id, appsflyer_id AS user_rowid, first_seen_date FROM {storage_table('users', True)}" if coded
+        else "SELECT appsflyer_id, rowid AS user_rowid, first_seen_date FROM users"
+    )
+    return pd.read_sql_query(sql, conn, index_col='appsflyer_id')
+
+def read_stats_dictionaries(conn, columns):
+    """读取规范化存储中columns的编码列的字典，返回{列名: 按编码顺序排列的原值}"""
+    return {
+        column: pd.Index(pd.read_sql_query(f"SELECT value FROM {dictionary_table(column)} ORDER BY code", conn)['value'])
+        for column in columns if column in NORMALIZED_COLUMNS['events']
+    }
+
+def decode_stats_columns(events, dictionaries):
+    """将编码列转换为分类类型，字典编码从1开始连续分配，编码n对应第n个原值，空值仍为空"""
+    for column, values in dictionaries.items():
+        codes = events[column].to_numpy(dtype=np.int64, na_value=0) - 1
+        events[column] = pd.Categorical.from_codes(codes, categories=values)
+    return events
+
+def attach_users(events, users):
+    """为事件补充user_rowid和is_new_user列，不在users表中的用户两列均为空"""
+    positions = users.index.get_indexer(events['appsflyer_id'])
+    found = positions >= 0
+    user_rowids = users['user_rowid'].to_numpy()[positions]
+    first_seen_dates = users['first_seen_date'].to_numpy()[positions]
+    events['user_rowid'] = pd.Series(user_rowids, index=events.index).where(found)
+    events['is_new_user'] = pd.Series(first_seen_dates == events['stat_date'].to_numpy(), index=events.index).where(found)
+    return events
+
+def aggregate_stats(events):
+    """由一批事件计算各统计表的插入记录（按STATS_TABLES的顺序）和用户位图记录
+    
+    events包含STAT_EVENTS_SQL的各列及attach_users补充的列，须包含所含日期的全部事件。
+    统计口径：收入只计购买事件，全部为空时为NULL；用户数按users表的rowid去重，
+    新用户为首次出现日期等于统计日期的用户。
+    """
+    is_purchase = events['is_purchase'] == 1
+    events = events.assign(
+        is_purchase=is_purchase,
+        revenue_usd=events['event_revenue_usd'].where(is_purchase, 0.0),
+        new_user_rowid=events['user_rowid'].where(events['is_new_user'] == 1)
+    )
+    # 分组列先转换为分类类型，各统计表分组时不再重复编码字符串
+    for column in ['stat_date'] + stats_dimension_columns(STATS_TABLES):
+        events[column] = events[column].astype('category')
+        if column in REGISTERED_DIMENSION_COLUMNS and column not in SUMMARY_DIMENSION_COLUMNS:
+            if UNKNOWN_DIMENSION_VALUE not in events[column].cat.categories:
+                events[column] = events[column].cat.add_categories(UNKNOWN_DIMENSION_VALUE)
+            events[column] = events[column].fillna(UNKNOWN_DIMENSION_VALUE)
+    
+    def table_rows(keys, columns):
+        grouped = events.groupby(keys, observed=True, dropna=False)
+        measures = {
+            'user_count': lambda: grouped['user_rowid'].nunique(),
+            'new_user_count': lambda: grouped['new_user_rowid'].nunique(),
+            'event_count': lambda: grouped.size(),
+            'purchase_count': lambda: grouped['is_purchase'].sum(),
+            'revenue_usd': lambda: grouped['revenue_usd'].sum(min_count=1),
+            'device_count': lambda: grouped['device_category'].nunique(),
+            'country_count': lambda: grouped['country_code'].nunique(),
+        }
+        stats = pd.DataFrame({column: measures[column]() for column in columns}).reset_index().astype(object)
+        return stats.where(stats.notna(), None).to_numpy().tolist()
+    
+    stats_rows = [table_rows(keys, columns) for _, keys, columns in STATS_TABLES]
+    bitmap_rows = build_user_bitmap_rows(events[['stat_date', 'country_code', 'device_category', 'user_rowid']])
+    return stats_rows, bitmap_rows
+
+INSERT_DAILY_DETAILS_SQL = "INSERT INTO daily_details (stat_date, details_json) VALUES (?, ?)"
+
+def build_daily_details_rows(stats_rows):
+    """由每日、国家、设备统计记录生成daily_details表的插入记录
+    
+    details_json与/api/details实时查询返回的data对象相同：国家、设备按用户数从多到少排列，
+    total_revenue为当天购买收入，没有购买时为0。
+    """
+    tables = {table: rows for (table, _, _), rows in zip(STATS_TABLES, stats_rows)}
+    details = {
+        stat_date: {'date': stat_date, 'total_revenue': revenue_usd or 0.0, 'countries': [], 'devices': []}
+        for stat_date, revenue_usd in (
+            (row[0], row[1 + SUMMARY_STATS_COLUMNS.index('revenue_usd')]) for row in tables['daily_stats']
+        )
+    }
+    user_count_index = 2 + DIMENSION_STATS_COLUMNS.index('user_count')
+    for table, key, name in [('country_stats', 'countries', 'country'), ('device_stats', 'devices', 'device')]:
+        for row in sorted(tables[table], key=lambda row: (-row[user_count_index], row[1] or '')):
+            details[row[0]][key].append({name: row[1], 'users': row[user_count_index]})
+    return [
+        (stat_date, json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+        for stat_date, data in details.items()
+    ]
+
+def stats_date_batches(cursor, date_filter):
+    """将需统计的日期按事件数划分为批次，返回[(开始日期, 结束日期)]
+    
+    只有一个批次时返回空列表，由调用方直接扫描事件表。事件表没有created_date索引时
+    （如批量导入尚未创建索引）先创建该索引，否则按日期范围读取每批都要扫描整个表。
+    """
+    events_table = storage_table('events', is_normalized(cursor))
+    indexed = any(
+        cursor.execute(f"PRAGMA index_info({index[1]})").fetchone()[2] == 'created_date'
+        for index in cursor.execute(f"PRAGMA index_list({events_table})").fetchall()
+    )
+    if not indexed:
+        logger.info("事件表没有created_date索引，先创建索引以便按日期分批统计")
+        create_index(cursor, 'idx_events_created_date')
+    cursor.execute(f"""
+    SELECT e.created_date, COUNT(*)
+    FROM {events_table} e
+    WHERE 1 {date_filter}
+    GROUP BY e.created_date
+    ORDER BY e.created_date
+    """)
+    
+    batches = []
+    batch_start, batch_rows = None, 0
+    for stat_date, event_count in cursor.fetchall():
+        if batch_start is None:
+            batch_start = stat_date
+        batch_rows += event_count
+        if batch_rows >= STATS_BATCH_ROWS:
+            batches.append((batch_start, stat_date))
+            batch_start, batch_rows = None, 0
+    if batch_start is not None:
+        batches.append((batch_start, stat_date))
+    return batches if len(batches) > 1 else []
+
+def iter_stats_batches(conn, date_filter):
+    """从事件表读取统计所需的列，事件较多时按日期批次读取
+    
+    规范化存储时读取编码表，用户ID保持为编码，维度列由字典转换为分类类型。
+    """
+    normalized = is_normalized(conn.cursor())
+    users = read_stats_users(conn, coded=normalized)
+    dimension_columns = stats_dimension_columns(STATS_TABLES)
+    dictionaries = read_stats_dictionaries(conn, dimension_columns) if normalized else {}
+    sql = STAT_EVENTS_SQL.format(
+        date_filter=date_filter,
+        dimension_columns=',\n    '.join(f"e.{column}" for column in dimension_columns),
+        events_table=storage_table('events', normalized),
+        purchase_event_name=PURCHASE_EVENT_CODE_SQL if normalized else PURCHASE_EVENT_NAME_SQL
+    )
+    batches = stats_date_batches(conn.cursor(), date_filter)
+    if not batches:
+        yield attach_users(decode_stats_columns(pd.read_sql_query(sql, conn), dictionaries), users)
+    for batch_start, batch_end in batches:
+        events = pd.read_sql_query(f"{sql} {STATS_BATCH_FILTER}", conn, params=(batch_start, batch_end))
+        yield attach_users(decode_stats_columns(events, dictionaries), users)
+
+# 从暂存区计算统计数据所需的列，另加各统计表的维度列
+STAGING_STATS_COLUMNS = ['appsflyer_id', 'event_name', 'created_date', 'event_time', 'event_revenue_usd']
+
+def prepare_staged_stats_events(events, users):
+    """将暂存区读取的事件整理为与iter_stats_batches相同的列"""
+    events = events.rename(columns={'created_date': 'stat_date'})
+    events['stat_hour'] = events['event_time'].dt.hour
+    events['is_purchase'] = events['event_name'] == 'af_purchase'
+    return attach_users(events, users)
+
+def read_stats_from_staging(conn):
+    """从暂存区按日期分区分批读取统计所需的列，每批包含若干完整日期，与iter_stats_batches的批次大小相同
+    
+    返回各批事件的迭代器；暂存区不可用时返回None。
+    """
+    batches = read_staging_batches(
+        conn, 'events', STAGING_STATS_COLUMNS + stats_dimension_columns(STATS_TABLES), STATS_BATCH_ROWS
+    )
+    if batches is None:
+        return None
+    users = read_stats_users(conn)
+    return (prepare_staged_stats_events(events, users) for events in batches)
+
+def stats_tables_missing(cursor):
+    """是否有统计表为空而每日统计表有数据，如升级后新增的小时统计表和用户位图表"""
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM daily_stats)")
+    if not cursor.fetchone()[0]:
+        return False
+    for table in STATS_TABLE_NAMES:
+        cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {table})")
+        if not cursor.fetchone()[0]:
+            return True
+    return False
+
+def find_affected_stat_dates(cursor, after_event_id):
+    """找出after_event_id之后的新事件影响的统计日期，写入stat_dates临时表
+    
+    包括新事件所在的日期（含迟到的旧日期事件），以及首次出现日期因新事件而提前的用户
+    原来的首次出现日期，这些日期的新用户数会减少。原首次出现日期由之前已导入的事件得出。
+    规范化存储时直接比较用户ID编码。
+    """
+    events_table = storage_table('events', is_normalized(cursor))
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS stat_dates (stat_date DATE PRIMARY KEY)")
+    cursor.execute("DELETE FROM temp.stat_dates")
+    cursor.execute(f"""
+    INSERT INTO temp.stat_dates (stat_date)
+    WITH new_user_dates AS (
+        SELECT appsflyer_id, MIN(created_date) AS first_date
+        FROM {events_table}
+        WHERE id > :event_id
+        GROUP BY appsflyer_id
+    ),
+    old_user_dates AS (
+        SELECT e.appsflyer_id, MIN(e.created_date) AS first_date
+        FROM {events_table} e
+        JOIN new_user_dates n ON e.appsflyer_id = n.appsflyer_id
+        WHERE e.id <= :event_id
+        GROUP BY e.appsflyer_id
+    )
+    SELECT created_date FROM {events_table} WHERE id > :event_id
+    UNION
+    SELECT o.first_date
+    FROM old_user_dates o
+    JOIN new_user_dates n ON o.appsflyer_id = n.appsflyer_id
+    WHERE n.first_date < o.first_date
+    """, {'event_id': after_event_id})
+    return cursor.rowcount
+
+def generate_daily_stats(incremental=False, db_file=None, bulk_load=False, conn=None, from_staging=False):
+    """生成每日统计数据
+    
+    incremental为True时只重新统计上次统计后有新事件的日期，并替换这些日期的统计数据。
+    from_staging为True时全量统计从Parquet暂存区读取事件，暂存区与数据库不一致时在数据库中统计。
+    传入conn时使用该共享连接，不关闭连接，修改作为保存点随调用方的事务提交。
+    """
+    own_conn = conn is None
+    db_file = db_file or DB_FILE
     try:
         # 检查数据库是否存在
-        if not os.path.exists(DB_FILE):
-            logger.error(f"数据库文件不存在: {DB_FILE}")
+        if own_conn and not os.path.exists(db_file):
+            logger.error(f"数据库文件不存在: {db_file}")
             return
         
-        logger.info("开始生成每日统计数据")
+        logger.info(f"开始{'增量' if incremental else ''}生成每日统计数据")
         
         # 连接数据库
-        conn = sqlite3.connect(DB_FILE)
+        if own_conn:
+            conn = connect_database(db_file, bulk_load)
         cursor = conn.cursor()
         
+        cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {storage_table('events', is_normalized(cursor))}")
+        max_event_id = cursor.fetchone()[0]
+        
+        # 增量模式从上次处理到的事件ID之后开始
+        watermark = get_etl_state(cursor, STATS_WATERMARK_KEY) if incremental else None
+        if incremental and watermark is None:
+            logger.info("没有统计数据增量计算记录，执行全量统计")
+            incremental = False
+        if incremental and stats_tables_missing(cursor):
+            logger.info("存在尚未生成的统计表，执行全量统计")
+            incremental = False
+        if incremental and watermark >= max_event_id:
+            logger.info("没有新的事件数据，统计数据无需更新")
+            return
+        
+        # 全量统计时可从暂存区按日期分批读取事件，不扫描事件表
+        staged_events = read_stats_from_staging(conn) if from_staging and not incremental else None
+        
         # 开始事务
-        conn.execute("BEGIN TRANSACTION")
+        begin_stage(conn, 'generate_daily_stats')
         
         try:
-            # 清空现有统计数据
-            cursor.execute("DELETE FROM daily_stats")
-            cursor.execute("DELETE FROM country_stats")
-            cursor.execute("DELETE FROM device_stats")
-            
-            # 计算每日基本统计数据
-            cursor.execute("""
-            INSERT INTO daily_stats (
-                stat_date, user_count, new_user_count, event_count, 
-                purchase_count, revenue_usd, device_count, country_count
-            )
-            SELECT 
-                e.created_date,
-                COUNT(DISTINCT e.appsflyer_id) as user_count,
-                COUNT(DISTINCT CASE WHEN u.first_seen_date = e.created_date THEN u.appsflyer_id END) as new_user_count,
-                COUNT(*) as event_count,
-                COUNT(CASE WHEN e.event_name = 'af_purchase' THEN 1 END) as purchase_count,
-                SUM(CASE WHEN e.event_name = 'af_purchase' THEN e.event_revenue_usd ELSE 0 END) as revenue_usd,
-                COUNT(DISTINCT e.device_category) as device_count,
-                COUNT(DISTINCT e.country_code) as country_count
-            FROM 
-                events e
-            LEFT JOIN 
-                users u ON e.appsflyer_id = u.appsflyer_id
-            GROUP BY 
-                e.created_date
-            ORDER BY 
-                e.created_date
-            """)
+            if incremental:
+                # 只替换受影响日期的统计数据
+                affected_dates = find_affected_stat_dates(cursor, watermark)
+                logger.info(f"重新统计 {affected_dates} 个日期的数据")
+                for table in STATS_TABLE_NAMES:
+                    cursor.execute(f"DELETE FROM {table} WHERE stat_date IN (SELECT stat_date FROM temp.stat_dates)")
+                date_filter = STATS_DATE_FILTER
+            else:
+                # 清空现有统计数据
+                for table in STATS_TABLE_NAMES:
+                    cursor.execute(f"DELETE FROM {table}")
+                date_filter = ""
             
-            # 计算国家维度统计数据
-            cursor.execute("""
-            INSERT INTO country_stats (
-                stat_date, country_code, user_count, event_count, revenue_usd
-            )
-            SELECT 
-                e.created_date,
-                e.country_code,
-                COUNT(DISTINCT e.appsflyer_id) as user_count,
-                COUNT(*) as event_count,
-                SUM(CASE WHEN e.event_name = 'af_purchase' THEN e.event_revenue_usd ELSE 0 END) as revenue_usd
-            FROM 
-                events e
-            GROUP BY 
-                e.created_date, e.country_code
-            ORDER BY 
-                e.created_date, e.country_code
-            """)
+            # 每批事件只读取一次，同时计算所有统计表、用户位图和日期详情
+            batches = staged_events if staged_events is not None else iter_stats_batches(conn, date_filter)
+            for events in batches:
+                if events.empty:
+                    continue
+                stats_rows, bitmap_rows = aggregate_stats(events)
+                for (table, keys, columns), rows in zip(STATS_TABLES, stats_rows):
+                    cursor.executemany(insert_stats_sql(table, keys, columns), rows)
+                cursor.executemany(INSERT_USER_BITMAP_SQL, bitmap_rows)
+                cursor.executemany(INSERT_DAILY_DETAILS_SQL, build_daily_details_rows(stats_rows))
             
-            # 计算设备维度统计数据
-            cursor.execute("""
-            INSERT INTO device_stats (
-                stat_date, device_category, user_count, event_count, revenue_usd
-            )
-            SELECT 
-                e.created_date,
-                e.device_category,
-                COUNT(DISTINCT e.appsflyer_id) as user_count,
-                COUNT(*) as event_count,
-                SUM(CASE WHEN e.event_name = 'af_purchase' THEN e.event_revenue_usd ELSE 0 END) as revenue_usd
-            FROM 
-                events e
-            GROUP BY 
-                e.created_date, e.device_category
-            ORDER BY 
-                e.created_date, e.device_category
-            """)
-            
-            # 提交事务
-            conn.commit()
+            set_etl_state(cursor, STATS_WATERMARK_KEY, max_event_id)
             
             # 获取统计结果
-            cursor.execute("SELECT COUNT(*) FROM daily_stats")
-            daily_stats_count = cursor.fetchone()[0]
+            stats_counts = {}
+            for table in STATS_TABLE_NAMES:
+                cursor.execute(f"SELECT COUNT(*) FROM {table}")
+                stats_counts[table] = cursor.fetchone()[0]
             
-            cursor.execute("SELECT COUNT(*) FROM country_stats")
-            country_stats_count = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT COUNT(*) FROM device_stats")
-            device_stats_count = cursor.fetchone()[0]
+            # 提交事务
+            commit_stage(conn, 'generate_daily_stats')
             
-            logger.info(f"已生成 {daily_stats_count} 条每日统计数据")
-            logger.info(f"已生成 {country_stats_count} 条国家统计数据")
-            logger.info(f"已生成 {device_stats_count} 条设备统计数据")
+            for table, count in stats_counts.items():
+                logger.info(f"已生成 {count} 条{STATS_TABLE_NAMES[table]}数据")
             
         except Exception as e:
             # 回滚事务
-            conn.rollback()
+            rollback_stage(conn, 'generate_daily_stats')
             logger.error(f"生成统计数据失败: {e}")
             raise
         
@@ -280,9 +820,36 @@ def generate_daily_stats():
         logger.error(f"统计数据生成过程出错: {e}")
         raise
     finally:
-        if conn:
+        if own_conn and conn:
             conn.close()
 
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="LTV和统计数据计算脚本")
+    parser.add_argument("--incremental", action="store_true", help="只重新计算有新购买的用户的LTV和有新事件的日期的统计数据")
+    parser.add_argument("--check", action="store_true", help="检查user_ltv表与全量计算结果是否一致，不修改数据")
+    parser.add_argument(
+        "--add-window", type=int, action="append", metavar="DAYS",
+        help="登记新的LTV窗口天数（可多次指定），随后计算LTV时为所有用户补算"
+    )
+    parser.add_argument(
+        "--from-staging", action="store_true",
+        help="全量计算时从Parquet暂存区读取所需的列，不扫描数据库中的购买和事件表"
+    )
+    return parser.parse_args()
+
 if __name__ == "__main__":
-    calculate_ltv()
-    generate_daily_stats() 
\ No newline at end of file
+    args = parse_args()
+    if args.check:
+        sys.exit(0 if check_ltv_consistency() else 1)
+    if args.add_window:
+        conn = sqlite3.connect(DB_FILE)
+        try:
+            for window_days in args.add_window:
+                if register_ltv_window(conn.cursor(), window_days):
+                    logger.info(f"已登记LTV窗口: {window_days}d")
+            conn.commit()
+        finally:
+            conn.close()
+    calculate_ltv(incremental=args.incremental, from_staging=args.from_staging)
+    generate_daily_stats(incremental=args.incremental, from_staging=args.from_staging) 
\ No newline at end of file
@@ -9,6 +9,7 @@
 import os
 import sqlite3
 import logging
+import argparse
 from datetime import datetime
 
 # 配置日志
@@ -25,8 +26,10 @@ DB_FILE = os.path.join(DB_DIR, 'app.db')
 # 确保数据库目录存在
 os.makedirs(DB_DIR, exist_ok=True)
 
-# 创建表的SQL语句
-CREATE_TABLES_SQL = """
+# 事件、用户和购买表，即导入步骤写入的存储表，可切换为规范化存储（见NORMALIZED_TABLES_SQL）
+STORAGE_TABLES = ['events', 'users', 'purchases']
+
+STORAGE_TABLES_SQL = """
 -- 事件表，存储所有原始事件数据
 CREATE TABLE IF NOT EXISTS events (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -72,8 +75,19 @@ CREATE TABLE IF NOT EXISTS purchases (
     event_revenue_usd REAL NOT NULL,           -- USD收入金额
     product_id TEXT,                           -- 产品ID
     order_id TEXT,                             -- 订单ID
+    purchase_key TEXT UNIQUE,                  -- 购买唯一标识(用户ID_订单ID_购买时间)，用于跨批次去重
     FOREIGN KEY (appsflyer_id) REFERENCES users(appsflyer_id)
 );
+"""
+
+# 创建表的SQL语句
+CREATE_TABLES_SQL = STORAGE_TABLES_SQL + """
+-- 事件载荷表，以compressed方式导入时事件表的event_value、event_params为空，
+-- 两列按ID连续的事件分块压缩后保存在此表，以块中第一个事件的ID为键
+CREATE TABLE IF NOT EXISTS event_payloads (
+    first_event_id INTEGER PRIMARY KEY,         -- 块中第一个事件的ID
+    payload BLOB NOT NULL                       -- zlib压缩的JSON数组，第n项为第n个事件的[event_value, event_params]，无载荷时为null
+);
 
 -- 用户LTV表，存储计算好的用户终身价值数据
 CREATE TABLE IF NOT EXISTS user_ltv (
@@ -91,6 +105,41 @@ CREATE TABLE IF NOT EXISTS user_ltv (
     FOREIGN KEY (appsflyer_id) REFERENCES users(appsflyer_id)
 );
 
+-- LTV窗口登记表，登记的每个窗口都会计算并写入user_ltv_window，新增窗口只需插入一行
+CREATE TABLE IF NOT EXISTS ltv_windows (
+    window_days INTEGER PRIMARY KEY,            -- 窗口天数，累加首次购买日起该天数内（含当天）的购买
+    window_name TEXT NOT NULL UNIQUE            -- 窗口名称(如7d)，API的window参数使用该名称
+);
+
+-- 用户各窗口LTV表，每个用户每个登记窗口一行
+CREATE TABLE IF NOT EXISTS user_ltv_window (
+    window_days INTEGER NOT NULL,               -- 窗口天数
+    appsflyer_id TEXT NOT NULL,                 -- 用户ID
+    ltv REAL NOT NULL DEFAULT 0,                -- 窗口内LTV
+    PRIMARY KEY (window_days, appsflyer_id)
+) WITHOUT ROWID;
+
+-- 各窗口LTV汇总表，预先计算每个窗口的用户数、总LTV和平均LTV
+CREATE TABLE IF NOT EXISTS ltv_window_stats (
+    window_days INTEGER PRIMARY KEY,            -- 窗口天数
+    user_count INTEGER DEFAULT 0,               -- 用户数
+    total_ltv REAL DEFAULT 0,                   -- 总LTV
+    avg_ltv REAL DEFAULT 0                      -- 平均LTV
+);
+
+-- LTV同期群汇总表，按首次购买日期、国家和设备类别预先汇总每个窗口的LTV
+-- window_days为0的行是总LTV，其余为ltv_windows中登记的窗口
+CREATE TABLE IF NOT EXISTS ltv_cohort_stats (
+    first_purchase_date DATE NOT NULL,          -- 首次购买日期
+    country_code TEXT,                          -- 国家代码(取自users表)
+    device_category TEXT,                       -- 设备类别(取自users表)
+    window_days INTEGER NOT NULL,               -- 窗口天数，0为总LTV
+    user_count INTEGER DEFAULT 0,               -- 用户数
+    purchase_count INTEGER DEFAULT 0,           -- 购买次数
+    total_ltv REAL DEFAULT 0,                   -- 总LTV
+    avg_ltv REAL DEFAULT 0                      -- 平均LTV
+);
+
 -- 日报表，按日汇总的统计数据
 CREATE TABLE IF NOT EXISTS daily_stats (
     stat_date DATE PRIMARY KEY,                 -- 统计日期
@@ -123,12 +172,104 @@ CREATE TABLE IF NOT EXISTS device_stats (
     PRIMARY KEY (stat_date, device_category)
 );
 
+-- 小时报表，按日期和小时汇总的统计数据，与日报表在同一次扫描中生成
+-- 事件数、购买数和收入按小时相加等于日报表，去重计数（用户数等）不可相加
+CREATE TABLE IF NOT EXISTS hourly_stats (
+    stat_date DATE NOT NULL,                    -- 统计日期
+    stat_hour INTEGER NOT NULL,                 -- 小时（0-23）
+    user_count INTEGER DEFAULT 0,               -- 用户数
+    new_user_count INTEGER DEFAULT 0,           -- 新用户数
+    event_count INTEGER DEFAULT 0,              -- 事件数
+    purchase_count INTEGER DEFAULT 0,           -- 购买数
+    revenue_usd REAL DEFAULT 0,                 -- USD收入
+    device_count INTEGER DEFAULT 0,             -- 设备数量
+    country_count INTEGER DEFAULT 0,            -- 国家数量
+    PRIMARY KEY (stat_date, stat_hour)
+);
+
+-- 国家维度小时统计表
+CREATE TABLE IF NOT EXISTS country_hourly_stats (
+    stat_date DATE NOT NULL,                    -- 统计日期
+    stat_hour INTEGER NOT NULL,                 -- 小时（0-23）
+    country_code TEXT NOT NULL,                 -- 国家代码
+    user_count INTEGER DEFAULT 0,               -- 用户数
+    event_count INTEGER DEFAULT 0,              -- 事件数
+    revenue_usd REAL DEFAULT 0,                 -- USD收入
+    PRIMARY KEY (stat_date, stat_hour, country_code)
+);
+
+-- 设备维度小时统计表
+CREATE TABLE IF NOT EXISTS device_hourly_stats (
+    stat_date DATE NOT NULL,                    -- 统计日期
+    stat_hour INTEGER NOT NULL,                 -- 小时（0-23）
+    device_category TEXT NOT NULL,              -- 设备类别
+    user_count INTEGER DEFAULT 0,               -- 用户数
+    event_count INTEGER DEFAULT 0,              -- 事件数
+    revenue_usd REAL DEFAULT 0,                 -- USD收入
+    PRIMARY KEY (stat_date, stat_hour, device_category)
+);
+
+-- 用户位图表，每个统计日期（及国家、设备）当天出现的用户集合，按日期范围合并可得去重用户数
+-- 位序号为users表的rowid，users表不能VACUUM（会重新编号rowid），全量导入时与统计数据一起重建
+CREATE TABLE IF NOT EXISTS user_bitmaps (
+    dimension TEXT NOT NULL,                    -- 分组维度：total、country_code、device_category
+    stat_date DATE NOT NULL,                    -- 统计日期
+    dimension_value TEXT NOT NULL,              -- 维度值，total维度为空字符串
+    user_count INTEGER DEFAULT 0,               -- 用户数
+    user_bitmap BLOB NOT NULL,                  -- zlib压缩的用户位图
+    PRIMARY KEY (dimension, stat_date, dimension_value)
+);
+
+-- 日期详情表，每个统计日期一行，保存/api/details返回的data对象（JSON），API按主键读取后原样返回
+CREATE TABLE IF NOT EXISTS daily_details (
+    stat_date DATE PRIMARY KEY,                 -- 统计日期
+    details_json TEXT NOT NULL                  -- 按国家、设备的用户数和购买收入，JSON格式
+);
+
+-- 设备类别映射表，缓存设备型号的分类结果，供后续运行复用
+CREATE TABLE IF NOT EXISTS device_categories (
+    device_model TEXT PRIMARY KEY,              -- 设备型号
+    device_category TEXT NOT NULL               -- 设备类别
+);
+
 -- 货币转换表，用于存储各种货币对USD的转换率
 CREATE TABLE IF NOT EXISTS currency_rates (
     currency_code TEXT PRIMARY KEY,             -- 货币代码
     rate_to_usd REAL NOT NULL,                  -- 对USD的汇率
     last_updated DATETIME NOT NULL              -- 最后更新时间
 );
+
+-- 导入记录表，记录每个CSV文件已导入到的字节位置，增量导入时只读取之后追加的数据
+CREATE TABLE IF NOT EXISTS ingest_log (
+    file_path TEXT PRIMARY KEY,                 -- CSV文件绝对路径
+    byte_offset INTEGER NOT NULL,               -- 已导入的字节数
+    row_count INTEGER NOT NULL,                 -- 已导入的数据行数
+    head_digest TEXT NOT NULL,                  -- 文件开头内容的摘要，用于识别被替换的文件
+    ingested_at DATETIME NOT NULL               -- 最后导入时间
+);
+
+-- ETL状态表，记录增量计算的进度（如LTV已处理到的最大购买ID）
+CREATE TABLE IF NOT EXISTS etl_state (
+    state_key TEXT PRIMARY KEY,                 -- 状态名称
+    state_value INTEGER NOT NULL,               -- 状态值
+    updated_at DATETIME NOT NULL                -- 更新时间
+);
+
+-- 货币汇率历史表，按生效日期记录汇率，收入按事件日期当时有效的汇率换算
+CREATE TABLE IF NOT EXISTS currency_rate_history (
+    currency_code TEXT NOT NULL,                -- 货币代码
+    effective_date DATE NOT NULL,               -- 生效日期
+    rate_to_usd REAL NOT NULL,                  -- 对USD的汇率
+    PRIMARY KEY (currency_code, effective_date)
+);
+
+-- 维度统计登记表，与DIMENSION_STATS一致，供API查找维度对应的统计表
+CREATE TABLE IF NOT EXISTS stats_dimensions (
+    dimension_name TEXT PRIMARY KEY,            -- 维度名称，如media_source、media_source_platform
+    table_name TEXT NOT NULL,                   -- 统计表名
+    dimension_columns TEXT NOT NULL,            -- 维度列，逗号分隔
+    dimension_label TEXT                        -- 中文名称
+);
 """
 
 # 创建索引的SQL语句
@@ -148,11 +289,228 @@ CREATE INDEX IF NOT EXISTS idx_purchases_user ON purchases(appsflyer_id);
 CREATE INDEX IF NOT EXISTS idx_purchases_date ON purchases(created_date);
 CREATE INDEX IF NOT EXISTS idx_purchases_country_device ON purchases(country_code, device_category);
 
+-- LTV表索引
+CREATE INDEX IF NOT EXISTS idx_user_ltv_first_purchase ON user_ltv(first_purchase_date);
+CREATE INDEX IF NOT EXISTS idx_ltv_cohort_stats_window_date ON ltv_cohort_stats(window_days, first_purchase_date);
+
 -- 统计表索引
 CREATE INDEX IF NOT EXISTS idx_country_stats_date ON country_stats(stat_date);
 CREATE INDEX IF NOT EXISTS idx_device_stats_date ON device_stats(stat_date);
 """
 
+# 登记的维度统计：(维度列, 中文名称)。每项生成一张按(统计日期, 维度列)汇总的统计表
+# {维度列}_stats，以及以维度列开头的组合索引，按渠道查询一段日期的曲线时只读取索引范围。
+# 增加维度或维度组合只需在此登记，统计时不会增加对事件表的扫描
+DIMENSION_STATS = [
+    (['media_source'], '媒体来源'),
+    (['platform'], '平台'),
+    (['app_id'], '应用'),
+    (['media_source', 'platform'], '媒体来源-平台'),
+    (['media_source', 'country_code'], '媒体来源-国家'),
+]
+
+# 维度统计表的指标列
+DIMENSION_STATS_MEASURES = [
+    ('user_count', 'INTEGER DEFAULT 0', '用户数'),
+    ('new_user_count', 'INTEGER DEFAULT 0', '新用户数'),
+    ('event_count', 'INTEGER DEFAULT 0', '事件数'),
+    ('purchase_count', 'INTEGER DEFAULT 0', '购买数'),
+    ('revenue_usd', 'REAL DEFAULT 0', 'USD收入'),
+]
+
+# 事件的维度值为空时在维度统计表中计入的值
+UNKNOWN_DIMENSION_VALUE = 'unknown'
+
+def dimension_stats_name(dimension_columns):
+    """维度统计的名称，也是统计表名的前缀"""
+    return '_'.join(dimension_columns)
+
+def dimension_stats_table(dimension_columns):
+    """维度统计表名"""
+    return f"{dimension_stats_name(dimension_columns)}_stats"
+
+def dimension_stats_table_sql(dimension_columns, label):
+    """创建维度统计表的语句"""
+    lines = ["stat_date DATE NOT NULL,                    -- 统计日期"]
+    lines += [f"{column} TEXT NOT NULL,".ljust(44) + "-- 维度列" for column in dimension_columns]
+    lines += [f"{column} {column_type},".ljust(44) + f"-- {comment}" for column, column_type, comment in DIMENSION_STATS_MEASURES]
+    lines.append(f"PRIMARY KEY (stat_date, {', '.join(dimension_columns)})")
+    body = '\n    '.join(lines)
+    return f"""
+-- {label}维度统计表
+CREATE TABLE IF NOT EXISTS {dimension_stats_table(dimension_columns)} (
+    {body}
+);
+"""
+
+def dimension_stats_index_sql(dimension_columns):
+    """维度统计表的组合索引，维度列在前、统计日期在后"""
+    table = dimension_stats_table(dimension_columns)
+    return f"CREATE INDEX IF NOT EXISTS idx_{table}_dimension ON {table}({', '.join(dimension_columns)}, stat_date);\n"
+
+CREATE_TABLES_SQL += ''.join(dimension_stats_table_sql(columns, label) for columns, label in DIMENSION_STATS)
+CREATE_INDEXES_SQL += "\n-- 维度统计表索引\n" + ''.join(
+    dimension_stats_index_sql(columns) for columns, _ in DIMENSION_STATS
+)
+
+# 规范化存储：存储表中重复出现的文本列只保存整数编码，编码与原值记录在每列一张的字典表dict_{列名}中，
+# 数据写入{表名}_coded，同名视图按原列名还原文本，读取events、users、purchases的查询无需修改。
+# users_coded以用户ID编码为主键，users视图的rowid即该编码
+NORMALIZED_COLUMNS = {
+    'events': [
+        'appsflyer_id', 'event_name', 'country_code', 'device_model', 'device_category',
+        'app_id', 'platform', 'media_source', 'event_revenue_currency'
+    ],
+    'users': ['appsflyer_id', 'country_code', 'device_model', 'device_category', 'platform', 'media_source'],
+    'purchases': ['appsflyer_id', 'country_code', 'device_category'],
+}
+DICTIONARY_COLUMNS = list(dict.fromkeys(column for columns in NORMALIZED_COLUMNS.values() for column in columns))
+
+NORMALIZED_TABLES_SQL = """
+-- 规范化存储的事件表，编码列见NORMALIZED_COLUMNS
+CREATE TABLE IF NOT EXISTS events_coded (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    appsflyer_id INTEGER NOT NULL,             -- 用户ID编码
+    event_name INTEGER NOT NULL,               -- 事件名称编码
+    event_value TEXT,                          -- 事件值
+    created_date DATE NOT NULL,                -- 事件日期
+    event_time DATETIME,                       -- 事件时间
+    country_code INTEGER,                      -- 国家代码编码
+    device_model INTEGER,                      -- 设备型号编码
+    device_category INTEGER,                   -- 设备类别编码
+    app_id INTEGER,                            -- 应用ID编码
+    platform INTEGER,                          -- 平台编码
+    media_source INTEGER,                      -- 媒体来源编码
+    event_revenue REAL,                        -- 原始收入金额
+    event_revenue_currency INTEGER,            -- 收入货币类型编码
+    event_revenue_usd REAL,                    -- 统一为USD的收入
+    event_params TEXT,                         -- 事件参数(JSON格式)
+    install_time DATETIME                      -- 安装时间
+);
+
+-- 规范化存储的用户表
+CREATE TABLE IF NOT EXISTS users_coded (
+    appsflyer_id INTEGER PRIMARY KEY,          -- 用户ID编码
+    first_seen_date DATE NOT NULL,             -- 首次出现日期
+    last_seen_date DATE NOT NULL,              -- 最后出现日期
+    country_code INTEGER,                      -- 国家代码编码
+    device_model INTEGER,                      -- 设备型号编码
+    device_category INTEGER,                   -- 设备类别编码
+    platform INTEGER,                          -- 平台编码
+    media_source INTEGER,                      -- 用户来源编码
+    install_time DATETIME                      -- 安装时间
+);
+
+-- 规范化存储的购买表
+CREATE TABLE IF NOT EXISTS purchases_coded (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    appsflyer_id INTEGER NOT NULL,             -- 用户ID编码
+    purchase_time DATETIME NOT NULL,           -- 购买时间
+    created_date DATE NOT NULL,                -- 购买日期
+    country_code INTEGER,                      -- 国家代码编码
+    device_category INTEGER,                   -- 设备类别编码
+    event_revenue_usd REAL NOT NULL,           -- USD收入金额
+    product_id TEXT,                           -- 产品ID
+    order_id TEXT,                             -- 订单ID
+    purchase_key TEXT UNIQUE,                  -- 购买唯一标识(用户ID_订单ID_购买时间)，用于跨批次去重
+    FOREIGN KEY (appsflyer_id) REFERENCES users_coded(appsflyer_id)
+);
+""" + ''.join(f"""
+CREATE TABLE IF NOT EXISTS dict_{column} (
+    code INTEGER PRIMARY KEY,                   -- 编码，从1开始连续分配
+    value TEXT NOT NULL UNIQUE                  -- 原值
+);
+""" for column in DICTIONARY_COLUMNS)
+
+def dictionary_table(column):
+    """编码列的字典表名"""
+    return f"dict_{column}"
+
+def coded_table(table):
+    """规范化存储时保存编码的表名"""
+    return f"{table}_coded"
+
+def is_normalized(cursor):
+    """数据库是否使用规范化存储（events为视图）"""
+    row = cursor.execute("SELECT type FROM sqlite_master WHERE name = 'events'").fetchone()
+    return row is not None and row[0] == 'view'
+
+def storage_table(table, normalized):
+    """存储表实际写入的表名"""
+    return coded_table(table) if normalized else table
+
+def storage_view_sql(cursor, table):
+    """还原原列名和文本值的视图
+    
+    用户ID通过LEFT JOIN字典表还原，按用户ID连接其他表时可使用字典表和编码列的索引；
+    其余编码列用标量子查询还原，查询未用到的列不会读取字典表。
+    """
+    columns, joins = [], []
+    for _, column, *_ in cursor.execute(f"PRAGMA table_info({coded_table(table)})").fetchall():
+        if column == 'appsflyer_id':
+            columns.append(f"d.value AS {column}")
+            joins.append(f"LEFT JOIN {dictionary_table(column)} d ON d.code = t.{column}")
+        elif column in NORMALIZED_COLUMNS[table]:
+            columns.append(f"(SELECT value FROM {dictionary_table(column)} WHERE code = t.{column}) AS {column}")
+        else:
+            columns.append(f"t.{column}")
+    if table == 'users':
+        columns.append("t.appsflyer_id AS rowid")
+    return f"CREATE VIEW {table} AS SELECT {', '.join(columns)} FROM {coded_table(table)} t {' '.join(joins)}"
+
+def set_storage_layout(cursor, normalized):
+    """将存储表切换为规范化存储（normalized为True）或原始存储，原有的事件、用户和购买数据全部删除
+
+    可在事务中执行。原存储表已有二级索引时同时为新的表创建索引，否则（批量导入延后创建索引）
+    仍由finish_bulk_load创建。
+    """
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE name = 'idx_events_created_date')")
+    with_indexes = cursor.fetchone()[0]
+    drop_tables = [coded_table(table) for table in STORAGE_TABLES] + [dictionary_table(column) for column in DICTIONARY_COLUMNS]
+    for table in STORAGE_TABLES:
+        cursor.execute("SELECT type FROM sqlite_master WHERE name = ?", (table,))
+        row = cursor.fetchone()
+        if row is not None:
+            cursor.execute(f"DROP {row[0].upper()} {table}")
+    for table in drop_tables:
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    cursor.execute(
+        f"DELETE FROM sqlite_sequence WHERE name IN ({', '.join('?' * len(STORAGE_TABLES) * 2)})",
+        STORAGE_TABLES + [coded_table(table) for table in STORAGE_TABLES]
+    )
+
+    statements = (NORMALIZED_TABLES_SQL if normalized else STORAGE_TABLES_SQL).split(';')
+    for statement in statements:
+        if statement.strip():
+            cursor.execute(statement)
+    if normalized:
+        for table in STORAGE_TABLES:
+            cursor.execute(storage_view_sql(cursor, table))
+    if with_indexes:
+        create_indexes(cursor)
+
+def storage_index_sql(statement, normalized):
+    """规范化存储时，存储表的索引建在对应的编码表上"""
+    if normalized:
+        for table in STORAGE_TABLES:
+            statement = statement.replace(f" ON {table}(", f" ON {coded_table(table)}(")
+    return statement
+
+# 批量导入时的连接设置：WAL日志、不等待数据落盘、256MB页缓存、临时数据放在内存
+# 导入中断时数据库可能损坏，需重新全量导入
+BULK_LOAD_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA cache_size = -262144",
+    "PRAGMA temp_store = MEMORY",
+]
+
+# 批量导入完成后恢复的持久化设置
+DURABLE_PRAGMAS = [
+    "PRAGMA journal_mode = DELETE",
+    "PRAGMA synchronous = FULL",
+]
+
 # 初始货币汇率数据
 CURRENCY_RATES = [
     ('USD', 1.0),
@@ -174,45 +532,257 @@ CURRENCY_RATES = [
     ('VND', 0.000044)
 ]
 
-def create_database():
-    """创建SQLite数据库和所有必要的表结构"""
+# 初始汇率的生效日期，早于所有事件日期
+INITIAL_RATES_EFFECTIVE_DATE = '1970-01-01'
+
+# 新建数据库时登记的LTV窗口天数，已登记的窗口不会重复插入
+DEFAULT_LTV_WINDOW_DAYS = [1, 3, 7, 14, 30, 60, 90, 120, 180]
+
+def migrate_schema(cursor):
+    """为旧版本创建的数据库补充新增的列"""
+    purchase_columns = [row[1] for row in cursor.execute("PRAGMA table_info(purchases)")]
+    if 'purchase_key' not in purchase_columns:
+        # ALTER TABLE不能添加UNIQUE列，唯一性改由唯一索引保证
+        logger.info("为purchases表添加purchase_key列")
+        cursor.execute("ALTER TABLE purchases ADD COLUMN purchase_key TEXT")
+        cursor.execute("""
+        UPDATE purchases
+        SET purchase_key = appsflyer_id || '_' || COALESCE(order_id, '') || '_' || purchase_time
+        """)
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_purchases_key ON purchases(purchase_key)")
+
+def connect_database(db_file, bulk_load=False):
+    """连接数据库，bulk_load为True时使用批量导入的连接设置
+    
+    连接不使用sqlite3模块的隐式事务，事务由各处理步骤通过begin_stage等函数控制。
+    """
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    if bulk_load:
+        for pragma in BULK_LOAD_PRAGMAS:
+            conn.execute(pragma)
+    return conn
+
+def get_etl_state(cursor, state_key, default=None):
+    """读取增量计算的进度"""
+    cursor.execute("SELECT state_value FROM etl_state WHERE state_key = ?", (state_key,))
+    row = cursor.fetchone()
+    return row[0] if row else default
+
+def set_etl_state(cursor, state_key, state_value):
+    """记录增量计算的进度"""
+    cursor.execute(
+        "INSERT OR REPLACE INTO etl_state (state_key, state_value, updated_at) VALUES (?, ?, ?)",
+        (state_key, state_value, datetime.now().isoformat())
+    )
+
+def begin_stage(conn, name):
+    """开始处理步骤：没有外层事务时开启事务，在外层事务中时创建保存点"""
+    conn.execute(f"SAVEPOINT {name}")
+
+def commit_stage(conn, name):
+    """提交处理步骤，在外层事务中时修改随外层事务一起提交"""
+    conn.execute(f"RELEASE {name}")
+
+def rollback_stage(conn, name):
+    """撤销处理步骤的全部修改，外层事务中之前步骤的修改不受影响"""
+    if conn.in_transaction:
+        conn.execute(f"ROLLBACK TO {name}")
+        conn.execute(f"RELEASE {name}")
+
+def create_indexes(cursor):
+    """逐条执行CREATE_INDEXES_SQL，可在事务中执行（executescript会先提交当前事务）"""
+    normalized = is_normalized(cursor)
+    for statement in CREATE_INDEXES_SQL.split(';'):
+        if statement.strip():
+            cursor.execute(storage_index_sql(statement, normalized))
+
+def create_index(cursor, index_name):
+    """只创建CREATE_INDEXES_SQL中名为index_name的索引，可在事务中执行"""
+    normalized = is_normalized(cursor)
+    for statement in CREATE_INDEXES_SQL.split(';'):
+        if f" {index_name} " in statement:
+            cursor.execute(storage_index_sql(statement, normalized))
+
+def restore_durable_settings(conn):
+    """恢复持久化设置，需在事务之外执行"""
+    for pragma in DURABLE_PRAGMAS:
+        conn.execute(pragma)
+
+def finish_bulk_load(db_file=None, conn=None):
+    """批量导入完成后创建索引并更新查询优化统计信息
+    
+    未传入conn时使用独立连接执行并随后恢复持久化设置；传入共享连接时在其当前事务中执行，
+    由调用方在事务提交后调用restore_durable_settings。
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = connect_database(db_file or DB_FILE, bulk_load=True)
+    try:
+        begin_stage(conn, 'finish_bulk_load')
+        try:
+            logger.info("创建数据库索引")
+            create_indexes(conn)
+            logger.info("更新查询优化统计信息")
+            conn.execute("ANALYZE")
+            commit_stage(conn, 'finish_bulk_load')
+        except Exception:
+            rollback_stage(conn, 'finish_bulk_load')
+            raise
+        if own_conn:
+            restore_durable_settings(conn)
+    finally:
+        if own_conn:
+            conn.close()
+
+# 配置表（由用户维护）和可复用的缓存表（设备型号分类），内容不由导入的数据重新生成，
+# 全量重建时从现有数据库复制到新数据库
+CONFIG_TABLES = ['ltv_windows', 'currency_rate_history', 'currency_rates', 'device_categories']
+
+def copy_config_tables(conn, source_db_file):
+    """将source_db_file中的配置表复制到conn的数据库，替换新建数据库中的默认内容
+    
+    只复制两边都有的列，source_db_file中没有的表保持默认内容。
+    conn不能处于事务中（ATTACH不能在事务中执行）。
+    """
+    conn.execute("ATTACH DATABASE ? AS config_source", (source_db_file,))
+    try:
+        begin_stage(conn, 'copy_config_tables')
+        try:
+            for table in CONFIG_TABLES:
+                source_columns = {row[1] for row in conn.execute(f"PRAGMA config_source.table_info({table})")}
+                if not source_columns:
+                    continue
+                columns = ', '.join(
+                    row[1] for row in conn.execute(f"PRAGMA main.table_info({table})") if row[1] in source_columns
+                )
+                conn.execute(f"DELETE FROM main.{table}")
+                conn.execute(f"INSERT INTO main.{table} ({columns}) SELECT {columns} FROM config_source.{table}")
+            commit_stage(conn, 'copy_config_tables')
+        except Exception:
+            rollback_stage(conn, 'copy_config_tables')
+            raise
+    finally:
+        conn.execute("DETACH DATABASE config_source")
+
+def sync_current_rates(cursor):
+    """由汇率历史更新当前汇率表，每种货币取最新生效的汇率，汇率未变的货币不更新"""
+    cursor.execute("""
+    INSERT OR REPLACE INTO currency_rates (currency_code, rate_to_usd, last_updated)
+    SELECT h.currency_code, h.rate_to_usd, ?
+    FROM currency_rate_history h
+    WHERE h.effective_date = (
+        SELECT MAX(effective_date) FROM currency_rate_history WHERE currency_code = h.currency_code
+    )
+    AND NOT EXISTS (
+        SELECT 1 FROM currency_rates r WHERE r.currency_code = h.currency_code AND r.rate_to_usd = h.rate_to_usd
+    )
+    """, (datetime.now().isoformat(),))
+
+def update_currency_rate(cursor, currency, rate, effective_date):
+    """记录自effective_date起生效的新汇率，之前日期的收入仍按旧汇率换算"""
+    cursor.execute(
+        "INSERT OR REPLACE INTO currency_rate_history (currency_code, effective_date, rate_to_usd) VALUES (?, ?, ?)",
+        (currency, effective_date, rate)
+    )
+    # 当前汇率表只保留最新生效的汇率
+    sync_current_rates(cursor)
+
+def create_database(db_file=None, with_indexes=True, conn=None, config_db_file=None):
+    """创建SQLite数据库和所有必要的表结构
+    
+    with_indexes为False时只创建表，二级索引在批量导入完成后由finish_bulk_load创建。
+    传入conn时使用该连接，且不能处于事务中（executescript会先提交当前事务）。
+    config_db_file不为None时先从该数据库复制配置表，再补充缺少的默认数据。
+    """
+    own_conn = conn is None
     try:
         # 连接到数据库（如果不存在则创建）
-        logger.info(f"正在创建数据库: {DB_FILE}")
-        conn = sqlite3.connect(DB_FILE)
+        if own_conn:
+            db_file = db_file or DB_FILE
+            logger.info(f"正在创建数据库: {db_file}")
+            conn = connect_database(db_file)
         cursor = conn.cursor()
         
-        # 启用外键约束
-        cursor.execute("PRAGMA foreign_keys = ON;")
+        # 启用外键约束，共享连接上后续步骤会先写入购买再写入用户，因此不启用
+        if own_conn:
+            cursor.execute("PRAGMA foreign_keys = ON;")
         
         # 创建表
         logger.info("创建数据库表")
         cursor.executescript(CREATE_TABLES_SQL)
+        migrate_schema(cursor)
         
         # 创建索引
-        logger.info("创建数据库索引")
-        cursor.executescript(CREATE_INDEXES_SQL)
+        if with_indexes:
+            logger.info("创建数据库索引")
+            create_indexes(cursor)
+        
+        # 复制现有数据库中的配置表
+        if config_db_file:
+            logger.info(f"从 {config_db_file} 复制配置表: {', '.join(CONFIG_TABLES)}")
+            copy_config_tables(conn, config_db_file)
         
         # 插入初始货币汇率数据
         logger.info("初始化货币汇率数据")
-        now = datetime.now().isoformat()
-        for currency, rate in CURRENCY_RATES:
-            cursor.execute(
-                "INSERT OR REPLACE INTO currency_rates (currency_code, rate_to_usd, last_updated) VALUES (?, ?, ?)",
-                (currency, rate, now)
+        begin_stage(conn, 'create_database')
+        # 已有的汇率历史不覆盖，避免历史收入随汇率更新而变化；当前汇率取自最新的汇率历史，不被初始汇率覆盖
+        cursor.executemany(
+            "INSERT OR IGNORE INTO currency_rate_history (currency_code, effective_date, rate_to_usd) VALUES (?, ?, ?)",
+            [(currency, INITIAL_RATES_EFFECTIVE_DATE, rate) for currency, rate in CURRENCY_RATES]
+        )
+        sync_current_rates(cursor)
+        
+        # 登记默认的LTV窗口，只在窗口登记表为空时插入，不恢复已删除的窗口
+        cursor.execute("SELECT COUNT(*) FROM ltv_windows")
+        if cursor.fetchone()[0] == 0:
+            cursor.executemany(
+                "INSERT INTO ltv_windows (window_days, window_name) VALUES (?, ?)",
+                [(days, f"{days}d") for days in DEFAULT_LTV_WINDOW_DAYS]
             )
         
+        # 维度统计登记表与DIMENSION_STATS保持一致
+        cursor.execute("DELETE FROM stats_dimensions")
+        cursor.executemany(
+            "INSERT INTO stats_dimensions (dimension_name, table_name, dimension_columns, dimension_label) VALUES (?, ?, ?, ?)",
+            [
+                (dimension_stats_name(columns), dimension_stats_table(columns), ','.join(columns), label)
+                for columns, label in DIMENSION_STATS
+            ]
+        )
+        
         # 提交事务
-        conn.commit()
+        commit_stage(conn, 'create_database')
         logger.info("数据库创建成功")
         
     except sqlite3.Error as e:
         logger.error(f"数据库创建失败: {e}")
         raise
     finally:
-        if conn:
+        if own_conn and conn:
             conn.close()
 
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="数据库创建脚本")
+    parser.add_argument(
+        "--set-rate", nargs=3, action="append", metavar=("CURRENCY", "RATE", "EFFECTIVE_DATE"),
+        help="记录自EFFECTIVE_DATE（YYYY-MM-DD）起生效的CURRENCY对USD的汇率（可多次指定），"
+             "之后导入的该日期及以后的收入按新汇率换算"
+    )
+    return parser.parse_args()
+
 if __name__ == "__main__":
+    args = parse_args()
     create_database()
-    logger.info(f"数据库文件位置: {DB_FILE}") 
\ No newline at end of file
+    logger.info(f"数据库文件位置: {DB_FILE}")
+    if args.set_rate:
+        conn = connect_database(DB_FILE)
+        try:
+            begin_stage(conn, 'set_rate')
+            for currency, rate, effective_date in args.set_rate:
+                effective_date = datetime.strptime(effective_date, '%Y-%m-%d').strftime('%Y-%m-%d')
+                update_currency_rate(conn.cursor(), currency.upper(), float(rate), effective_date)
+                logger.info(f"已记录汇率: {currency.upper()} = {rate} USD，自 {effective_date} 起生效")
+            commit_stage(conn, 'set_rate')
+        finally:
+            conn.close() 
\ No newline at end of file
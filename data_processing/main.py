@@ -10,16 +10,23 @@ import os
 import sys
 import logging
 import time
+import shutil
 import sqlite3
+import argparse
 from pathlib import Path
 
 # 确保当前目录在导入路径中
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # 导入处理模块
-from data_processing.create_database import create_database
-from data_processing.process_data import process_csv_data
-from data_processing.calculate_ltv import calculate_ltv, generate_daily_stats
+from data_processing.create_database import (
+    connect_database, create_database, finish_bulk_load, is_normalized, restore_durable_settings, storage_table
+)
+from data_processing.process_data import process_csv_data, CHUNK_SIZE, EVENT_PAYLOAD_MODES
+from data_processing.calculate_ltv import (
+    LTV_WATERMARK_KEY, calculate_ltv, check_ltv_consistency, generate_daily_stats, get_etl_state
+)
+from data_processing.staging import clear_staging, prune_staging, staging_dir_for
 
 # 配置日志
 logging.basicConfig(
@@ -36,18 +43,28 @@ ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DB_DIR = os.path.join(ROOT_DIR, 'database')
 DB_FILE = os.path.join(DB_DIR, 'app.db')
 
-def reset_database():
-    """重置数据库，完全删除并重新创建数据库文件"""
+# 重建时先写入影子数据库，验证通过后整体替换DB_FILE，API服务始终读取完整的数据库
+SHADOW_DB_FILE = DB_FILE + '.building'
+# 替换前的数据库保留为备份，用于回滚
+BACKUP_DB_FILE = DB_FILE + '.bak'
+# SQLite数据库文件的附属文件后缀
+DB_SIDECAR_SUFFIXES = ['-journal', '-wal', '-shm']
+
+def reset_database(db_file=None):
+    """重置数据库，完全删除数据库文件及其日志文件和暂存区"""
+    db_file = db_file or DB_FILE
     logger.info("重置数据库...")
+    clear_staging(staging_dir_for(db_file))
     
     # 如果数据库文件存在，先删除它
-    if os.path.exists(DB_FILE):
-        try:
-            os.remove(DB_FILE)
-            logger.info(f"已删除现有数据库文件: {DB_FILE}")
-        except Exception as e:
-            logger.error(f"删除数据库文件失败: {e}")
-            raise
+    for path in [db_file] + [db_file + suffix for suffix in DB_SIDECAR_SUFFIXES]:
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+                logger.info(f"已删除现有数据库文件: {path}")
+            except Exception as e:
+                logger.error(f"删除数据库文件失败: {e}")
+                raise
     
     # 确保数据库目录存在
     if not os.path.exists(DB_DIR):
@@ -56,52 +73,255 @@ def reset_database():
     
     logger.info("数据库重置完成")
 
-def main():
-    """执行所有数据处理步骤"""
+def prepare_shadow_database():
+    """准备影子数据库，删除上次失败遗留的影子数据库，全量重建在新建的影子数据库中进行"""
+    reset_database(SHADOW_DB_FILE)
+
+def validate_database(conn):
+    """替换前验证影子数据库，验证失败时抛出异常"""
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA quick_check")
+    result = cursor.fetchone()[0]
+    if result != 'ok':
+        raise RuntimeError(f"数据库完整性检查失败: {result}")
+    cursor.execute(f"SELECT COUNT(*) FROM {storage_table('events', is_normalized(cursor))}")
+    if cursor.fetchone()[0] == 0:
+        raise RuntimeError("数据库中没有事件数据")
+    if not check_ltv_consistency(conn=conn):
+        raise RuntimeError("LTV数据与购买记录不一致")
+
+def validate_update(conn, after_purchase_id):
+    """提交增量更新前验证本次修改的数据，验证失败时抛出异常，全部修改随事务回滚
+    
+    只检查after_purchase_id之后有新购买的用户的LTV及其同期群，不做全库完整性检查和全量LTV重算，
+    验证开销与新增数据量相关。
+    """
+    if not check_ltv_consistency(conn=conn, after_purchase_id=after_purchase_id):
+        raise RuntimeError("本次更新的LTV数据与购买记录不一致")
+
+def link_or_copy(source, target):
+    """创建硬链接，文件系统不支持硬链接时复制"""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+def replace_staging(source_db_file, target_db_file):
+    """将source_db_file的暂存区移动为target_db_file的暂存区"""
+    clear_staging(staging_dir_for(target_db_file))
+    if os.path.exists(staging_dir_for(source_db_file)):
+        os.replace(staging_dir_for(source_db_file), staging_dir_for(target_db_file))
+
+def swap_database():
+    """用影子数据库替换DB_FILE，原数据库保留为备份
+    
+    备份通过硬链接创建，替换通过重命名完成，DB_FILE路径始终指向一个完整的数据库；
+    已打开旧文件的连接继续读取旧数据，API服务检测到文件被替换后重新打开
+    """
+    if os.path.exists(DB_FILE):
+        if os.path.exists(BACKUP_DB_FILE):
+            os.remove(BACKUP_DB_FILE)
+        link_or_copy(DB_FILE, BACKUP_DB_FILE)
+    os.replace(SHADOW_DB_FILE, DB_FILE)
+    # 暂存区随数据库一起替换
+    replace_staging(DB_FILE, BACKUP_DB_FILE)
+    replace_staging(SHADOW_DB_FILE, DB_FILE)
+    logger.info(f"已替换数据库文件: {DB_FILE}，原数据库备份为 {BACKUP_DB_FILE}")
+
+def rollback_database():
+    """用上次替换前的备份恢复DB_FILE"""
+    if not os.path.exists(BACKUP_DB_FILE):
+        raise FileNotFoundError(f"备份数据库不存在: {BACKUP_DB_FILE}")
+    os.replace(BACKUP_DB_FILE, DB_FILE)
+    replace_staging(BACKUP_DB_FILE, DB_FILE)
+    logger.info(f"已从备份恢复数据库: {DB_FILE}")
+
+def run_pipeline(conn, stages, atomic=False):
+    """在共享连接上依次执行各处理步骤
+    
+    stages为(步骤说明, 步骤函数)列表，步骤函数接收共享连接。atomic为True时所有步骤在同一事务中执行，
+    每个步骤是其中的一个保存点，任一步骤失败时回滚全部修改，数据库保持执行前的状态；
+    否则每个步骤完成后单独提交。
+    """
+    if atomic:
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        for description, stage in stages:
+            logger.info(description)
+            stage(conn)
+        if atomic:
+            conn.execute("COMMIT")
+    except Exception:
+        if atomic and conn.in_transaction:
+            conn.execute("ROLLBACK")
+            logger.error("处理失败，已回滚本次全部修改，数据库保持处理前的状态")
+        raise
+
+def main(chunksize=None, incremental=False, csv_files=None, workers=1, bulk_load=False, atomic=False,
+         staging=False, normalized=None, event_payloads='inline'):
+    """执行所有数据处理步骤
+    
+    chunksize: 流式读取CSV时每块的行数，为None时一次性读取整个文件
+    incremental: 保留现有数据库，只导入CSV文件中新追加的数据，并只更新受影响的LTV和统计数据；
+                 总是直接在DB_FILE上于同一事务中执行，提交前只验证本次更新的数据
+    csv_files: 要导入的CSV文件列表，为None时使用默认数据文件
+    workers: 并行清洗CSV数据的工作进程数，为1时在主进程中串行处理
+    bulk_load: 批量导入模式，导入期间使用WAL日志、关闭同步并延后创建二级索引，
+               完成后创建索引、执行ANALYZE并恢复持久化设置
+    atomic: 全量重建时直接在DB_FILE上于同一事务中完成全部步骤，失败时数据库保持原状；
+            否则在影子数据库中完成全部步骤，验证通过后替换DB_FILE
+    staging: 导入时将清洗后的数据写入Parquet暂存区，全量计算LTV和统计数据时从暂存区读取
+    normalized: 全量导入时切换存储方式，True为规范化存储（文本维度列保存为字典编码），False为原始存储，
+                None时保持DB_FILE当前的存储方式
+    event_payloads: 本次导入的事件event_value、event_params的保存方式，inline保存在事件表中，
+                    compressed分块压缩后保存在event_payloads表中，skip不保存
+    """
     start_time = time.time()
+    conn = None
     
     try:
-        # 步骤0: 重置数据库（删除现有数据库文件）
-        logger.info("步骤0: 重置数据库")
-        reset_database()
+        # 步骤0: 准备数据库。增量导入和单事务模式直接在现有数据库上于同一事务中修改，
+        # 增量导入无需复制整个数据库；全量重建默认写入影子数据库
+        if incremental or atomic:
+            atomic = True
+            logger.info("步骤0: 单事务模式，提交前保留现有数据")
+            db_file = DB_FILE
+        else:
+            logger.info("步骤0: 准备影子数据库")
+            # 影子数据库为新建的数据库，未指定存储方式时沿用DB_FILE的存储方式
+            if normalized is None and os.path.exists(DB_FILE):
+                live_conn = sqlite3.connect(DB_FILE)
+                try:
+                    normalized = is_normalized(live_conn)
+                finally:
+                    live_conn.close()
+            prepare_shadow_database()
+            db_file = SHADOW_DB_FILE
         
-        # 步骤1: 创建数据库
-        logger.info("步骤1: 创建数据库")
-        create_database()
+        # 所有步骤共用一个连接
+        conn = connect_database(db_file, bulk_load)
         
-        # 步骤2: 处理CSV数据
-        logger.info("步骤2: 处理CSV数据")
-        process_csv_data()
+        # 步骤1: 创建数据库（表已存在时只补充缺少的表、列和索引），批量导入时延后创建索引
+        # 建表语句会提交当前事务，因此在其余步骤的事务之外执行
+        logger.info("步骤1: 创建数据库")
+        # 全量重建的影子数据库为新建的数据库，配置表（如登记的LTV窗口、汇率历史）沿用DB_FILE中的内容
+        rebuild_from_live = db_file == SHADOW_DB_FILE and not incremental and os.path.exists(DB_FILE)
+        create_database(with_indexes=not bulk_load, conn=conn, config_db_file=DB_FILE if rebuild_from_live else None)
         
-        # 步骤3: 计算用户LTV
-        logger.info("步骤3: 计算用户LTV")
-        calculate_ltv()
+        stages = [
+            ("步骤2: 处理CSV数据", lambda conn: process_csv_data(
+                chunksize=chunksize, incremental=incremental, csv_files=csv_files, workers=workers, conn=conn,
+                staging=staging, normalized=normalized, event_payloads=event_payloads
+            )),
+            ("步骤3: 计算用户LTV", lambda conn: calculate_ltv(
+                incremental=incremental, conn=conn, from_staging=staging
+            )),
+            ("步骤4: 生成汇总统计数据", lambda conn: generate_daily_stats(
+                incremental=incremental, conn=conn, from_staging=staging
+            )),
+        ]
+        if bulk_load:
+            stages.append(("步骤5: 创建索引并更新查询优化统计信息", lambda conn: finish_bulk_load(conn=conn)))
+        # 增量导入在提交前只验证本次更新的数据
+        if incremental:
+            ltv_watermark = get_etl_state(conn.cursor(), LTV_WATERMARK_KEY, 0)
+            stages.append(("步骤6: 验证本次更新的数据", lambda conn: validate_update(conn, ltv_watermark)))
+        run_pipeline(conn, stages, atomic)
+        # 提交后删除被本次导入替换的暂存数据
+        prune_staging(conn)
         
-        # 步骤4: 生成汇总统计数据
-        logger.info("步骤4: 生成汇总统计数据")
-        generate_daily_stats()
+        # 批量导入完成后恢复持久化设置
+        if bulk_load:
+            restore_durable_settings(conn)
         
         # 验证数据一致性
         logger.info("验证数据一致性...")
-        conn = sqlite3.connect(DB_FILE)
         cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM events")
+        normalized = is_normalized(cursor)
+        cursor.execute(f"SELECT COUNT(*) FROM {storage_table('events', normalized)}")
         event_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM users")
+        cursor.execute(f"SELECT COUNT(*) FROM {storage_table('users', normalized)}")
         user_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM purchases")
+        cursor.execute(f"SELECT COUNT(*) FROM {storage_table('purchases', normalized)}")
         purchase_count = cursor.fetchone()[0]
-        conn.close()
         
         logger.info(f"数据验证结果: 事件数={event_count}, 用户数={user_count}, 购买数={purchase_count}")
         
+        # 步骤6: 验证影子数据库并替换DB_FILE
+        if not atomic:
+            logger.info("步骤6: 验证并替换数据库")
+            validate_database(conn)
+            conn.close()
+            conn = None
+            swap_database()
+        
         # 计算总耗时
         elapsed_time = time.time() - start_time
         logger.info(f"数据处理完成! 总耗时: {elapsed_time:.2f} 秒")
         
     except Exception as e:
         logger.error(f"数据处理过程中出错: {e}")
+        if not atomic:
+            logger.error(f"数据库文件未替换，影子数据库保留在 {SHADOW_DB_FILE}")
         sys.exit(1)
+    finally:
+        if conn:
+            conn.close()
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="数据处理主脚本")
+    parser.add_argument(
+        "--chunksize", type=int, nargs="?", const=CHUNK_SIZE, default=None,
+        help=f"流式读取CSV，每块读取的行数（不指定数值时为{CHUNK_SIZE}）"
+    )
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="增量导入，直接在现有数据库上于同一事务中只处理CSV文件中尚未导入的数据，提交前只验证本次更新的数据"
+    )
+    parser.add_argument(
+        "--csv", dest="csv_files", action="append", metavar="FILE",
+        help="要导入的CSV文件，可多次指定（默认为后端考核/test.csv）"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="并行清洗CSV数据的工作进程数（默认1，即串行处理；大于1时按块读取）"
+    )
+    parser.add_argument(
+        "--bulk-load", action="store_true",
+        help="批量导入模式：导入期间放宽持久化设置并延后创建索引，适合全量重建"
+    )
+    parser.add_argument(
+        "--atomic", action="store_true",
+        help="全量重建时直接在现有数据库上于同一事务中完成全部步骤，不使用影子数据库，任一步骤失败时数据库保持原状"
+    )
+    parser.add_argument(
+        "--staging", action="store_true",
+        help="将清洗后的数据按日期分区写入Parquet暂存区（需要pyarrow），LTV和统计数据从暂存区读取所需的列"
+    )
+    parser.add_argument(
+        "--normalized", action=argparse.BooleanOptionalAction, default=None,
+        help="全量导入时使用规范化存储：事件、用户和购买表的文本维度列保存为字典编码，通过同名视图读取；"
+             "--no-normalized切换回原始存储；都不指定时保持数据库当前的存储方式"
+    )
+    parser.add_argument(
+        "--event-payloads", choices=EVENT_PAYLOAD_MODES, default='inline',
+        help="事件event_value、event_params的保存方式：inline保存在事件表中（默认），"
+             "compressed分块压缩后保存在event_payloads表中，skip不保存"
+    )
+    parser.add_argument(
+        "--rollback", action="store_true",
+        help="用上次替换前的备份恢复数据库后退出"
+    )
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    args = parse_args()
+    if args.rollback:
+        rollback_database()
+        sys.exit(0)
+    main(
+        chunksize=args.chunksize, incremental=args.incremental, csv_files=args.csv_files,
+        workers=args.workers, bulk_load=args.bulk_load, atomic=args.atomic, staging=args.staging,
+        normalized=args.normalized, event_payloads=args.event_payloads
+    ) 
\ No newline at end of file
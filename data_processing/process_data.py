@@ -7,14 +7,43 @@
 """
 
 import os
+import sys
 import json
-import sqlite3
+import zlib
+import mmap
+import hashlib
 import logging
 import pandas as pd
 import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+from dateutil.tz import tzlocal
 from pathlib import Path
 
+# 确保当前目录在导入路径中
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_processing.create_database import (
+    DICTIONARY_COLUMNS, NORMALIZED_COLUMNS, STORAGE_TABLES, begin_stage, commit_stage, connect_database,
+    dictionary_table, is_normalized, rollback_stage, set_storage_layout, storage_table
+)
+from data_processing.staging import (
+    STAGING_TABLES, begin_staging_generation, connection_staging_dir, current_staging_dir, mark_staged,
+    prune_staging, remove_staging_files, staging_available, write_staging
+)
+
+# JSON解析后端：优先使用更快的orjson或ujson，均未安装时使用标准库json
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        json_loads = ujson.loads
+    except ImportError:
+        json_loads = json.loads
+
 # 固定随机种子，确保每次运行结果一致
 np.random.seed(42)
 if hasattr(pd, 'set_option'):
@@ -37,6 +66,110 @@ CSV_FILE = os.path.join(ROOT_DIR, '后端考核', 'test.csv')
 DB_DIR = os.path.join(ROOT_DIR, 'database')
 DB_FILE = os.path.join(DB_DIR, 'app.db')
 
+# 流式处理模式下每块读取的行数
+CHUNK_SIZE = 100000
+
+# 写入数据库的日期时间格式
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+DATE_FORMAT = '%Y-%m-%d'
+
+# 可整批解析的日期时间格式，与clean_datetime中不带时区的格式对应
+FAST_DATETIME_FORMATS = [
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d',
+]
+
+# 并行清洗时每个工作进程最多排队的数据块数，限制内存中等待写入的数据量
+PENDING_CHUNKS_PER_WORKER = 2
+
+# 生成事件插入记录时每批转换的行数
+EVENT_BATCH_SIZE = 50000
+
+# 需要解析event_value提取产品ID的事件
+PRODUCT_EVENT_NAMES = ['af_purchase']
+
+# event_value中没有af_content_id时依次检查的产品ID字段
+PRODUCT_ID_COLUMNS = ['af_content_id', 'product_id', 'sku']
+
+# 按文本读取的列，避免不同数据块推断出不同的类型（如含空值时ID被读成浮点数）
+CSV_DTYPES = {
+    'appsflyer_id': str,
+    'app_id': str,
+    'event_name': str,
+    'event_value': str,
+    'event_time': str,
+    'install_time': str,
+    'country_code': str,
+    'device_model': str,
+    'platform': str,
+    'media_source': str,
+    'event_revenue_currency': str,
+    'order_id': str,
+}
+
+# 用户写入语句，已存在的用户只合并首末出现日期，保留首条记录的属性
+UPSERT_USERS_SQL = """
+INSERT INTO users 
+(appsflyer_id, first_seen_date, last_seen_date, 
+ country_code, device_model, device_category, 
+ platform, media_source, install_time)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(appsflyer_id) DO UPDATE SET
+    first_seen_date = MIN(first_seen_date, excluded.first_seen_date),
+    last_seen_date = MAX(last_seen_date, excluded.last_seen_date)
+"""
+
+# 用户汇总状态中取自首条记录的属性列
+USER_ATTRIBUTE_COLUMNS = [
+    'country_code', 'device_model', 'device_category',
+    'platform', 'media_source', 'install_time'
+]
+USER_STATE_COLUMNS = ['first_seen_date', 'last_seen_date'] + USER_ATTRIBUTE_COLUMNS
+
+INSERT_EVENTS_SQL = """
+INSERT INTO events 
+(appsflyer_id, event_name, event_value, 
+ created_date, event_time, country_code, 
+ device_model, device_category, app_id, 
+ platform, media_source, event_revenue, 
+ event_revenue_currency, event_revenue_usd, 
+ event_params, install_time)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# 购买写入语句，purchase_key已存在的购买（包括之前批次导入的）会被忽略
+INSERT_PURCHASES_SQL = """
+INSERT OR IGNORE INTO purchases 
+(appsflyer_id, purchase_time, created_date, 
+ country_code, device_category, event_revenue_usd, 
+ product_id, order_id, purchase_key)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+INSERT_EVENT_PAYLOADS_SQL = """
+INSERT INTO event_payloads (first_event_id, payload)
+VALUES (?, ?)
+"""
+
+# 事件原始载荷（event_value、event_params）的保存方式：inline保存在事件表中；compressed分块压缩后
+# 保存在event_payloads表中，事件表中两列为空；skip不保存。统计和LTV计算都不读取这两列
+EVENT_PAYLOAD_MODES = ['inline', 'compressed', 'skip']
+EVENT_PAYLOAD_COLUMNS = ['event_value', 'event_params']
+
+# 每个载荷块包含的连续事件数。单个事件的载荷只有几十字节，逐条压缩反而变大，
+# 相邻事件的载荷高度重复，成块压缩才能显著缩小
+EVENT_PAYLOAD_BLOCK_SIZE = 1000
+
+# 读取事件载荷时每次查询的事件ID数
+EVENT_PAYLOAD_QUERY_SIZE = 500
+
+# 查找文件中最后一个换行符时每次向前读取的字节数
+LINE_END_SCAN_BYTES = 65536
+
+# 计算文件摘要时读取的文件开头字节数
+HEAD_DIGEST_BYTES = 65536
+
 def extract_device_category(device_model):
     """从设备型号中提取设备类别"""
     if not device_model or pd.isna(device_model):
@@ -55,6 +188,153 @@ def extract_device_category(device_model):
     else:
         return device_model.split('::')[0] if '::' in device_model else 'mobile_phone'
 
+def load_device_categories(cursor):
+    """读取已缓存的设备型号分类结果"""
+    cursor.execute("SELECT device_model, device_category FROM device_categories")
+    return dict(cursor.fetchall())
+
+def save_device_categories(cursor, device_categories):
+    """缓存新的设备型号分类结果"""
+    cursor.executemany(
+        "INSERT OR IGNORE INTO device_categories (device_model, device_category) VALUES (?, ?)",
+        device_categories.items()
+    )
+
+def load_dictionaries(cursor):
+    """读取规范化存储的字典，返回{列名: {原值: 编码}}"""
+    return {
+        column: dict(cursor.execute(f"SELECT value, code FROM {dictionary_table(column)}").fetchall())
+        for column in DICTIONARY_COLUMNS
+    }
+
+def save_dictionaries(cursor, new_values):
+    """写入新分配的字典编码，写入后清空new_values"""
+    for column, values in new_values.items():
+        if not values:
+            continue
+        cursor.executemany(f"INSERT INTO {dictionary_table(column)} (code, value) VALUES (?, ?)", values)
+        values.clear()
+
+def insert_columns(sql):
+    """写入语句的列名列表"""
+    return [column.strip() for column in sql[sql.index('(') + 1:sql.index(')')].split(',')]
+
+def encode_rows(rows, table, columns, dictionaries, new_values):
+    """将记录中table的编码列替换为字典编码，columns为记录各位置的列名
+    
+    新出现的值按字典大小顺序分配编码，并记入new_values，由调用方通过save_dictionaries写入。
+    """
+    positions = [
+        (position, dictionaries[column], new_values[column])
+        for position, column in enumerate(columns) if column in NORMALIZED_COLUMNS[table]
+    ]
+    for row in rows:
+        row = list(row)
+        for position, codes, added in positions:
+            value = row[position]
+            if value is not None:
+                code = codes.get(value)
+                if code is None:
+                    code = codes[value] = len(codes) + 1
+                    added.append((code, value))
+                row[position] = code
+        yield row
+
+def storage_write_sql(sql, normalized):
+    """规范化存储时将写入语句的目标表替换为对应的编码表"""
+    for table in STORAGE_TABLES:
+        sql = sql.replace(f"INTO {table} ", f"INTO {storage_table(table, normalized)} ")
+    return sql
+
+def encode_event_payloads(payloads):
+    """将连续事件的载荷列表压缩为event_payloads表的payload"""
+    return zlib.compress(json.dumps(payloads, ensure_ascii=False).encode('utf-8'))
+
+def decode_event_payloads(payload):
+    """解压event_payloads表的payload，返回连续事件的载荷列表"""
+    return json_loads(zlib.decompress(payload))
+
+def split_event_payloads(rows, payloads=None):
+    """将事件记录中的event_value、event_params置空
+    
+    payloads不为None时按记录顺序追加两列的值，两列均为空的记录追加None。
+    """
+    columns = insert_columns(INSERT_EVENTS_SQL)
+    positions = [columns.index(column) for column in EVENT_PAYLOAD_COLUMNS]
+    for row in rows:
+        row = list(row)
+        values = [row[position] for position in positions]
+        if payloads is not None:
+            payloads.append(None if all(value is None for value in values) else values)
+        for position in positions:
+            row[position] = None
+        yield row
+
+def build_event_payload_rows(payloads, first_event_id, block_size=EVENT_PAYLOAD_BLOCK_SIZE):
+    """将ID从first_event_id开始连续的事件载荷按block_size个事件分块，生成event_payloads表的插入记录
+    
+    全部事件都没有载荷的块不写入。
+    """
+    for start in range(0, len(payloads), block_size):
+        block = payloads[start:start + block_size]
+        if any(values is not None for values in block):
+            yield first_event_id + start, encode_event_payloads(block)
+
+def read_event_payloads(conn, event_ids):
+    """读取事件的event_value和event_params，返回{事件ID: (event_value, event_params)}
+    
+    兼容各种载荷保存方式：事件表中两列不全为空时直接返回，否则从event_payloads表中所在的块解压；
+    以skip方式导入的事件两列均为None。
+    """
+    event_ids = list(event_ids)
+    payloads = {}
+    for start in range(0, len(event_ids), EVENT_PAYLOAD_QUERY_SIZE):
+        batch = event_ids[start:start + EVENT_PAYLOAD_QUERY_SIZE]
+        placeholders = ', '.join('?' * len(batch))
+        for event_id, event_value, event_params in conn.execute(f"""
+        SELECT id, event_value, event_params FROM events WHERE id IN ({placeholders})
+        """, batch):
+            payloads[event_id] = (event_value, event_params)
+    
+    # 按ID顺序读取，相邻事件共用已解压的块
+    first_event_id, block = None, []
+    for event_id in sorted(event_id for event_id, values in payloads.items() if values == (None, None)):
+        if first_event_id is None or not first_event_id <= event_id < first_event_id + len(block):
+            row = conn.execute("""
+            SELECT first_event_id, payload FROM event_payloads
+            WHERE first_event_id <= ?
+            ORDER BY first_event_id DESC
+            LIMIT 1
+            """, (event_id,)).fetchone()
+            if row is None:
+                continue
+            first_event_id, block = row[0], decode_event_payloads(row[1])
+        offset = event_id - first_event_id
+        if offset < len(block) and block[offset] is not None:
+            payloads[event_id] = tuple(block[offset])
+    return payloads
+
+def classify_device_models(device_models, device_categories):
+    """按去重后的设备型号分类并映射回每一行
+    
+    device_categories为已知的型号到类别的映射，只有其中没有的型号才调用
+    extract_device_category。返回(设备类别列, 本次新分类的映射)。
+    """
+    codes, uniques = pd.factorize(device_models)
+    new_categories = {}
+    categories = []
+    for device_model in uniques:
+        category = device_categories.get(device_model)
+        if category is None:
+            category = extract_device_category(device_model)
+            new_categories[device_model] = category
+        categories.append(category)
+    
+    # 空值的编码为-1，对应追加在末尾的空值类别
+    categories.append(extract_device_category(None))
+    result = np.array(categories, dtype=object)[codes]
+    return pd.Series(result, index=device_models.index), new_categories
+
 def clean_datetime(dt_str):
     """清洗并标准化日期时间格式"""
     if pd.isna(dt_str) or not dt_str:
@@ -97,318 +377,880 @@ def clean_date(date_str):
         logger.warning(f"日期解析失败 '{date_str}': {e}")
         return None
 
+def parse_datetime_column(series):
+    """向量化解析日期时间列，结果与逐个调用clean_datetime一致
+    
+    先按常见格式整批解析，再处理带时区偏移和Unix时间戳（秒）的值，
+    其余无法整批解析的值才逐个（按去重后的取值）交给clean_datetime。
+    带时区的值保留其本地时间并去掉时区信息，与写入数据库的字符串一致。
+    返回(datetime64列, 无法解析的值个数)。
+    """
+    values = series.astype(object).where(series.notna() & series.astype(bool), None)
+    result = pd.Series(pd.NaT, index=series.index, dtype='datetime64[ns]')
+    pending = values.notna()
+    text = values[pending].astype(str)
+    
+    def parse_pending(candidates, fmt):
+        parsed = pd.to_datetime(candidates, format=fmt, errors='coerce')
+        parsed = parsed[parsed.notna()]
+        result.loc[parsed.index] = parsed
+        pending.loc[parsed.index] = False
+    
+    def fast_candidates(candidates, fmt):
+        # pandas接受strptime会拒绝的空的或超过6位的%f和60秒，这些值交给逐个解析
+        if '%f' in fmt:
+            candidates = candidates[candidates.str.contains(r'\.\d{1,6}$', regex=True)]
+        if '%S' in fmt:
+            candidates = candidates[~candidates.str.contains(':6', regex=False)]
+        return candidates
+    
+    # 1. 按常见格式整批解析
+    for fmt in FAST_DATETIME_FORMATS:
+        candidates = text[pending[text.index]]
+        if candidates.empty:
+            break
+        parse_pending(fast_candidates(candidates, fmt), fmt)
+    
+    # 2. 带"+HHMM"时区偏移的值，去掉偏移后按本地时间解析
+    candidates = text[pending[text.index]]
+    if not candidates.empty:
+        has_offset = candidates.str[-5:].str.fullmatch(r'[+-]\d{4}')
+        stripped = candidates[has_offset].str[:-5]
+        for fmt in FAST_DATETIME_FORMATS[:2]:
+            parse_pending(fast_candidates(stripped[pending[stripped.index]], fmt), fmt)
+    
+    # 3. Unix时间戳（秒），按本地时区转换，与datetime.fromtimestamp一致
+    candidates = text[pending[text.index]]
+    candidates = candidates[candidates.str.isdigit()]
+    if not candidates.empty:
+        try:
+            parsed = pd.to_datetime(candidates.astype('int64'), unit='s', utc=True)
+            parse_pending(parsed.dt.tz_convert(tzlocal()).dt.tz_localize(None), None)
+        except (OverflowError, ValueError, pd.errors.OutOfBoundsDatetime):
+            pass
+    
+    # 4. 其余值逐个回退到clean_datetime
+    fallback = values[pending]
+    failed_count = 0
+    if not fallback.empty:
+        parsed_values = {}
+        for val in fallback.unique():
+            dt = clean_datetime(val)
+            if dt is not None and dt.tzinfo is not None:
+                dt = dt.replace(tzinfo=None)
+            parsed_values[val] = pd.Timestamp(dt) if dt is not None else pd.NaT
+        parsed = pd.to_datetime(fallback.map(parsed_values), errors='coerce')
+        result.loc[fallback.index] = parsed
+        failed_count = int(parsed.isna().sum())
+    
+    return result, failed_count
+
 def clean_currency_code(code):
     """清洗货币代码"""
     if pd.isna(code) or not code:
         return 'USD'  # 默认使用USD
     return str(code).upper()
 
-def extract_event_params(row):
-    """从事件值中提取事件参数"""
-    event_value = row.get('event_value', '')
+def decode_json(text):
+    """解析JSON字符串，快速后端解析失败时再用标准库json解析"""
+    try:
+        return json_loads(text)
+    except Exception:
+        return json.loads(text)
+
+def read_content_id(event_value):
+    """解析event_value中的af_content_id，返回(是否找到, 产品ID)"""
+    try:
+        data = decode_json(event_value)
+        if 'af_content_id' in data:
+            return True, data['af_content_id']
+    except Exception:
+        pass
+    return False, None
+
+def extract_event_fields(df):
+    """从event_value中提取事件参数和产品ID
     
-    # 如果event_value是JSON格式
-    if event_value and isinstance(event_value, str) and (event_value.startswith('{') or event_value.startswith('{')):
-        try:
-            return event_value
-        except Exception as e:
-            logger.warning(f"事件值JSON解析失败: {e}")
+    JSON格式的event_value直接作为事件参数，否则将params类字段合并为JSON。
+    产品ID只对PRODUCT_EVENT_NAMES中的事件提取，每个不同的event_value只解析一次，
+    其余事件的产品ID为None。
+    """
+    if 'event_value' in df.columns:
+        event_value = df['event_value']
+    else:
+        event_value = pd.Series(None, index=df.index, dtype=object)
+    is_json = event_value.str.startswith('{', na=False).astype(bool)
     
-    # 检查event_params字段
-    params = {}
-    for col in row.keys():
-        if 'params' in col and row[col]:
-            try:
-                params[col] = row[col]
-            except Exception:
-                pass
+    # 事件参数
+    event_params = event_value.astype(object).where(is_json, None)
+    param_columns = [col for col in df.columns if 'params' in col]
+    other_rows = ~is_json
+    if param_columns and other_rows.any():
+        dumped = {}
+        def dump_params(values):
+            if values not in dumped:
+                params = {col: value for col, value in zip(param_columns, values) if value}
+                dumped[values] = json.dumps(params) if params else None
+            return dumped[values]
+        
+        param_values = zip(*(df.loc[other_rows, col] for col in param_columns))
+        event_params[other_rows] = [dump_params(values) for values in param_values]
     
-    return json.dumps(params) if params else None
+    # 产品ID，先从JSON中读取af_content_id
+    product_id = pd.Series(None, index=df.index, dtype=object)
+    pending = df['event_name'].isin(PRODUCT_EVENT_NAMES)
+    decode_rows = pending & is_json
+    if decode_rows.any():
+        values = event_value[decode_rows]
+        content_ids = {}
+        for value in values.unique():
+            found, content_id = read_content_id(value)
+            if found:
+                content_ids[value] = content_id
+        
+        found_rows = values.isin(content_ids.keys())
+        found_index = found_rows.index[found_rows]
+        product_id[found_index] = pd.Series(
+            [content_ids[value] for value in values[found_rows]], index=found_index, dtype=object
+        )
+        pending[found_index] = False
+    
+    # JSON中没有产品ID时检查对应字段，取第一个非假值
+    for col in PRODUCT_ID_COLUMNS:
+        if col not in df.columns or not pending.any():
+            continue
+        has_value = pending & df[col].astype(bool)
+        product_id[has_value] = df.loc[has_value, col]
+        pending &= ~has_value
+    
+    return event_params, product_id
+
+def ensure_str_or_none(val, fmt=DATETIME_FORMAT):
+    """确保日期时间对象转换为字符串"""
+    if val is None or pd.isna(val):
+        return None
+    elif isinstance(val, (datetime, pd.Timestamp)):
+        return val.strftime(fmt)
+    else:
+        return str(val)
 
-def extract_product_id(row):
-    """从事件参数中提取产品ID"""
-    event_value = row.get('event_value', '')
+def round_like_builtin(values, ndigits):
+    """向量化四舍五入，结果与内置round一致
     
-    try:
-        # 尝试解析JSON格式的事件值
-        if event_value and isinstance(event_value, str) and (event_value.startswith('{') or event_value.startswith('{')):
-            data = json.loads(event_value)
-            if 'af_content_id' in data:
-                return data['af_content_id']
-    except Exception:
-        pass
+    np.round先放大再取整，在十进制.5附近可能与round的结果相差一位，
+    这些少量的值逐个使用round计算。
+    """
+    rounded = values.round(ndigits)
+    scaled = values * 10 ** ndigits
+    near_half = ((scaled - np.floor(scaled)) - 0.5).abs() < 1e-6
+    if near_half.any():
+        rounded[near_half] = [round(value, ndigits) for value in values[near_half]]
+    return rounded
+
+def load_currency_rates(cursor):
+    """读取按生效日期排列的汇率历史"""
+    cursor.execute("""
+    SELECT currency_code, effective_date, rate_to_usd
+    FROM currency_rate_history
+    ORDER BY effective_date, currency_code
+    """)
+    rates = pd.DataFrame(cursor.fetchall(), columns=['currency_code', 'effective_date', 'rate_to_usd'])
+    rates['effective_date'] = pd.to_datetime(rates['effective_date'])
+    return rates
+
+def lookup_currency_rates(currencies, dates, currency_rates):
+    """按货币和日期查找当时有效的汇率（as-of连接）
+    
+    日期早于该货币最早汇率时使用最早的汇率，日期为空时使用最新汇率，
+    未知货币的汇率为1.0。
+    """
+    rates = pd.Series(np.nan, index=currencies.index)
+    if currency_rates.empty or currencies.empty:
+        return rates.fillna(1.0)
+    
+    keys = pd.DataFrame({'currency_code': currencies, 'effective_date': dates.astype('datetime64[ns]')})
+    dated = keys[keys['effective_date'].notna()].sort_values('effective_date', kind='stable')
+    if not dated.empty:
+        currency_rates = currency_rates.astype({'effective_date': 'datetime64[ns]'})
+        for direction in ('backward', 'forward'):
+            merged = pd.merge_asof(
+                dated.reset_index(), currency_rates,
+                on='effective_date', by='currency_code', direction=direction
+            ).set_index('index')['rate_to_usd']
+            rates = rates.fillna(merged)
     
-    # 检查事件参数字段
-    for col in ['af_content_id', 'product_id', 'sku']:
-        if col in row and row[col]:
-            return row[col]
+    undated = keys['effective_date'].isna()
+    if undated.any():
+        latest_rates = currency_rates.groupby('currency_code')['rate_to_usd'].last()
+        rates[undated] = currencies[undated].map(latest_rates)
     
-    return None
+    return rates.fillna(1.0)
 
-def process_csv_data():
-    """处理CSV数据"""
+def convert_revenue_to_usd(df, currency_rates):
+    """计算USD收入，已有event_revenue_usd时直接使用，否则按汇率换算，保留4位小数"""
+    revenue = pd.to_numeric(df['event_revenue'], errors='coerce') if 'event_revenue' in df.columns else pd.Series(np.nan, index=df.index)
+    has_revenue = revenue.notna() & (revenue != 0)
+    
+    if 'event_revenue_usd' in df.columns:
+        revenue_usd = pd.to_numeric(df['event_revenue_usd'], errors='coerce')
+    else:
+        revenue_usd = pd.Series(np.nan, index=df.index)
+    has_revenue_usd = revenue_usd.notna() & (revenue_usd != 0)
+    
+    result = pd.Series(0.0, index=df.index)
+    result[has_revenue & has_revenue_usd] = revenue_usd
+    
+    needs_conversion = has_revenue & ~has_revenue_usd
+    if needs_conversion.any():
+        rates = lookup_currency_rates(
+            df.loc[needs_conversion, 'event_revenue_currency'],
+            df.loc[needs_conversion, 'created_date'],
+            currency_rates
+        )
+        result[needs_conversion] = revenue[needs_conversion] * rates
+    
+    return round_like_builtin(result, 4)
+
+def read_csv_chunks(csv_file, chunksize=None, names=None):
+    """按块读取CSV文件，未指定块大小时一次性读取整个文件
+    
+    csv_file可以是已定位到某一行行首的文件对象，此时需通过names传入文件首行的列名。
+    """
+    header = 'infer' if names is None else None
+    if chunksize:
+        return pd.read_csv(csv_file, dtype=CSV_DTYPES, chunksize=chunksize, header=header, names=names)
+    return [pd.read_csv(csv_file, dtype=CSV_DTYPES, header=header, names=names)]
+
+def file_head_digest(csv_file, length):
+    """计算文件开头length字节（最多HEAD_DIGEST_BYTES）的摘要"""
+    with open(csv_file, 'rb') as f:
+        return hashlib.sha1(f.read(min(length, HEAD_DIGEST_BYTES))).hexdigest()
+
+def load_ingest_offsets(cursor):
+    """读取各CSV文件已导入的字节位置和行数"""
+    cursor.execute("SELECT file_path, byte_offset, row_count, head_digest FROM ingest_log")
+    return {file_path: (byte_offset, row_count, head_digest) for file_path, byte_offset, row_count, head_digest in cursor.fetchall()}
+
+def resolve_ingest_offset(csv_file, ingested):
+    """返回增量导入时CSV文件的起始字节位置，文件无新数据或已被替换时返回None"""
+    if ingested is None:
+        return 0
+    
+    byte_offset, _, head_digest = ingested
+    file_size = os.path.getsize(csv_file)
+    if file_size < byte_offset or file_head_digest(csv_file, byte_offset) != head_digest:
+        logger.warning(f"文件内容与已导入的记录不一致，可能已被替换，跳过: {csv_file}（请全量重新导入）")
+        return None
+    if file_size == byte_offset:
+        logger.info(f"文件没有新追加的数据: {csv_file}")
+        return None
+    return byte_offset
+
+def complete_lines_end(csv_file):
+    """返回文件中最后一个换行符之后的字节位置
+    
+    文件末尾没有换行符的内容可能是仍在写入的不完整行，本次不导入，
+    导入位置停在完整行的结尾，写入完成后由下次增量导入读取整行。
+    """
+    with open(csv_file, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - LINE_END_SCAN_BYTES)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+    return 0
+
+def save_ingest_offset(cursor, csv_file, byte_offset, row_count):
+    """记录CSV文件已导入到的字节位置"""
+    cursor.execute("""
+    INSERT OR REPLACE INTO ingest_log (file_path, byte_offset, row_count, head_digest, ingested_at)
+    VALUES (?, ?, ?, ?, ?)
+    """, (csv_file, byte_offset, row_count, file_head_digest(csv_file, byte_offset), datetime.now().isoformat()))
+
+def preprocess_chunk(df, currency_rates, device_categories=None):
+    """清洗数据块并计算派生字段
+    
+    currency_rates为load_currency_rates返回的汇率历史，
+    device_categories为设备型号分类缓存，新分类的型号会加入其中。
+    """
+    # 填充空值
+    df = df.fillna({
+        'event_name': 'unknown_event',
+        'country_code': 'unknown',
+        'device_model': 'unknown_device',
+        'event_revenue_currency': 'USD'
+    })
+    
+    # 添加设备类别
+    if device_categories is None:
+        device_categories = {}
+    df['device_category'], new_device_categories = classify_device_models(df['device_model'], device_categories)
+    device_categories.update(new_device_categories)
+    
+    # 处理日期和时间，created_date直接由解析后的event_time得到
+    df['event_time'], failed_event_times = parse_datetime_column(df['event_time'])
+    df['created_date'] = df['event_time'].dt.normalize()
+    if 'install_time' in df.columns:
+        df['install_time'], failed_install_times = parse_datetime_column(df['install_time'])
+    else:
+        df['install_time'], failed_install_times = df['event_time'], 0
+    if failed_event_times or failed_install_times:
+        logger.warning(f"无法解析的日期时间: event_time {failed_event_times} 个, install_time {failed_install_times} 个")
+    
+    # 确保install_time不晚于event_time
+    install_after_event = df['install_time'] > df['event_time']
+    df['install_time'] = df['install_time'].mask(install_after_event, df['event_time'])
+    
+    # 确保货币代码规范化
+    currency = df['event_revenue_currency']
+    df['event_revenue_currency'] = currency.where(currency.notna() & currency.astype(bool), 'USD').astype(str).str.upper()
+    
+    # 按事件日期当时有效的汇率计算USD收入
+    df['event_revenue_usd'] = convert_revenue_to_usd(df, currency_rates)
+    
+    # 一次解析event_value，提取事件参数和产品ID
+    df['event_params'], df['product_id'] = extract_event_fields(df)
+    
+    return df
+
+def aggregate_users(df):
+    """单次分组汇总数据块中每个用户的首末出现日期和首条记录属性
+    
+    返回以appsflyer_id为索引、按用户首次出现顺序排列的部分状态，
+    可通过merge_user_states与其他数据块的结果合并。
+    """
+    user_df = df[df['appsflyer_id'].notna()]
+    grouped = user_df.groupby('appsflyer_id', sort=False)['created_date']
+    state = pd.DataFrame({
+        'first_seen_date': grouped.min(),
+        'last_seen_date': grouped.max(),
+    })
+    
+    # 每个用户的第一条记录（保留其中的空值，不能用groupby.first）
+    first_rows = user_df.drop_duplicates(subset=['appsflyer_id']).set_index('appsflyer_id')
+    return state.join(first_rows.reindex(columns=USER_ATTRIBUTE_COLUMNS))
+
+def merge_user_states(states):
+    """按先后顺序合并多个用户汇总状态，日期取最小/最大值，属性保留最早出现的记录"""
+    states = [state for state in states if state is not None]
+    if not states:
+        return None
+    if len(states) == 1:
+        return states[0]
+    
+    combined = pd.concat(states)
+    grouped = combined.groupby(level=0, sort=False)
+    merged = pd.DataFrame({
+        'first_seen_date': grouped['first_seen_date'].min(),
+        'last_seen_date': grouped['last_seen_date'].max(),
+    })
+    first_rows = combined[~combined.index.duplicated(keep='first')]
+    return merged.join(first_rows[USER_ATTRIBUTE_COLUMNS])
+
+def build_user_rows(user_state):
+    """将用户汇总状态转换为用户表的插入记录"""
+    def str_or_none(val):
+        return str(val) if not pd.isna(val) else None
+    
+    def non_empty_str_or_none(val):
+        return str(val) if val and not pd.isna(val) else None
+    
+    return [
+        (
+            str(user_id),
+            ensure_str_or_none(first_seen_date, DATE_FORMAT),
+            ensure_str_or_none(last_seen_date, DATE_FORMAT),
+            str_or_none(country_code),
+            str_or_none(device_model),
+            str_or_none(device_category),
+            non_empty_str_or_none(platform),
+            non_empty_str_or_none(media_source),
+            ensure_str_or_none(install_time)
+        )
+        for user_id, first_seen_date, last_seen_date, country_code, device_model,
+            device_category, platform, media_source, install_time
+        in user_state[USER_STATE_COLUMNS].itertuples(name=None)
+    ]
+
+def text_column(df, col, default=None, skip_empty=False):
+    """按列将值转换为字符串，空值（skip_empty时还包括空字符串、0等假值）替换为default"""
+    if col not in df.columns:
+        return [default] * len(df)
+    
+    series = df[col]
+    valid = series.notna().to_numpy()
+    if skip_empty:
+        valid &= series.astype(bool).to_numpy()
+    return np.where(valid, series.astype(str).to_numpy(dtype=object), default).tolist()
+
+def float_column(df, col, default=0.0, skip_empty=False):
+    """按列将值转换为浮点数，空值（skip_empty时还包括0）替换为default"""
+    if col not in df.columns:
+        return [default] * len(df)
+    
+    series = df[col]
+    valid = series.notna().to_numpy()
+    if skip_empty:
+        valid &= series.astype(bool).to_numpy()
+    values = pd.to_numeric(series.where(valid), errors='coerce').to_numpy(dtype=float)
+    return np.where(valid, values, default).tolist()
+
+def datetime_column(df, col, fmt=DATETIME_FORMAT):
+    """按列将日期时间转换为字符串，格式与ensure_str_or_none一致"""
+    series = df[col]
+    if pd.api.types.is_datetime64_any_dtype(series):
+        formatted = series.dt.strftime(fmt)
+        return formatted.astype(object).where(formatted.notna(), None).tolist()
+    return [ensure_str_or_none(val, fmt) for val in series]
+
+def valid_event_rows(df):
+    """跳过没有用户ID的记录"""
+    appsflyer_id = df['appsflyer_id']
+    return df[appsflyer_id.notna().to_numpy() & appsflyer_id.astype(bool).to_numpy()]
+
+def iter_event_rows(df, batch_size=EVENT_BATCH_SIZE):
+    """按列批量生成事件表的插入记录
+    
+    每次只转换batch_size行，空值判断和类型转换在列级别完成，
+    生成器可直接交给executemany，避免构建整个数据块的记录列表。
+    """
+    df = valid_event_rows(df)
+    
+    for start in range(0, len(df), batch_size):
+        batch = df.iloc[start:start + batch_size]
+        yield from zip(
+            text_column(batch, 'appsflyer_id'),
+            text_column(batch, 'event_name', default='unknown_event'),
+            text_column(batch, 'event_value', skip_empty=True),
+            datetime_column(batch, 'created_date', DATE_FORMAT),
+            datetime_column(batch, 'event_time'),
+            text_column(batch, 'country_code'),
+            text_column(batch, 'device_model'),
+            text_column(batch, 'device_category'),
+            text_column(batch, 'app_id', skip_empty=True),
+            text_column(batch, 'platform', skip_empty=True),
+            text_column(batch, 'media_source', skip_empty=True),
+            float_column(batch, 'event_revenue', skip_empty=True),
+            text_column(batch, 'event_revenue_currency', default='USD'),
+            float_column(batch, 'event_revenue_usd'),
+            text_column(batch, 'event_params'),
+            datetime_column(batch, 'install_time')
+        )
+
+def build_staging_frame(df):
+    """生成写入暂存区的事件数据，与写入事件表的记录逐行对应
+    
+    文本和数值列的转换与iter_event_rows一致，日期时间保留为datetime类型；
+    不包含原始event_value和event_params。
+    """
+    df = valid_event_rows(df)
+    return pd.DataFrame({
+        'appsflyer_id': text_column(df, 'appsflyer_id'),
+        'event_name': text_column(df, 'event_name', default='unknown_event'),
+        'created_date': datetime_column(df, 'created_date', DATE_FORMAT),
+        'event_time': df['event_time'].to_numpy(),
+        'country_code': text_column(df, 'country_code'),
+        'device_model': text_column(df, 'device_model'),
+        'device_category': text_column(df, 'device_category'),
+        'app_id': text_column(df, 'app_id', skip_empty=True),
+        'platform': text_column(df, 'platform', skip_empty=True),
+        'media_source': text_column(df, 'media_source', skip_empty=True),
+        'event_revenue': float_column(df, 'event_revenue', skip_empty=True),
+        'event_revenue_currency': text_column(df, 'event_revenue_currency', default='USD'),
+        'event_revenue_usd': float_column(df, 'event_revenue_usd'),
+        'install_time': df['install_time'].to_numpy(),
+    })
+
+def build_purchase_rows(df):
+    """提取购买事件记录，重复的购买在写入时按purchase_key去重"""
+    purchases_data = []
+    
+    # 仅处理购买事件
+    purchase_df = df[df['event_name'] == 'af_purchase'].copy()
+    purchase_df = purchase_df[purchase_df['event_revenue_usd'] > 0]
+    
+    if purchase_df.empty:
+        return purchases_data
+    
+    # 创建唯一标识来防止重复，与purchases表中的purchase_time、order_id拼接方式一致
+    if 'order_id' in purchase_df.columns:
+        order_id = purchase_df['order_id'].where(purchase_df['order_id'].notna() & purchase_df['order_id'].astype(bool), '')
+    else:
+        order_id = ''
+    purchase_df['purchase_key'] = (
+        purchase_df['appsflyer_id'].astype(str) + '_' + order_id + '_'
+        + purchase_df['event_time'].dt.strftime(DATETIME_FORMAT).fillna('None')
+    )
+    purchase_df = purchase_df.drop_duplicates(subset=['purchase_key'])
+    
+    for _, row in purchase_df.iterrows():
+        purchases_data.append((
+            str(row['appsflyer_id']),
+            ensure_str_or_none(row['event_time']),
+            ensure_str_or_none(row['created_date'], DATE_FORMAT),
+            str(row['country_code']) if not pd.isna(row['country_code']) else None,
+            str(row['device_category']) if not pd.isna(row['device_category']) else None,
+            float(row['event_revenue_usd']) if not pd.isna(row['event_revenue_usd']) else 0.0,
+            str(row['product_id']) if not pd.isna(row['product_id']) else None,
+            str(row.get('order_id', '')) if row.get('order_id') and not pd.isna(row.get('order_id')) else None,
+            row['purchase_key']
+        ))
+    
+    return purchases_data
+
+def transform_chunk(df, currency_rates, device_categories, staging=False):
+    """清洗数据块并生成写入所需的数据
+    
+    返回(行数, 事件记录生成器, 用户汇总, 购买记录, 本块新分类的设备型号, 暂存区事件数据)，
+    staging为False时暂存区事件数据为None。
+    """
+    row_count = len(df)
+    known_device_models = set(device_categories)
+    df = preprocess_chunk(df, currency_rates, device_categories)
+    new_device_categories = {
+        model: device_categories[model] for model in device_categories.keys() - known_device_models
+    }
+    staging_frame = build_staging_frame(df) if staging else None
+    return (
+        row_count, iter_event_rows(df), aggregate_users(df), build_purchase_rows(df), new_device_categories,
+        staging_frame
+    )
+
+def transform_chunk_in_worker(df, currency_rates, device_categories, staging=False):
+    """在工作进程中清洗数据块，事件记录展开为列表后才能传回主进程"""
+    row_count, event_rows, user_state, purchases_data, new_device_categories, staging_frame = transform_chunk(
+        df, currency_rates, device_categories, staging
+    )
+    return row_count, list(event_rows), user_state, purchases_data, new_device_categories, staging_frame
+
+def iter_transformed_chunks(chunks, currency_rates, device_categories, executor=None, max_pending=1,
+                            staging=False):
+    """按读取顺序返回清洗后的数据块
+    
+    指定executor时数据块提交到进程池并行清洗，最多max_pending个数据块在途，
+    结果仍按提交顺序返回，与串行清洗的输出完全一致。
+    device_categories会合并各数据块新分类的设备型号，之后提交的数据块可直接复用。
+    """
+    if executor is None:
+        for df in chunks:
+            yield transform_chunk(df, currency_rates, device_categories, staging)
+        return
+    
+    pending = deque()
+    for df in chunks:
+        # 参数在后台线程中序列化，传入副本避免与合并新分类同时修改
+        pending.append(executor.submit(
+            transform_chunk_in_worker, df, currency_rates, dict(device_categories), staging
+        ))
+        del df
+        if len(pending) >= max_pending:
+            result = pending.popleft().result()
+            device_categories.update(result[4])
+            yield result
+    while pending:
+        result = pending.popleft().result()
+        device_categories.update(result[4])
+        yield result
+
+def process_csv_data(chunksize=None, incremental=False, csv_files=None, workers=1, db_file=None, bulk_load=False,
+                     conn=None, staging=False, normalized=None, event_payloads='inline'):
+    """处理CSV数据
+    
+    chunksize为None时一次性读取整个CSV文件；指定chunksize时进入流式模式，
+    每次只读取并清洗chunksize行，写入该块的事件和购买数据后再读取下一块，
+    内存占用与输入文件大小无关。
+    
+    incremental为True时不清空现有数据，每个文件只读取上次导入位置之后追加的行：
+    新事件直接追加，用户按首末出现日期合并，购买按purchase_key去重。
+    csv_files为要导入的CSV文件列表，默认为CSV_FILE。
+    
+    workers大于1时按块读取CSV，由workers个工作进程并行清洗，主进程按读取顺序
+    依次写入数据库，写入的数据与串行处理完全相同。
+    
+    db_file为目标数据库文件，默认为DB_FILE；bulk_load为True时使用批量导入的连接设置。
+    传入conn时使用该共享连接（忽略db_file和bulk_load），不关闭连接，
+    修改作为保存点随调用方的事务提交。
+    
+    staging为True时同时将写入的事件和购买数据按created_date分区追加到数据库文件对应的
+    Parquet暂存区（需要pyarrow），供LTV和统计计算读取。全量导入时写入新的一代暂存目录，
+    事务提交前原来的暂存数据保持可用；事务回滚时已写入的暂存文件在下次导入开始时删除。
+    
+    normalized为True时使用规范化存储：事件、用户和购买表中的文本维度列只保存字典编码，
+    通过同名视图按原列名读取；为False时使用原始存储；为None时保持数据库当前的存储方式。
+    只有全量导入时才切换存储方式，增量导入总是沿用当前的存储方式。
+    
+    event_payloads为事件event_value、event_params的保存方式（见EVENT_PAYLOAD_MODES），
+    只影响本次写入的事件，已导入的事件保持原样，可通过read_event_payloads统一读取。
+    """
+    own_conn = conn is None
+    db_file = db_file or DB_FILE
+    if event_payloads not in EVENT_PAYLOAD_MODES:
+        raise ValueError(f"无效的事件载荷保存方式: {event_payloads}")
     try:
         # 检查数据库是否存在
-        if not os.path.exists(DB_FILE):
-            logger.error(f"数据库文件不存在: {DB_FILE}")
+        if own_conn and not os.path.exists(db_file):
+            logger.error(f"数据库文件不存在: {db_file}")
             logger.info("请先运行 create_database.py 创建数据库")
             return
         
         # 检查CSV文件是否存在
-        if not os.path.exists(CSV_FILE):
-            logger.error(f"CSV文件不存在: {CSV_FILE}")
-            return
-        
-        logger.info(f"开始处理CSV数据: {CSV_FILE}")
+        csv_files = [os.path.abspath(csv_file) for csv_file in (csv_files or [CSV_FILE])]
+        for csv_file in csv_files:
+            if not os.path.exists(csv_file):
+                logger.error(f"CSV文件不存在: {csv_file}")
+                return
         
-        # 读取CSV数据
-        logger.info("读取整个CSV文件到内存")
-        df = pd.read_csv(CSV_FILE)
-        logger.info(f"CSV文件读取完成，共{len(df)}行")
+        logger.info(f"开始{'增量' if incremental else ''}处理CSV数据: {', '.join(csv_files)}")
+        if workers > 1:
+            # 并行清洗需要按块分配给工作进程
+            chunksize = chunksize or CHUNK_SIZE
+            logger.info(f"使用 {workers} 个工作进程并行清洗数据")
+        if chunksize:
+            logger.info(f"流式读取CSV文件，每块 {chunksize} 行")
+        else:
+            logger.info("读取整个CSV文件到内存")
         
         # 连接数据库
-        conn = sqlite3.connect(DB_FILE)
+        if own_conn:
+            conn = connect_database(db_file, bulk_load)
         cursor = conn.cursor()
         
-        # 清空现有数据
-        logger.info("清空现有事件、用户和购买数据")
-        cursor.execute("DELETE FROM events")
-        cursor.execute("DELETE FROM users")
-        cursor.execute("DELETE FROM purchases")
-        conn.commit()
+        # 暂存区与数据库文件对应，先删除之前被替换或已回滚的导入留下的暂存数据
+        staging_dir = connection_staging_dir(conn)
+        if staging_dir:
+            prune_staging(conn)
+        if staging and not staging_available():
+            logger.warning("未安装pyarrow，不写入暂存区")
+            staging = False
+        if staging and not staging_dir:
+            logger.warning("内存数据库没有暂存区，不写入暂存区")
+            staging = False
+        # 增量导入追加到当前一代暂存目录，暂存区缺少已导入的数据时不再写入
+        if staging and incremental:
+            staging_dir = current_staging_dir(conn)
+            if staging_dir is None:
+                logger.warning("暂存区缺少已导入的数据，本次不写入暂存区（全量导入时重新生成）")
+                staging = False
+        staged_files = []
+        
+        # 存储方式只在全量导入时切换
+        if normalized is None:
+            normalized = is_normalized(cursor)
+        elif incremental and normalized != is_normalized(cursor):
+            logger.warning("增量导入不切换存储方式，沿用数据库当前的存储方式")
+            normalized = is_normalized(cursor)
         
-        # 获取货币汇率数据
-        cursor.execute("SELECT currency_code, rate_to_usd FROM currency_rates")
-        currency_rates = dict(cursor.fetchall())
+        # 增量模式保留现有数据，只导入新追加的行
+        ingested_files = load_ingest_offsets(cursor) if incremental else {}
+        
+        # 获取货币汇率历史
+        currency_rates = load_currency_rates(cursor)
+        
+        # 获取已缓存的设备型号分类
+        device_categories = load_device_categories(cursor)
+        known_device_models = set(device_categories)
         
         # 初始化计数器
-        total_rows = len(df)
+        total_rows = 0
         inserted_events = 0
         inserted_users = 0
         inserted_purchases = 0
         
-        # 辅助函数：确保日期时间对象转换为字符串
-        def ensure_str_or_none(val):
-            if val is None or pd.isna(val):
-                return None
-            elif isinstance(val, (datetime, pd.Timestamp)):
-                return val.strftime('%Y-%m-%d %H:%M:%S')
-            else:
-                return str(val)
-        
-        # 预处理数据
-        logger.info("预处理数据...")
-        # 填充空值
-        df = df.fillna({
-            'event_name': 'unknown_event',
-            'country_code': 'unknown',
-            'device_model': 'unknown_device',
-            'event_revenue_currency': 'USD'
-        })
-        
-        # 添加设备类别
-        df['device_category'] = df['device_model'].apply(extract_device_category)
-        
-        # 处理日期和时间
-        df['created_date'] = df['event_time'].apply(clean_date)
-        df['event_time'] = df['event_time'].apply(clean_datetime)
-        df['install_time'] = df.get('install_time', df['event_time']).apply(clean_datetime)
-        
-        # 确保install_time不晚于event_time
-        for idx, row in df.iterrows():
-            if pd.notna(row['event_time']) and pd.notna(row['install_time']):
-                if row['install_time'] > row['event_time']:
-                    df.at[idx, 'install_time'] = row['event_time']
-        
-        # 确保货币代码规范化
-        df['event_revenue_currency'] = df['event_revenue_currency'].apply(clean_currency_code)
-        
-        # 计算USD收入 - 确保精确到小数点后4位以保持一致性
-        def convert_to_usd(row):
-            if pd.isna(row['event_revenue']) or not row['event_revenue']:
-                return 0.0
-            
-            # 如果已经有USD收入，直接使用
-            if 'event_revenue_usd' in row and row['event_revenue_usd']:
-                return round(float(row['event_revenue_usd']), 4)
-            
-            # 使用汇率转换
-            currency = row['event_revenue_currency']
-            revenue = float(row['event_revenue'])
-            
-            rate = currency_rates.get(currency, 1.0)  # 默认为1.0
-            return round(revenue * rate, 4)  # 确保精确到小数点后4位
-        
-        df['event_revenue_usd'] = df.apply(convert_to_usd, axis=1)
+        # 已合并的用户汇总状态，以及尚未合并的各数据块汇总结果
+        user_state = None
+        pending_user_states = []
         
-        # 提取事件参数
-        df['event_params'] = df.apply(extract_event_params, axis=1)
-        
-        # 处理产品ID
-        df['product_id'] = df.apply(extract_product_id, axis=1)
+        # 并行清洗的进程池，数据库只由主进程写入
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        max_pending = workers * PENDING_CHUNKS_PER_WORKER
         
         # 开启事务
-        conn.execute("BEGIN TRANSACTION")
+        begin_stage(conn, 'process_csv_data')
         
         try:
-            # 1. 处理用户数据
-            logger.info("处理用户数据...")
-            user_data = []
-            unique_users = df['appsflyer_id'].dropna().unique()
-            
-            for user_id in unique_users:
-                user_rows = df[df['appsflyer_id'] == user_id]
-                
-                first_seen_date = min(user_rows['created_date'].dropna())
-                last_seen_date = max(user_rows['created_date'].dropna())
-                
-                # 获取用户的第一条记录，用于提取其他字段
-                first_row = user_rows.iloc[0]
-                
-                user_data.append((
-                    str(user_id),
-                    ensure_str_or_none(first_seen_date),
-                    ensure_str_or_none(last_seen_date),
-                    str(first_row['country_code']) if not pd.isna(first_row['country_code']) else None,
-                    str(first_row['device_model']) if not pd.isna(first_row['device_model']) else None,
-                    str(first_row['device_category']) if not pd.isna(first_row['device_category']) else None,
-                    str(first_row.get('platform', '')) if first_row.get('platform') and not pd.isna(first_row.get('platform')) else None,
-                    str(first_row.get('media_source', '')) if first_row.get('media_source') and not pd.isna(first_row.get('media_source')) else None,
-                    ensure_str_or_none(first_row['install_time'])
-                ))
-            
-            # 批量插入用户数据
-            cursor.executemany("""
-            INSERT INTO users 
-            (appsflyer_id, first_seen_date, last_seen_date, 
-             country_code, device_model, device_category, 
-             platform, media_source, install_time)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, user_data)
+            if not incremental:
+                # 切换存储方式时重建事件、用户和购买表，与新数据在同一事务中
+                if normalized != is_normalized(cursor):
+                    logger.info(f"切换为{'规范化' if normalized else '原始'}存储")
+                    set_storage_layout(cursor, normalized)
+                # 清空现有数据，与新数据在同一事务中，导入失败时保留原有数据
+                logger.info("清空现有事件、用户和购买数据")
+                for table in STORAGE_TABLES:
+                    cursor.execute(f"DELETE FROM {storage_table(table, normalized)}")
+                if normalized:
+                    for column in DICTIONARY_COLUMNS:
+                        cursor.execute(f"DELETE FROM {dictionary_table(column)}")
+                cursor.execute("DELETE FROM event_payloads")
+                cursor.execute("DELETE FROM ingest_log")
+                # 事件和购买ID从1开始重新编号，与重建数据库文件的结果一致
+                cursor.execute(
+                    "DELETE FROM sqlite_sequence WHERE name IN (?, ?)",
+                    (storage_table('events', normalized), storage_table('purchases', normalized))
+                )
+                # 全量导入后之前的增量计算进度失效
+                cursor.execute("DELETE FROM etl_state")
+                # 暂存区写入新的一代目录，代号随数据一起提交
+                if staging:
+                    staging_dir = begin_staging_generation(cursor, staging_dir)
             
-            inserted_users = len(user_data)
-            logger.info(f"已插入 {inserted_users} 个用户")
+            # 规范化存储时写入编码表，文本维度列在写入前替换为字典编码
+            insert_events_sql = storage_write_sql(INSERT_EVENTS_SQL, normalized)
+            insert_purchases_sql = storage_write_sql(INSERT_PURCHASES_SQL, normalized)
+            upsert_users_sql = storage_write_sql(UPSERT_USERS_SQL, normalized)
+            dictionaries = load_dictionaries(cursor) if normalized else None
+            new_dictionary_values = {column: [] for column in DICTIONARY_COLUMNS}
             
-            # 2. 插入事件数据
-            logger.info("处理事件数据...")
-            events_data = []
+            # 本次导入前的最大购买ID，之后写入的购买记录追加到暂存区
+            cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {storage_table('purchases', normalized)}")
+            staged_purchase_id = cursor.fetchone()[0]
             
-            for _, row in df.iterrows():
-                appsflyer_id = row['appsflyer_id']
-                if pd.isna(appsflyer_id) or not appsflyer_id:
+            for csv_file in csv_files:
+                ingested = ingested_files.get(csv_file)
+                byte_offset = resolve_ingest_offset(csv_file, ingested)
+                if byte_offset is None:
                     continue
+                file_rows = ingested[1] if ingested else 0
                 
-                # 确保所有值都是SQLite支持的类型
-                event_name = str(row['event_name']) if not pd.isna(row['event_name']) else 'unknown_event'
-                event_value = str(row.get('event_value', '')) if row.get('event_value') and not pd.isna(row.get('event_value')) else None
-                created_date = ensure_str_or_none(row['created_date'])
-                event_time = ensure_str_or_none(row['event_time'])
-                country_code = str(row['country_code']) if not pd.isna(row['country_code']) else None
-                device_model = str(row['device_model']) if not pd.isna(row['device_model']) else None
-                device_category = str(row['device_category']) if not pd.isna(row['device_category']) else None
-                app_id = str(row.get('app_id', '')) if row.get('app_id') and not pd.isna(row.get('app_id')) else None
-                platform = str(row.get('platform', '')) if row.get('platform') and not pd.isna(row.get('platform')) else None
-                media_source = str(row.get('media_source', '')) if row.get('media_source') and not pd.isna(row.get('media_source')) else None
-                event_revenue = float(row.get('event_revenue', 0.0)) if row.get('event_revenue') and not pd.isna(row.get('event_revenue')) else 0.0
-                event_revenue_currency = str(row['event_revenue_currency']) if not pd.isna(row['event_revenue_currency']) else 'USD'
-                event_revenue_usd = float(row['event_revenue_usd']) if not pd.isna(row['event_revenue_usd']) else 0.0
-                event_params = str(row['event_params']) if not pd.isna(row['event_params']) else None
-                install_time = ensure_str_or_none(row['install_time'])
+                # 只读取到最后一个完整行，末尾不完整的行留到下次导入
+                end_offset = complete_lines_end(csv_file)
+                if end_offset < os.path.getsize(csv_file):
+                    logger.warning(f"文件末尾有 {os.path.getsize(csv_file) - end_offset} 字节的不完整行，本次不导入: {csv_file}")
+                if end_offset <= byte_offset:
+                    logger.info(f"文件没有新追加的完整行: {csv_file}")
+                    continue
                 
-                events_data.append((
-                    str(appsflyer_id),
-                    event_name,
-                    event_value,
-                    created_date,
-                    event_time,
-                    country_code,
-                    device_model,
-                    device_category,
-                    app_id,
-                    platform,
-                    media_source,
-                    event_revenue,
-                    event_revenue_currency,
-                    event_revenue_usd,
-                    event_params,
-                    install_time
-                ))
-            
-            # 批量插入事件数据
-            if events_data:
-                cursor.executemany(
-                    """
-                    INSERT INTO events 
-                    (appsflyer_id, event_name, event_value, 
-                     created_date, event_time, country_code, 
-                     device_model, device_category, app_id, 
-                     platform, media_source, event_revenue, 
-                     event_revenue_currency, event_revenue_usd, 
-                     event_params, install_time)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """,
-                    events_data
-                )
-                inserted_events = len(events_data)
-                logger.info(f"已插入 {inserted_events} 条事件数据")
+                # 从上次导入位置继续读取时，列名取自文件首行
+                names = list(pd.read_csv(csv_file, nrows=0).columns) if byte_offset else None
+                if byte_offset:
+                    logger.info(f"从第 {byte_offset} 字节继续读取: {csv_file}")
+                
+                with open(csv_file, 'rb') as f, mmap.mmap(f.fileno(), end_offset, access=mmap.ACCESS_READ) as data:
+                    data.seek(byte_offset)
+                    chunks = read_csv_chunks(data, chunksize, names)
+                    transformed_chunks = iter_transformed_chunks(
+                        chunks, currency_rates, device_categories, executor, max_pending, staging
+                    )
+                    for chunk_index, transformed in enumerate(transformed_chunks):
+                        row_count, event_rows, chunk_user_state, purchases_data, _, staging_frame = transformed
+                        total_rows += row_count
+                        file_rows += row_count
+                        logger.info(f"处理第 {chunk_index + 1} 块数据，共{row_count}行")
+                        
+                        # 1. 汇总用户数据，待合并的部分状态超过已合并状态的规模时再合并，
+                        #    使跨数据块合并的总开销与数据量成线性对数关系
+                        pending_user_states.append(chunk_user_state)
+                        pending_users = sum(len(state) for state in pending_user_states)
+                        if user_state is None or pending_users >= len(user_state):
+                            user_state = merge_user_states([user_state] + pending_user_states)
+                            pending_user_states = []
+                        
+                        # 2. 插入事件数据，载荷不保存在事件表时先将两列置空
+                        payloads = []
+                        if event_payloads != 'inline':
+                            event_rows = split_event_payloads(
+                                event_rows, payloads if event_payloads == 'compressed' else None
+                            )
+                        if normalized:
+                            event_rows = encode_rows(
+                                event_rows, 'events', insert_columns(INSERT_EVENTS_SQL), dictionaries, new_dictionary_values
+                            )
+                        cursor.executemany(insert_events_sql, event_rows)
+                        inserted_events += max(cursor.rowcount, 0)
+                        
+                        # 单一写入者连续插入，本块事件的ID为插入后最大ID之前的连续区间
+                        staging_chunk = staging and not staging_frame.empty
+                        if staging_chunk or payloads:
+                            cursor.execute(f"SELECT MAX(id) FROM {storage_table('events', normalized)}")
+                            last_event_id = cursor.fetchone()[0]
+                        
+                        # 分块压缩写入载荷
+                        if payloads:
+                            first_event_id = last_event_id - len(payloads) + 1
+                            cursor.executemany(INSERT_EVENT_PAYLOADS_SQL, build_event_payload_rows(payloads, first_event_id))
+                        
+                        # 写入暂存区
+                        if staging_chunk:
+                            first_event_id = last_event_id - len(staging_frame) + 1
+                            staging_frame.insert(0, 'id', np.arange(first_event_id, first_event_id + len(staging_frame)))
+                            staged_files += write_staging(staging_dir, 'events', staging_frame, first_event_id)
+                        
+                        # 3. 插入购买数据
+                        if purchases_data:
+                            if normalized:
+                                purchases_data = encode_rows(
+                                    purchases_data, 'purchases', insert_columns(INSERT_PURCHASES_SQL), dictionaries,
+                                    new_dictionary_values
+                                )
+                            cursor.executemany(insert_purchases_sql, purchases_data)
+                            inserted_purchases += max(cursor.rowcount, 0)
+                        save_dictionaries(cursor, new_dictionary_values)
+                        
+                        # 释放当前数据块
+                        del event_rows, chunk_user_state, purchases_data, staging_frame, payloads
+                    
+                    # 与数据在同一事务中记录导入位置
+                    save_ingest_offset(cursor, csv_file, end_offset, file_rows)
             
-            # 3. 处理购买数据
-            logger.info("处理购买数据...")
-            purchases_data = []
+            # 新写入的购买记录（已按purchase_key去重）追加到暂存区
+            if staging:
+                purchase_frame = pd.read_sql_query("""
+                SELECT id, appsflyer_id, created_date, purchase_time, country_code, device_category,
+                       event_revenue_usd, product_id, order_id
+                FROM purchases
+                WHERE id > ?
+                ORDER BY id
+                """, conn, params=(staged_purchase_id,))
+                if not purchase_frame.empty:
+                    purchase_frame['purchase_time'] = pd.to_datetime(purchase_frame['purchase_time'], format=DATETIME_FORMAT)
+                    staged_files += write_staging(staging_dir, 'purchases', purchase_frame, purchase_frame['id'].iloc[0])
+                # 记录暂存区已包含的最大ID，与数据在同一事务中提交
+                for table_name in STAGING_TABLES:
+                    cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {storage_table(table_name, normalized)}")
+                    mark_staged(cursor, table_name, cursor.fetchone()[0])
+                logger.info(f"已写入 {len(staged_files)} 个暂存文件: {staging_dir}")
             
-            # 仅处理购买事件
-            purchase_df = df[df['event_name'] == 'af_purchase'].copy()
-            purchase_df = purchase_df[purchase_df['event_revenue_usd'] > 0]
+            # 缓存新出现的设备型号分类
+            new_device_models = set(device_categories) - known_device_models
+            save_device_categories(cursor, {model: device_categories[model] for model in new_device_models})
+            logger.info(f"新增 {len(new_device_models)} 个设备型号分类")
             
-            # 创建唯一标识来防止重复
-            if not purchase_df.empty:
-                purchase_df['purchase_key'] = purchase_df.apply(
-                    lambda r: f"{r['appsflyer_id']}_{r.get('order_id', '')}_{ensure_str_or_none(r['event_time'])}", 
-                    axis=1
-                )
-                
-                # 删除重复项
-                purchase_df = purchase_df.drop_duplicates(subset=['purchase_key'])
-                
-                for _, row in purchase_df.iterrows():
-                    purchases_data.append((
-                        str(row['appsflyer_id']),
-                        ensure_str_or_none(row['event_time']),
-                        ensure_str_or_none(row['created_date']),
-                        str(row['country_code']) if not pd.isna(row['country_code']) else None,
-                        str(row['device_category']) if not pd.isna(row['device_category']) else None,
-                        float(row['event_revenue_usd']) if not pd.isna(row['event_revenue_usd']) else 0.0,
-                        str(row['product_id']) if not pd.isna(row['product_id']) else None,
-                        str(row.get('order_id', '')) if row.get('order_id') and not pd.isna(row.get('order_id')) else None
-                    ))
-            
-            # 批量插入购买数据
-            if purchases_data:
-                cursor.executemany(
-                    """
-                    INSERT INTO purchases 
-                    (appsflyer_id, purchase_time, created_date, 
-                     country_code, device_category, event_revenue_usd, 
-                     product_id, order_id)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    """,
-                    purchases_data
-                )
-                inserted_purchases = len(purchases_data)
-                logger.info(f"已插入 {inserted_purchases} 条购买数据")
+            # 写入合并后的用户数据，已存在的用户只更新首末出现日期
+            logger.info("处理用户数据...")
+            user_state = merge_user_states([user_state] + pending_user_states)
+            user_data = build_user_rows(user_state) if user_state is not None else []
+            if normalized:
+                user_data = list(encode_rows(
+                    user_data, 'users', insert_columns(UPSERT_USERS_SQL), dictionaries, new_dictionary_values
+                ))
+                save_dictionaries(cursor, new_dictionary_values)
+            cursor.executemany(upsert_users_sql, user_data)
+            inserted_users = len(user_data)
+            logger.info(f"已插入或更新 {inserted_users} 个用户")
+            logger.info(f"已插入 {inserted_events} 条事件数据")
+            logger.info(f"已插入 {inserted_purchases} 条购买数据")
             
             # 提交事务
-            conn.commit()
-            logger.info("数据处理完成并已提交到数据库")
+            commit_stage(conn, 'process_csv_data')
+            logger.info("数据处理完成")
+            # 使用独立连接时已提交，删除被本次导入替换的暂存数据
+            if own_conn and staging_dir:
+                prune_staging(conn)
             
         except Exception as e:
             # 回滚事务
-            conn.rollback()
+            rollback_stage(conn, 'process_csv_data')
+            remove_staging_files(staged_files)
             logger.error(f"数据处理失败，已回滚: {e}")
             raise
         finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
             # 关闭数据库连接
-            conn.close()
+            if own_conn:
+                conn.close()
         
         logger.info(f"CSV数据处理完成，共处理 {total_rows} 行数据")
         logger.info(f"统计结果: 插入用户 {inserted_users}, 事件 {inserted_events}, 购买 {inserted_purchases}")
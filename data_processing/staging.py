@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Parquet暂存区
+将清洗后的事件和购买数据按created_date分区保存为Parquet文件，
+LTV和统计计算可只读取所需的列，无需重新解析CSV或扫描SQLite
+
+每次全量导入写入新的一代暂存目录，代号和各数据集已写入的最大ID与数据在同一事务中记录在etl_state中，
+事务回滚后仍读取原来一代的目录；未提交的目录和文件在下次导入开始时删除。
+"""
+
+import os
+import sys
+import glob
+import time
+import shutil
+import logging
+
+# pyarrow为可选依赖，未安装时不使用暂存区
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+
+# 确保当前目录在导入路径中
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_processing.create_database import get_etl_state, is_normalized, set_etl_state, storage_table
+
+logger = logging.getLogger(__name__)
+
+# 暂存区目录为数据库文件路径加此后缀，影子数据库和备份数据库各有自己的暂存区
+STAGING_DIR_SUFFIX = '.staging'
+
+# 暂存的数据集，与数据库中的同名表对应
+STAGING_TABLES = ['events', 'purchases']
+
+# 分区列，日期以YYYY-MM-DD字符串保存，与数据库中的格式一致
+PARTITION_COLUMN = 'created_date'
+
+# etl_state中记录当前一代暂存目录代号的键
+STAGING_GENERATION_KEY = 'staging_generation'
+
+# 按字典编码保存的低基数列
+DICTIONARY_COLUMNS = ['event_name', 'country_code', 'device_category']
+
+def staging_available():
+    """是否已安装pyarrow"""
+    return pa is not None
+
+def staging_dir_for(db_file):
+    """数据库文件对应的暂存区目录"""
+    return db_file + STAGING_DIR_SUFFIX
+
+def connection_staging_dir(conn):
+    """连接所打开的数据库文件对应的暂存区目录，内存数据库返回None"""
+    db_file = conn.execute("PRAGMA database_list").fetchone()[2]
+    return staging_dir_for(db_file) if db_file else None
+
+def clear_staging(staging_dir):
+    """删除暂存区"""
+    if os.path.exists(staging_dir):
+        shutil.rmtree(staging_dir)
+
+def partitioning():
+    """按created_date分区的目录结构（created_date=YYYY-MM-DD）"""
+    return ds.partitioning(pa.schema([(PARTITION_COLUMN, pa.string())]), flavor='hive')
+
+def write_staging(staging_dir, table_name, df, first_id):
+    """将数据块追加写入暂存区，返回写入的文件列表
+
+    df须包含id列和created_date列；文件名包含数据块的首个ID，
+    已有的文件不会被覆盖，增量导入时直接追加新文件。
+    """
+    if df.empty:
+        return []
+    df = df.copy()
+    for col in DICTIONARY_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+
+    written_files = []
+    ds.write_dataset(
+        pa.Table.from_pandas(df, preserve_index=False),
+        os.path.join(staging_dir, table_name),
+        format='parquet',
+        partitioning=partitioning(),
+        basename_template=f"part-{first_id:012d}-{{i}}.parquet",
+        existing_data_behavior='overwrite_or_ignore',
+        file_visitor=lambda written_file: written_files.append(written_file.path)
+    )
+    return written_files
+
+def remove_staging_files(paths):
+    """删除写入失败时已写入的暂存文件"""
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+def staging_watermark_key(table_name):
+    """etl_state中记录数据集已写入暂存区的最大ID的键"""
+    return f"staging_{table_name}_id"
+
+def generation_dir(staging_dir, generation):
+    """暂存区中某一代数据的目录"""
+    return os.path.join(staging_dir, f"generation-{generation}")
+
+def part_first_id(path):
+    """暂存文件名中记录的数据块首个ID"""
+    return int(os.path.basename(path).split('-')[1])
+
+def list_staging_files(data_dir, table_name):
+    """一代暂存目录中数据集的全部文件"""
+    return glob.glob(os.path.join(data_dir, table_name, '*', '*.parquet'))
+
+def begin_staging_generation(cursor, staging_dir):
+    """开始新的一代暂存数据并返回其目录，须在全量导入清空etl_state之后、与导入数据在同一事务中调用"""
+    generation = time.time_ns()
+    set_etl_state(cursor, STAGING_GENERATION_KEY, generation)
+    for table_name in STAGING_TABLES:
+        set_etl_state(cursor, staging_watermark_key(table_name), 0)
+    return generation_dir(staging_dir, generation)
+
+def mark_staged(cursor, table_name, max_id):
+    """记录数据集已写入暂存区的最大ID，与写入的数据在同一事务中提交"""
+    set_etl_state(cursor, staging_watermark_key(table_name), max_id)
+
+def current_staging_dir(conn):
+    """当前一代暂存数据的目录
+
+    暂存区缺少数据库中的部分数据时（如之后的导入未写入暂存区）返回None。
+    """
+    staging_dir = connection_staging_dir(conn)
+    cursor = conn.cursor()
+    generation = get_etl_state(cursor, STAGING_GENERATION_KEY)
+    if not staging_dir or generation is None:
+        return None
+    normalized = is_normalized(cursor)
+    for table_name in STAGING_TABLES:
+        max_id = cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {storage_table(table_name, normalized)}").fetchone()[0]
+        if get_etl_state(cursor, staging_watermark_key(table_name), 0) != max_id:
+            return None
+    return generation_dir(staging_dir, generation)
+
+def prune_staging(conn):
+    """删除未提交的暂存数据：不是当前一代的目录，以及当前一代中ID超过已记录最大ID的文件
+
+    这些数据属于已被替换或事务已回滚的导入。须在本次导入修改etl_state之前调用。
+    """
+    staging_dir = connection_staging_dir(conn)
+    if not staging_dir or not os.path.exists(staging_dir):
+        return
+    cursor = conn.cursor()
+    generation = get_etl_state(cursor, STAGING_GENERATION_KEY)
+    current_dir = generation_dir(staging_dir, generation) if generation is not None else None
+    for name in os.listdir(staging_dir):
+        path = os.path.join(staging_dir, name)
+        if path == current_dir:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    if current_dir and os.path.exists(current_dir):
+        for table_name in STAGING_TABLES:
+            watermark = get_etl_state(cursor, staging_watermark_key(table_name), 0)
+            remove_staging_files(
+                path for path in list_staging_files(current_dir, table_name) if part_first_id(path) > watermark
+            )
+
+def open_staging(conn, table_name):
+    """打开与数据库中同名表一致的暂存数据集
+
+    只读取etl_state中记录的当前一代目录，且只包含已记录的最大ID之内的文件；
+    暂存区缺少数据或行数与数据库不一致时返回None，调用方应改为从数据库读取。
+    """
+    if not staging_available():
+        logger.info("未安装pyarrow，不使用暂存区")
+        return None
+    data_dir = current_staging_dir(conn)
+    if data_dir is None:
+        logger.info(f"暂存区与数据库不一致或没有暂存数据，{table_name}改为从数据库读取")
+        return None
+    watermark = get_etl_state(conn.cursor(), staging_watermark_key(table_name), 0)
+    paths = sorted(path for path in list_staging_files(data_dir, table_name) if part_first_id(path) <= watermark)
+    if not paths:
+        logger.info(f"暂存区中没有{table_name}数据")
+        return None
+
+    dataset = ds.dataset(
+        paths, format='parquet', partitioning=partitioning(), partition_base_dir=os.path.join(data_dir, table_name)
+    )
+    row_count = conn.execute(
+        f"SELECT COUNT(*) FROM {storage_table(table_name, is_normalized(conn.cursor()))}"
+    ).fetchone()[0]
+    staged_count = dataset.count_rows()
+    if staged_count != row_count:
+        logger.warning(f"暂存区中的{table_name}数据与数据库不一致（{staged_count} 行 / {row_count} 行），改为从数据库读取")
+        return None
+    return dataset
+
+def partition_batches(dataset, batch_rows):
+    """按分区日期顺序将数据集划分为批次，每批包含若干完整日期、约batch_rows行，返回[[日期, ...]]
+
+    各分区的行数取自Parquet文件的元数据，不读取数据。
+    """
+    date_rows = {}
+    for fragment in dataset.get_fragments():
+        partition_date = ds.get_partition_keys(fragment.partition_expression)[PARTITION_COLUMN]
+        date_rows[partition_date] = date_rows.get(partition_date, 0) + fragment.count_rows()
+    batches = []
+    batch, rows = [], 0
+    for partition_date in sorted(date_rows):
+        batch.append(partition_date)
+        rows += date_rows[partition_date]
+        if rows >= batch_rows:
+            batches.append(batch)
+            batch, rows = [], 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+def read_staging_batches(conn, table_name, columns, batch_rows):
+    """按created_date分区分批读取暂存区的指定列，返回DataFrame的迭代器；暂存区不可用时返回None
+
+    每批包含若干完整日期、约batch_rows行，只读取这些日期的分区，内存占用与批次大小相关。
+    """
+    dataset = open_staging(conn, table_name)
+    if dataset is None:
+        return None
+    logger.info(f"从暂存区按日期分批读取{table_name}: {', '.join(columns)}")
+    return (
+        dataset.to_table(columns=columns, filter=ds.field(PARTITION_COLUMN).isin(dates)).to_pandas()
+        for dates in partition_batches(dataset, batch_rows)
+    )
+
+def read_staging(conn, table_name, columns):
+    """从暂存区读取指定的列，返回DataFrame；暂存区不可用时返回None
+
+    字典编码的列读取后为category类型，created_date为字符串。
+    """
+    dataset = open_staging(conn, table_name)
+    if dataset is None:
+        return None
+    logger.info(f"从暂存区读取{table_name}: {', '.join(columns)}")
+    return dataset.to_table(columns=columns).to_pandas()
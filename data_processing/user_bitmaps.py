@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+用户位图
+为每个统计日期（及国家、设备）保存当天出现的用户集合，以users表的rowid为位序号，
+压缩后存入user_bitmaps表。位图可按任意日期范围合并，得到精确的去重用户数（DAU/WAU/MAU），
+无需重新扫描事件表。
+"""
+
+import os
+import zlib
+import sqlite3
+import argparse
+from datetime import datetime, timedelta
+import numpy as np
+
+# 项目根目录
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 数据库文件路径
+DB_FILE = os.path.join(ROOT_DIR, 'database', 'app.db')
+
+# 位图的分组维度，与统计表对应：total对应daily_stats，其余为country_stats、device_stats的维度列
+TOTAL_DIMENSION = 'total'
+BITMAP_DIMENSIONS = [TOTAL_DIMENSION, 'country_code', 'device_category']
+
+INSERT_USER_BITMAP_SQL = """
+INSERT INTO user_bitmaps (dimension, stat_date, dimension_value, user_count, user_bitmap)
+VALUES (?, ?, ?, ?, ?)
+"""
+
+def encode_bitmap(user_rowids):
+    """将用户rowid集合编码为压缩位图，第n位表示rowid为n的用户"""
+    bits = np.zeros(int(user_rowids.max()) + 1, dtype=bool)
+    bits[user_rowids] = True
+    return zlib.compress(np.packbits(bits, bitorder='little').tobytes())
+
+def decode_bitmap(user_bitmap):
+    """解压位图，返回只读的uint8数组"""
+    return np.frombuffer(zlib.decompress(user_bitmap), dtype=np.uint8)
+
+def or_bits(merged, bits):
+    """将解压后的位图按位或合并到merged（None表示空集合），返回合并结果，不修改bits"""
+    if merged is None:
+        return bits.copy()
+    if len(bits) > len(merged):
+        merged, bits = bits.copy(), merged
+    merged[:len(bits)] |= bits
+    return merged
+
+def bitmap_count(bits):
+    """位图中的用户数"""
+    return 0 if bits is None else int(np.bitwise_count(bits).sum())
+
+def build_user_bitmap_rows(user_days):
+    """由(stat_date, country_code, device_category, user_rowid)记录生成user_bitmaps表的插入记录
+
+    user_rowid为空的记录（用户不在users表中）不计入。
+    """
+    user_days = user_days.dropna(subset=['user_rowid'])
+    user_days = user_days.astype({'user_rowid': np.int64})
+    rows = []
+    for dimension in BITMAP_DIMENSIONS:
+        keys = ['stat_date'] if dimension == TOTAL_DIMENSION else ['stat_date', dimension]
+        grouped = user_days.drop_duplicates(keys + ['user_rowid']).groupby(keys, observed=True, dropna=False)
+        for key, user_rowids in grouped['user_rowid']:
+            stat_date, dimension_value = (key[0], '') if dimension == TOTAL_DIMENSION else key
+            rowids = user_rowids.to_numpy()
+            rows.append((dimension, stat_date, dimension_value, len(rowids), encode_bitmap(rowids)))
+    return rows
+
+def count_unique_users(conn, start_date, end_date, dimension=None):
+    """合并日期范围内（含首尾）的位图，返回去重用户数
+
+    dimension为None时返回总用户数；为country_code或device_category时返回{维度值: 用户数}。
+    """
+    dimension = dimension or TOTAL_DIMENSION
+    if dimension not in BITMAP_DIMENSIONS:
+        raise ValueError(f"无效的位图维度: {dimension}")
+    merged = {}
+    cursor = conn.execute("""
+    SELECT dimension_value, user_bitmap
+    FROM user_bitmaps
+    WHERE dimension = ? AND stat_date BETWEEN ? AND ?
+    """, (dimension, start_date, end_date))
+    for dimension_value, user_bitmap in cursor:
+        merged[dimension_value] = or_bits(merged.get(dimension_value), decode_bitmap(user_bitmap))
+    if dimension == TOTAL_DIMENSION:
+        return bitmap_count(merged.get(''))
+    return {dimension_value: bitmap_count(bits) for dimension_value, bits in merged.items()}
+
+def rolling_unique_users(conn, start_date, end_date, window_days):
+    """返回[(日期, 截至该日window_days天内的去重用户数)]，window_days为7、30时即WAU、MAU"""
+    first_date = (datetime.strptime(start_date, '%Y-%m-%d') - timedelta(days=window_days - 1)).strftime('%Y-%m-%d')
+    daily_bits = {
+        stat_date: decode_bitmap(user_bitmap)
+        for stat_date, user_bitmap in conn.execute("""
+        SELECT stat_date, user_bitmap
+        FROM user_bitmaps
+        WHERE dimension = ? AND stat_date BETWEEN ? AND ?
+        """, (TOTAL_DIMENSION, first_date, end_date))
+    }
+    results = []
+    current = datetime.strptime(start_date, '%Y-%m-%d')
+    last = datetime.strptime(end_date, '%Y-%m-%d')
+    while current <= last:
+        merged = None
+        for offset in range(window_days):
+            bits = daily_bits.get((current - timedelta(days=offset)).strftime('%Y-%m-%d'))
+            if bits is not None:
+                merged = or_bits(merged, bits)
+        results.append((current.strftime('%Y-%m-%d'), bitmap_count(merged)))
+        current += timedelta(days=1)
+    return results
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="按日期范围合并用户位图，计算去重用户数")
+    parser.add_argument("start_date", help="开始日期，YYYY-MM-DD")
+    parser.add_argument("end_date", help="结束日期（含），YYYY-MM-DD")
+    parser.add_argument("--dimension", choices=BITMAP_DIMENSIONS[1:], help="按国家或设备分组")
+    parser.add_argument("--rolling", type=int, metavar="DAYS", help="输出每天截至当日DAYS天内的去重用户数")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        if args.rolling:
+            for stat_date, user_count in rolling_unique_users(conn, args.start_date, args.end_date, args.rolling):
+                print(f"{stat_date}\t{user_count}")
+        elif args.dimension:
+            counts = count_unique_users(conn, args.start_date, args.end_date, args.dimension)
+            for dimension_value, user_count in sorted(counts.items(), key=lambda item: -item[1]):
+                print(f"{dimension_value}\t{user_count}")
+        else:
+            print(count_unique_users(conn, args.start_date, args.end_date))
+    finally:
+        conn.close()
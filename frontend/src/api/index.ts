@@ -157,6 +157,35 @@ export interface TimelineItem {
   device_count: number
 }
 
+// 小时统计数据类型，dimension为country或device时包含对应字段
+export interface HourlyItem {
+  date: string
+  hour: number
+  user_count: number
+  event_count: number
+  revenue: number
+  new_user_count?: number
+  purchase_count?: number
+  country?: string
+  device?: string
+}
+
+// 维度统计数据类型，维度列（如media_source、platform）以列名为键
+export interface DimensionItem {
+  date: string
+  user_count: number
+  new_user_count: number
+  event_count: number
+  purchase_count: number
+  revenue: number
+  [dimensionColumn: string]: string | number
+}
+
+// 维度统计响应，dimension为维度列
+export interface DimensionResponse extends ListResponse<DimensionItem> {
+  dimension: string[]
+}
+
 // 国家统计数据类型
 export interface CountryItem {
   country: string
@@ -179,6 +208,15 @@ export interface DetailsData {
   devices: { device: string; users: number }[]
 }
 
+// 已登记LTV窗口的汇总数据类型
+export interface LtvWindowStats {
+  window: string
+  days: number
+  user_count: number
+  total_ltv: number
+  avg_ltv: number
+}
+
 // LTV概览数据类型
 export interface LtvOverviewData {
   avg_ltv_1d: number
@@ -191,6 +229,7 @@ export interface LtvOverviewData {
   total_ltv: number
   user_count: number
   avg_purchases: number
+  windows: LtvWindowStats[]
 }
 
 // LTV数据项类型（按用户）
@@ -375,6 +414,68 @@ export const getCountryData = async (date?: string, loadingState?: { value: bool
   );
 }
 
+/**
+ * 获取小时统计数据
+ * @param date 日期参数，格式为YYYY-MM-DD或startDate|endDate
+ * @param dimension 可选的分组维度：country或device
+ * @param loadingState 可选的加载状态ref
+ */
+export const getHourlyData = async (
+  date: string,
+  dimension?: 'country' | 'device',
+  loadingState?: { value: boolean }
+): Promise<ApiResponse<ListResponse<HourlyItem>> | null> => {
+  if (loadingState) loadingState.value = true;
+  
+  const cacheKey = ApiCache.generateKey('/api/hourly', { date, dimension: dimension || '' });
+  
+  return safeApiCall(
+    async () => {
+      const url = dimension
+        ? `/api/hourly?date=${date}&dimension=${dimension}`
+        : `/api/hourly?date=${date}`;
+      const response = await apiClient.get<ApiResponse<ListResponse<HourlyItem>>>(url);
+      return response.data;
+    },
+    cacheKey,
+    300000, // 5分钟缓存
+    loadingState,
+    '获取小时统计数据失败'
+  );
+}
+
+/**
+ * 获取登记维度的统计数据
+ * @param name 维度名称，如media_source、platform、media_source_platform
+ * @param date 可选的日期参数，格式为YYYY-MM-DD或startDate|endDate
+ * @param value 可选，只返回第一个维度列等于该值的数据（如某个媒体来源）
+ * @param loadingState 可选的加载状态ref
+ */
+export const getDimensionData = async (
+  name: string,
+  date?: string,
+  value?: string,
+  loadingState?: { value: boolean }
+): Promise<ApiResponse<DimensionResponse> | null> => {
+  if (loadingState) loadingState.value = true;
+  
+  const cacheKey = ApiCache.generateKey('/api/dimension', { name, date: date || '', value: value || '' });
+  
+  return safeApiCall(
+    async () => {
+      const params = new URLSearchParams({ name });
+      if (date) params.append('date', date);
+      if (value) params.append('value', value);
+      const response = await apiClient.get<ApiResponse<DimensionResponse>>(`/api/dimension?${params.toString()}`);
+      return response.data;
+    },
+    cacheKey,
+    300000, // 5分钟缓存
+    loadingState,
+    '获取维度统计数据失败'
+  );
+}
+
 /**
  * 获取设备维度数据
  * @param date 可选的日期参数，格式为YYYY-MM-DD
@@ -440,7 +541,7 @@ export const getLtvOverview = async (loadingState?: { value: boolean }): Promise
 /**
  * 获取LTV详细数据
  * @param groupBy 分组方式: country/device/date/undefined(默认按用户返回)
- * @param window 时间窗口: 1d/7d/14d/30d/60d/90d/total
+ * @param window 时间窗口: 已登记的窗口名称(如7d、180d)或total
  * @param loadingState 可选的加载状态ref
  */
 export const getLtvData = async <T>(